@@ -23,3 +23,13 @@ CSRF_COOKIE_NAME = f"{GAME_SLUG}_csrf" if GAME_SLUG else "game_csrf"
 
 DB_NAME = _env("DB_NAME", GAME_SLUG or "agame")
 DB_USER = _env("DB_USER", DB_NAME)
+
+STATE_CACHE_BACKEND = _env("STATE_CACHE_BACKEND", "none")
+STATE_CACHE_SINGLE_PROCESS = _env("STATE_CACHE_SINGLE_PROCESS", "false").lower() in ("1", "true", "yes")
+STATE_STORAGE = _env("STATE_STORAGE", "rows")
+TOWN_GENERATOR = _env("TOWN_GENERATOR", "classic")
+ASYNC_VIEWS = _env("ASYNC_VIEWS", "false").lower() in ("1", "true", "yes")
+SLOW_QUERY_MS = float(_env("SLOW_QUERY_MS", "100"))
+DB_POOL_SIZE = int(_env("DB_POOL_SIZE", "20"))
+DB_MULTI_STATEMENTS = _env("DB_MULTI_STATEMENTS", "false").lower() in ("1", "true", "yes")
+DB_REPLICA_HOSTS = [host.strip() for host in _env("DB_REPLICA_HOSTS", "").split(",") if host.strip()]
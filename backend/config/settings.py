@@ -1,15 +1,30 @@
 import os
 from pathlib import Path
+
 from .game_config import (
+    ASYNC_VIEWS,
+    DB_MULTI_STATEMENTS,
+    DB_POOL_SIZE,
+    DB_REPLICA_HOSTS,
     CSRF_COOKIE_NAME as GAME_CSRF_COOKIE_NAME,
     DB_NAME,
     DB_USER,
     SESSION_COOKIE_NAME as GAME_SESSION_COOKIE_NAME,
+    SLOW_QUERY_MS,
+    STATE_CACHE_BACKEND,
+    STATE_CACHE_SINGLE_PROCESS,
+    STATE_STORAGE,
+    TOWN_GENERATOR,
     URL_PATH,
 )
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 
+# Shared game content (dialog, quests) at the repository root.
+GAME_CONTENT_DIR = BASE_DIR.parent / 'content'
+# Hashed, precompressed bundles written by `manage.py build_content`.
+GAME_CONTENT_BUILD_DIR = BASE_DIR / 'content_build'
+
 SECRET_KEY = os.environ.get('DJANGO_SECRET_KEY')
 if not SECRET_KEY:
     raise RuntimeError('DJANGO_SECRET_KEY is required')
@@ -27,9 +42,11 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'game.middleware.ServerTimingMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
+    'game.sessions.SessionRefreshMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
@@ -41,7 +58,8 @@ WSGI_APPLICATION = 'config.wsgi.application'
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.mysql',
+        # Django's MySQL backend plus a per-process connection pool (game.pool).
+        'ENGINE': 'game.backends.mysql',
         'NAME': DB_NAME,
         'USER': DB_USER,
         'PASSWORD': os.environ.get('DB_PASSWORD', ''),
@@ -49,19 +67,84 @@ DATABASES = {
         'PORT': '3306',
         'OPTIONS': {
             'charset': 'utf8mb4',
+            # Lets game.db.batch send several statements in one round trip.
+            # Off by default: it also lets an injected "; ..." run as a second
+            # statement on every connection, replicas included.
+            'multi_statements': DB_MULTI_STATEMENTS,
+            # Seconds throughout. Idle connections older than check_after are
+            # pinged before reuse; lifetimes are jittered to spread reconnects.
+            'pool': {
+                'max_size': DB_POOL_SIZE,
+                'timeout': 10,
+                'max_lifetime': 30 * 60,
+                'max_idle': 5 * 60,
+                'check_after': 1,
+            },
         },
     }
 }
 
+# Read replicas, one alias per DB_REPLICA_HOSTS entry with the primary's
+# credentials. Reads inside game.db.read_replica() go to one of them; tests
+# mirror them onto the test database.
+for _index, _host in enumerate(DB_REPLICA_HOSTS, 1):
+    DATABASES[f'replica{_index}'] = {**DATABASES['default'], 'HOST': _host, 'TEST': {'MIRROR': 'default'}}
+GAME_DB_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+
+# Statements through game.db slower than this are logged on "game.sql".
+GAME_SLOW_QUERY_MS = SLOW_QUERY_MS
+
+# Async views (ASGI only): serve the user and town endpoints as coroutines.
+# Their DB work runs on this many game.db threads per process; each borrows a
+# pooled MySQL connection for one unit of work, so there are never more
+# threads than connections (game.db refuses to start otherwise).
+GAME_ASYNC_VIEWS = ASYNC_VIEWS
+GAME_DB_ASYNC_WORKERS = DB_POOL_SIZE
+
+# Caches — LocMemCache is the local stand-in; point "default" at Redis or
+# Memcached in production when GAME_STATE_CACHE uses the shared backend.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# Per-player snapshot/user cache: "none" (the default), "shared" (Django
+# cache alias above) or "local" (in-process LRU). Writes only invalidate the
+# process they run in, so "local", or "shared" over LocMemCache, is refused
+# unless SINGLE_PROCESS says one worker serves every player.
+GAME_STATE_CACHE = {
+    'BACKEND': STATE_CACHE_BACKEND,
+    'SINGLE_PROCESS': STATE_CACHE_SINGLE_PROCESS,
+    'MAX_BYTES': 64 * 1024 * 1024,
+    'ALIAS': 'default',
+    'TIMEOUT': 300,
+}
+
+# Player progress layout: "rows" (one row per flag/item/NPC) or "document"
+# (one encoded column on player_towns). Convert with `manage.py convert_player_state`.
+GAME_STATE_STORAGE = STATE_STORAGE
+
+# Town maps: "classic" (the hand-placed quest town, the same for every seed)
+# or "procedural" (roads, buildings and placements generated from each
+# player's seed at WIDTH x HEIGHT tiles). Switching changes existing maps.
+GAME_TOWN_GENERATOR = {
+    'NAME': TOWN_GENERATOR,
+    'WIDTH': 128,
+    'HEIGHT': 96,
+}
+
 # Session config — anonymous user persistence
-SESSION_ENGINE = 'django.contrib.sessions.backends.db'
+SESSION_ENGINE = 'game.sessions'
 SESSION_COOKIE_AGE = 60 * 60 * 24 * 365 * 2  # 2 years
 SESSION_COOKIE_NAME = GAME_SESSION_COOKIE_NAME
 SESSION_COOKIE_PATH = URL_PATH
 SESSION_COOKIE_SECURE = True
 SESSION_COOKIE_HTTPONLY = True
 SESSION_COOKIE_SAMESITE = 'Lax'
-SESSION_SAVE_EVERY_REQUEST = True
+# Signed cookie, re-issued at most once a day to keep the expiry sliding.
+SESSION_SAVE_EVERY_REQUEST = False
+GAME_SESSION_REFRESH_SECONDS = 60 * 60 * 24
 
 # CORS
 CORS_ALLOWED_ORIGINS = [
@@ -94,6 +177,10 @@ REST_FRAMEWORK = {
         'rest_framework.permissions.AllowAny',
     ],
     'UNAUTHENTICATED_USER': None,
+    'DEFAULT_RENDERER_CLASSES': [
+        'game.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
 }
 
 LANGUAGE_CODE = 'en-us'
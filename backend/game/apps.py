@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class GameConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'game'
+
+    def ready(self):
+        # Compile quest content up front so a broken file fails the deploy.
+        from .town import quest_rules
+
+        quest_rules()
@@ -0,0 +1,213 @@
+import pickle
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+
+# Snapshot entries are keyed by (user_id, version) and found through a
+# per-user version pointer. Write paths move the pointer, so an entry for an
+# old version can never be served for a newer one; old entries simply age out.
+
+
+class LocalLRUCache:
+    """In-process LRU bounded by the approximate pickled size of its entries.
+
+    Coherent only within one process: use it for single-worker deployments
+    and development, and the shared backend when several workers serve the
+    same players.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def add(self, key, value):
+        return self._store(key, value, replace=False)
+
+    def set(self, key, value):
+        self._store(key, value, replace=True)
+
+    def _store(self, key, value, replace):
+        size = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        with self._lock:
+            old = self._entries.get(key)
+            if old is not None and not replace:
+                return False
+            if old is not None:
+                del self._entries[key]
+                self._bytes -= old[1]
+            if size > self.max_bytes:
+                return False
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+class SharedCache:
+    """Adapter over a Django cache alias (Redis/Memcached in production,
+    LocMemCache as the local stand-in)."""
+
+    def __init__(self, alias, timeout):
+        self.alias = alias
+        self.timeout = timeout
+
+    @property
+    def _cache(self):
+        return caches[self.alias]
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def add(self, key, value):
+        return self._cache.add(key, value, self.timeout)
+
+    def set(self, key, value):
+        self._cache.set(key, value, self.timeout)
+
+    def delete(self, key):
+        self._cache.delete(key)
+
+    def clear(self):
+        self._cache.clear()
+
+
+class NullCache:
+    def get(self, key):
+        return None
+
+    def add(self, key, value):
+        return False
+
+    def set(self, key, value):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def _per_process(kind, config):
+    if kind == "local":
+        return True
+    return kind == "shared" and isinstance(caches[config.get("ALIAS", "default")], LocMemCache)
+
+
+def _build_backend():
+    config = getattr(settings, "GAME_STATE_CACHE", {})
+    kind = config.get("BACKEND", "none")
+    if _per_process(kind, config) and not config.get("SINGLE_PROCESS"):
+        # Another worker would keep serving what this one just invalidated.
+        raise ImproperlyConfigured(
+            f"GAME_STATE_CACHE backend {kind!r} is per-process; set SINGLE_PROCESS "
+            "(STATE_CACHE_SINGLE_PROCESS=true) only when one worker serves every player"
+        )
+    if kind == "local":
+        return LocalLRUCache(config.get("MAX_BYTES", 64 * 1024 * 1024))
+    if kind == "shared":
+        return SharedCache(config.get("ALIAS", "default"), config.get("TIMEOUT", 300))
+    if kind == "none":
+        return NullCache()
+    raise ValueError(f"unknown GAME_STATE_CACHE backend: {kind}")
+
+
+def backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = _build_backend()
+    return _backend
+
+
+def reset_backend():
+    global _backend
+    with _backend_lock:
+        _backend = None
+
+
+def _version_key(user_id):
+    return f"game:town-version:{user_id}"
+
+
+def _snapshot_key(user_id, version):
+    return f"game:town:{user_id}:{version}"
+
+
+def _user_key(user_id):
+    return f"game:user:{user_id}"
+
+
+def get_town_version(user_id):
+    return backend().get(_version_key(user_id))
+
+
+def get_snapshot(user_id):
+    cache = backend()
+    version = cache.get(_version_key(user_id))
+    if version is None:
+        return None
+    return cache.get(_snapshot_key(user_id, version))
+
+
+def add_snapshot(user_id, snapshot):
+    """Populate from a read path. Never moves an existing version pointer, so
+    a slow reader cannot roll the pointer back past a concurrent write."""
+    cache = backend()
+    cache.set(_snapshot_key(user_id, snapshot["version"]), snapshot)
+    cache.add(_version_key(user_id), snapshot["version"])
+
+
+def store_snapshot(user_id, snapshot):
+    """Publish a snapshot from a write path once its transaction commits."""
+    cache = backend()
+    cache.set(_snapshot_key(user_id, snapshot["version"]), snapshot)
+    cache.set(_version_key(user_id), snapshot["version"])
+
+
+def invalidate_town(user_id):
+    backend().delete(_version_key(user_id))
+
+
+def get_user_data(user_id):
+    return backend().get(_user_key(user_id))
+
+
+def set_user_data(user_id, data):
+    backend().set(_user_key(user_id), data)
+
+
+def invalidate_user(user_id):
+    backend().delete(_user_key(user_id))
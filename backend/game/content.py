@@ -0,0 +1,223 @@
+import gzip
+import hashlib
+import json
+import re
+import threading
+from collections import OrderedDict
+
+try:
+    import brotli
+except ImportError:  # optional: gzip variants are always built
+    brotli = None
+
+from django.conf import settings
+
+from .layout import DISTRICTS, NPCS, district_at
+
+# Release bundles built from content/ by `manage.py build_content`. Each
+# bundle is named by a hash of its bytes, so a URL's body never changes and
+# can be cached forever; manifest.json maps bundle names to the current files.
+
+DEFAULT_LOCALE = "en"
+SOURCES = {
+    "ui": "ui.json",
+    "dialog": "dialog/town_dialog.json",
+    "story": "story/town_story.json",
+}
+MANIFEST_NAME = "manifest.json"
+BUNDLE_NAME = re.compile(r"^[a-z0-9-]+\.[A-Za-z_-]+\.[0-9a-f]{16}\.json$")
+
+# Preferred first when the client accepts several.
+ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+
+# Files kept in memory per process: a few releases' bundles and variants.
+CACHED_FILES = 128
+
+
+class ContentError(ValueError):
+    pass
+
+
+def _locale_path(root, relative, locale):
+    path = root / relative
+    if locale == DEFAULT_LOCALE:
+        return path
+    return path.with_name(f"{path.stem}.{locale}{path.suffix}")
+
+
+def discover_locales(root):
+    """The default locale plus any ``<name>.<locale>.json`` translation found."""
+    locales = {DEFAULT_LOCALE}
+    for relative in SOURCES.values():
+        base = root / relative
+        for path in base.parent.glob(f"{base.stem}.*{base.suffix}"):
+            locales.add(path.name[len(base.stem) + 1 : -len(base.suffix)])
+    return sorted(locales)
+
+
+def _read_json(path):
+    with open(path, encoding="utf-8") as handle:
+        return json.load(handle)
+
+
+def load_sources(root, locale):
+    """Parsed sources for ``locale``; anything it does not translate comes from the default."""
+    sources = {name: _read_json(root / relative) for name, relative in SOURCES.items()}
+    if locale == DEFAULT_LOCALE:
+        return sources
+    for name, relative in SOURCES.items():
+        path = _locale_path(root, relative, locale)
+        if not path.exists():
+            continue
+        translated = _read_json(path)
+        merged = dict(sources[name])
+        for key, value in translated.items():
+            if isinstance(value, dict) and isinstance(merged.get(key), dict):
+                merged[key] = {**merged[key], **value}
+            else:
+                merged[key] = value
+        sources[name] = merged
+    return sources
+
+
+def missing_keys(dialog, required_keys):
+    known = set()
+    for section in dialog.values():
+        if isinstance(section, dict):
+            known.update(section)
+    return sorted(set(required_keys) - known)
+
+
+def split_bundles(sources):
+    """Return ``{bundle_name: data}``: one core bundle plus NPC dialog per district."""
+    dialog = sources["dialog"]
+    npc_districts = {npc["npc_id"]: district_at(npc["x"], npc["y"]) for npc in NPCS}
+    core_messages = {}
+    district_messages = {district["district_id"]: {} for district in DISTRICTS}
+    for key, text in dialog.get("messages", {}).items():
+        parts = key.split(".")
+        district_id = npc_districts.get(parts[1]) if parts[0] == "dialog" and len(parts) > 2 else None
+        if district_id is None:
+            core_messages[key] = text
+        else:
+            district_messages[district_id][key] = text
+
+    core = {section: values for section, values in dialog.items() if section != "messages"}
+    core.update(ui=sources["ui"], story=sources["story"], messages=core_messages)
+    bundles = {"core": core}
+    for district_id, messages in district_messages.items():
+        bundles[f"dialog-{district_id}"] = {"messages": messages}
+    return bundles
+
+
+def _encode(data):
+    return json.dumps(data, ensure_ascii=False, sort_keys=True, separators=(",", ":")).encode("utf-8")
+
+
+def _write_variants(out_dir, filename, body):
+    (out_dir / filename).write_bytes(body)
+    # mtime=0 keeps the gzip bytes identical across rebuilds.
+    (out_dir / f"{filename}.gz").write_bytes(gzip.compress(body, compresslevel=9, mtime=0))
+    if brotli is not None:
+        (out_dir / f"{filename}.br").write_bytes(brotli.compress(body))
+
+
+def build(out_dir, required_keys, root=None):
+    """Validate sources, write hashed bundles and their variants, return the manifest.
+
+    Fails with ContentError if the default locale lacks any of
+    ``required_keys``; other locales fall back to it key by key.
+    """
+    root = root or settings.GAME_CONTENT_DIR
+    out_dir.mkdir(parents=True, exist_ok=True)
+    default = load_sources(root, DEFAULT_LOCALE)
+    missing = missing_keys(default["dialog"], required_keys)
+    if missing:
+        raise ContentError(f"message keys referenced by the game are missing from content: {', '.join(missing)}")
+
+    locales = {}
+    for locale in discover_locales(root):
+        files = {}
+        for name, data in split_bundles(load_sources(root, locale)).items():
+            body = _encode(data)
+            filename = f"{name}.{locale}.{hashlib.sha256(body).hexdigest()[:16]}.json"
+            _write_variants(out_dir, filename, body)
+            files[name] = filename
+        locales[locale] = files
+
+    manifest = {
+        "release": hashlib.sha256(_encode(locales)).hexdigest()[:16],
+        "default_locale": DEFAULT_LOCALE,
+        "locales": locales,
+        "districts": {district["district_id"]: list(district["bounds"]) for district in DISTRICTS},
+    }
+    (out_dir / MANIFEST_NAME).write_bytes(_encode(manifest))
+    return manifest
+
+
+_files = OrderedDict()
+_files_lock = threading.Lock()
+
+
+def _read_cached(path):
+    # Misses are not cached: a bundle requested before the build finishes
+    # must appear once it does, and made-up names must not fill memory.
+    with _files_lock:
+        body = _files.get(path)
+        if body is not None:
+            _files.move_to_end(path)
+            return body
+    try:
+        body = path.read_bytes()
+    except FileNotFoundError:
+        return None
+    with _files_lock:
+        _files[path] = body
+        if len(_files) > CACHED_FILES:
+            _files.popitem(last=False)
+    return body
+
+
+def reset():
+    with _files_lock:
+        _files.clear()
+
+
+def manifest():
+    body = _read_cached(settings.GAME_CONTENT_BUILD_DIR / MANIFEST_NAME)
+    return json.loads(body) if body is not None else None
+
+
+def accepted_encodings(header):
+    accepted = set()
+    for part in (header or "").split(","):
+        coding, _, params = part.strip().partition(";")
+        quality = params.strip()
+        if quality.startswith("q="):
+            try:
+                if float(quality[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        if coding:
+            accepted.add(coding.strip().lower())
+    return accepted
+
+
+def bundle(filename, accept_encoding):
+    """Return ``(body, content_encoding)`` for a built bundle, or None if unknown.
+
+    Files from earlier releases stay servable until they are deleted, so a
+    client that loaded the previous manifest can finish its fetches.
+    """
+    if not BUNDLE_NAME.match(filename):
+        return None
+    out_dir = settings.GAME_CONTENT_BUILD_DIR
+    accepted = accepted_encodings(accept_encoding)
+    for encoding, suffix in ENCODINGS:
+        if encoding in accepted or "*" in accepted:
+            body = _read_cached(out_dir / f"{filename}{suffix}")
+            if body is not None:
+                return body, encoding
+    body = _read_cached(out_dir / filename)
+    return (body, None) if body is not None else None
@@ -1,19 +1,105 @@
-from django.db import connection
+import contextvars
+import logging
+import random
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS, OperationalError, close_old_connections, connections, transaction
+
+from . import pool
+
+logger = logging.getLogger("game.sql")
+
+_IDENTIFIER = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+_FINGERPRINT_RULES = [
+    (re.compile(r"'(?:[^'\\]|\\.)*'"), "?"),
+    (re.compile(r"\b\d+\b"), "?"),
+    (re.compile(r"%s"), "?"),
+    (re.compile(r"\s+"), " "),
+    (re.compile(r"\((?:\s*\?\s*,)*\s*\?\s*\)(?:\s*,\s*\((?:\s*\?\s*,)*\s*\?\s*\))*"), "(...)"),
+]
+
+# Per-request statement log; None when no request is being instrumented.
+_query_log = contextvars.ContextVar("game_query_log", default=None)
+
+# Replica alias for reads inside read_replica(); None reads from the primary.
+_replica = contextvars.ContextVar("game_db_replica", default=None)
+
+_READ_ONLY = re.compile(r"^\s*SELECT\b", re.IGNORECASE)
+# Reads that lock rows or take session locks belong on the primary.
+_PRIMARY_ONLY = re.compile(r"\b(?:FOR\s+UPDATE|LOCK\s+IN\s+SHARE\s+MODE|GET_LOCK|RELEASE_LOCK)\b", re.IGNORECASE)
+
+
+@contextmanager
+def read_replica():
+    """Send the read-only statements in this block to a replica.
+
+    Yields the chosen alias, or None when GAME_DB_REPLICAS is empty. Writes,
+    locking reads and anything inside ``atomic()`` still go to the primary,
+    and after the first write the rest of the block reads the primary too.
+    Replicas lag, so callers that must see a write check what they read (see
+    town.get_town_snapshot) and fall back to the primary.
+    """
+    aliases = settings.GAME_DB_REPLICAS
+    token = _replica.set(random.choice(aliases) if aliases else None)
+    try:
+        yield _replica.get()
+    finally:
+        _replica.reset(token)
+
+
+def _alias_for(statements):
+    alias = _replica.get()
+    if alias is None or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+        return DEFAULT_DB_ALIAS
+    if all(_READ_ONLY.match(sql) and not _PRIMARY_ONLY.search(sql) for sql in statements):
+        return alias
+    # Read your own writes for the rest of the block.
+    _replica.set(None)
+    return DEFAULT_DB_ALIAS
+
+
+def _on_replica_or_primary(statements, run):
+    alias = _alias_for(statements)
+    if alias == DEFAULT_DB_ALIAS:
+        return run(connections[alias])
+    try:
+        return run(connections[alias])
+    except OperationalError:
+        logger.warning("replica %s unavailable; reading from the primary", alias, exc_info=True)
+        _replica.set(None)
+        return run(connections[DEFAULT_DB_ALIAS])
 
 
 def _execute(sql, params=(), *, fetch=None, dicts=False):
-    with connection.cursor() as cursor:
+    return _on_replica_or_primary([sql], lambda conn: _execute_on(conn, sql, params, fetch, dicts))
+
+
+def _execute_on(conn, sql, params, fetch, dicts):
+    started = time.perf_counter()
+    with conn.cursor() as cursor:
         cursor.execute(sql, params)
         if fetch == 'one':
             row = cursor.fetchone()
+            _record(conn, sql, started, 0 if row is None else 1)
             if dicts and row is not None:
                 return _row_to_dict(cursor, row)
             return row
         if fetch == 'all':
             rows = cursor.fetchall()
+            _record(conn, sql, started, len(rows))
             if dicts:
                 return _rows_to_dicts(cursor, rows)
             return rows
+        _record(conn, sql, started, cursor.rowcount)
         return cursor.rowcount
 
 
@@ -37,6 +123,184 @@ def execute(sql, params=()):
     return _execute(sql, params, fetch=None, dicts=False)
 
 
+def batch(statements, *, dicts=False):
+    """Run several parameterized statements and return one result per statement.
+
+    ``statements`` is a sequence of ``(sql, params)`` pairs. Each result is
+    the fetched rows for a statement that returns a result set, otherwise
+    its rowcount. With ``OPTIONS["multi_statements"]`` on the MySQL alias
+    this is a single round trip; otherwise the statements run
+    one after another on the same cursor.
+    """
+    statements = [(sql.strip().rstrip(";"), list(params)) for sql, params in statements]
+    if not statements:
+        return []
+    return _on_replica_or_primary(
+        [sql for sql, _ in statements], lambda conn: _batch_on(conn, statements, dicts)
+    )
+
+
+def _batch_on(conn, statements, dicts):
+    with conn.cursor() as cursor:
+        if not _multi_statements_enabled(conn):
+            results = []
+            for sql, params in statements:
+                started = time.perf_counter()
+                cursor.execute(sql, params)
+                results.append(_cursor_result(cursor, dicts))
+                _record(conn, sql, started, _result_rows(results[-1]))
+            return results
+
+        started = time.perf_counter()
+        combined = ";\n".join(sql for sql, _ in statements)
+        cursor.execute(combined, [param for _, params in statements for param in params])
+        results = [_cursor_result(cursor, dicts)]
+        while cursor.nextset():
+            results.append(_cursor_result(cursor, dicts))
+        _record(conn, combined, started, sum(_result_rows(result) for result in results), len(statements))
+        return results
+
+
+def upsert_statement(table, columns, rows, *, update=(), ignore=False):
+    """Build a multi-row ``INSERT`` as a ``(sql, params)`` pair for ``batch``.
+
+    ``update`` names columns overwritten from the new row on duplicate key;
+    ``ignore`` makes duplicates a no-op instead.
+    """
+    for name in (table, *columns, *update):
+        if not _IDENTIFIER.match(name):
+            raise ValueError(f"invalid SQL identifier: {name!r}")
+    row_sql = "(" + ", ".join(["%s"] * len(columns)) + ")"
+    sql = (
+        f"INSERT {'IGNORE ' if ignore else ''}INTO {table} ({', '.join(columns)}) VALUES "
+        + ", ".join([row_sql] * len(rows))
+    )
+    if update:
+        sql += " ON DUPLICATE KEY UPDATE " + ", ".join(f"{col} = VALUES({col})" for col in update)
+    params = [value for row in rows for value in row]
+    return sql, params
+
+
+def upsert_many(table, columns, rows, *, update=(), ignore=False):
+    if not rows:
+        return 0
+    sql, params = upsert_statement(table, columns, rows, update=update, ignore=ignore)
+    return execute(sql, params)
+
+
+def _multi_statements_enabled(conn):
+    return conn.vendor == "mysql" and bool(conn.settings_dict.get("OPTIONS", {}).get("multi_statements"))
+
+
+def _result_rows(result):
+    return len(result) if isinstance(result, list) else max(result, 0)
+
+
+def _cursor_result(cursor, dicts):
+    if cursor.description is None:
+        return cursor.rowcount
+    rows = cursor.fetchall()
+    if dicts:
+        return _rows_to_dicts(cursor, rows)
+    return list(rows)
+
+
+def atomic():
+    return transaction.atomic()
+
+
+def on_commit(func):
+    transaction.on_commit(func)
+
+
+# Async API. Django connections belong to the thread that opened them, so
+# async callers hand whole units of work to a bounded pool of DB threads.
+# The event loop stays free while MySQL answers. Each unit of work borrows a
+# connection from the pool and returns it when it finishes.
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _check_async_workers():
+    # Each DB thread holds a pooled connection while it works; more threads
+    # than connections just queue on the pool and hit its timeout under load.
+    workers = settings.GAME_DB_ASYNC_WORKERS
+    for alias, config in settings.DATABASES.items():
+        max_size = config.get("OPTIONS", {}).get("pool", {}).get("max_size")
+        if max_size is not None and workers > max_size:
+            raise ImproperlyConfigured(
+                f"GAME_DB_ASYNC_WORKERS ({workers}) exceeds the {alias!r} connection pool ({max_size})"
+            )
+
+
+def _async_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _check_async_workers()
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.GAME_DB_ASYNC_WORKERS,
+                thread_name_prefix="game-db",
+            )
+        return _executor
+
+
+def _in_worker(func, args, kwargs):
+    close_old_connections()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+async def arun(func, *args, **kwargs):
+    """Await ``func(*args, **kwargs)`` on a DB thread.
+
+    ``func`` is ordinary sync code and may open ``atomic()``; a transaction
+    never spans an ``await``. The caller's query log is carried over.
+    """
+    return await sync_to_async(_in_worker, thread_sensitive=False, executor=_async_executor())(func, args, kwargs)
+
+
+async def afetch_one(sql, params=()):
+    return await arun(fetch_one, sql, params)
+
+
+async def afetch_all(sql, params=()):
+    return await arun(fetch_all, sql, params)
+
+
+async def afetch_dicts(sql, params=()):
+    return await arun(fetch_dicts, sql, params)
+
+
+async def aexecute(sql, params=()):
+    return await arun(execute, sql, params)
+
+
+async def abatch(statements, *, dicts=False):
+    return await arun(batch, statements, dicts=dicts)
+
+
+async def aupsert_many(table, columns, rows, *, update=(), ignore=False):
+    return await arun(upsert_many, table, columns, rows, update=update, ignore=ignore)
+
+
+def pool_stats():
+    """This process's connection pool counters, keyed by alias and target."""
+    return pool.stats()
+
+
+def pool_usage():
+    """``(in_use, idle, waiters, timeouts)`` summed over this process's pools."""
+    totals = [0, 0, 0, 0]
+    for stats in pool.stats().values():
+        for index, key in enumerate(("in_use", "idle", "waiters", "timeouts")):
+            totals[index] += stats[key]
+    return tuple(totals)
+
+
 def _row_to_dict(cursor, row):
     columns = [col[0] for col in cursor.description]
     return dict(zip(columns, row))
@@ -45,3 +309,58 @@ def _row_to_dict(cursor, row):
 def _rows_to_dicts(cursor, rows):
     columns = [col[0] for col in cursor.description]
     return [dict(zip(columns, row)) for row in rows]
+
+
+def fingerprint(sql):
+    """Normalize SQL so statements differing only in literals group together."""
+    text = sql.strip()
+    for pattern, replacement in _FINGERPRINT_RULES:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+def start_query_log():
+    return _query_log.set([])
+
+
+def stop_query_log(token):
+    entries = _query_log.get() or []
+    _query_log.reset(token)
+    return entries
+
+
+def _caller():
+    frame = sys._getframe(2)
+    while frame is not None and frame.f_globals.get("__name__") == __name__:
+        frame = frame.f_back
+    if frame is None:
+        return "?"
+    return f"{frame.f_globals.get('__name__', '?')}.{frame.f_code.co_name}:{frame.f_lineno}"
+
+
+def _record(conn, sql, started, rows, statements=1):
+    duration_ms = (time.perf_counter() - started) * 1000
+    entries = _query_log.get()
+    slow_ms = getattr(settings, "GAME_SLOW_QUERY_MS", None)
+    is_slow = slow_ms is not None and duration_ms >= slow_ms
+    if entries is None and not is_slow:
+        return
+    entry = {
+        "fingerprint": fingerprint(sql),
+        "duration_ms": duration_ms,
+        "rows": rows,
+        "statements": statements,
+        "alias": conn.alias,
+        "caller": _caller(),
+    }
+    if entries is not None:
+        entries.append(entry)
+    if is_slow:
+        logger.warning(
+            "slow query %.1fms rows=%s alias=%s caller=%s sql=%s",
+            duration_ms,
+            rows,
+            conn.alias,
+            entry["caller"],
+            entry["fingerprint"],
+        )
@@ -0,0 +1,117 @@
+import json
+
+from . import db
+
+# Versions of patch history kept per player. A stale client further behind
+# than this gets a full snapshot instead of a patch.
+PATCH_HISTORY = 32
+
+
+def empty_patch(version):
+    return {
+        "from_version": version,
+        "to_version": version,
+        "flags_added": [],
+        "items_changed": [],
+        "events_consumed": [],
+        "allowed_added": [],
+        "allowed_removed": [],
+    }
+
+
+def snapshot_patch(before, after):
+    before_flags = set(before["player_state"]["flags"])
+    before_items = {item["item_id"]: item for item in before["player_state"]["items"]}
+    after_items = {item["item_id"]: item for item in after["player_state"]["items"]}
+
+    items_changed = []
+    for item_id in sorted(set(before_items) | set(after_items)):
+        item = after_items.get(item_id)
+        if item is None:
+            items_changed.append({"item_id": item_id, "qty": 0})
+        elif before_items.get(item_id, {}).get("qty") != item["qty"]:
+            items_changed.append(item)
+
+    before_states = {event["event_id"]: event["state"] for event in before["events"]}
+    events_consumed = [
+        event["event_id"]
+        for event in after["events"]
+        if event["state"] == "consumed" and before_states.get(event["event_id"]) != "consumed"
+    ]
+
+    before_allowed = set(before["allowed_event_ids"])
+    after_allowed = set(after["allowed_event_ids"])
+
+    return {
+        "from_version": before["version"],
+        "to_version": after["version"],
+        "flags_added": [flag for flag in after["player_state"]["flags"] if flag not in before_flags],
+        "items_changed": items_changed,
+        "events_consumed": events_consumed,
+        "allowed_added": sorted(after_allowed - before_allowed),
+        "allowed_removed": sorted(before_allowed - after_allowed),
+    }
+
+
+def merge_patches(patches):
+    merged = empty_patch(patches[0]["from_version"])
+    flags = []
+    items = {}
+    consumed = []
+    added = set()
+    removed = set()
+    for patch in patches:
+        flags.extend(flag for flag in patch["flags_added"] if flag not in flags)
+        for item in patch["items_changed"]:
+            items[item["item_id"]] = item
+        consumed.extend(event_id for event_id in patch["events_consumed"] if event_id not in consumed)
+        for event_id in patch["allowed_removed"]:
+            if event_id in added:
+                added.discard(event_id)
+            else:
+                removed.add(event_id)
+        for event_id in patch["allowed_added"]:
+            if event_id in removed:
+                removed.discard(event_id)
+            else:
+                added.add(event_id)
+        merged["to_version"] = patch["to_version"]
+
+    merged["flags_added"] = sorted(flags)
+    merged["items_changed"] = [items[item_id] for item_id in sorted(items)]
+    merged["events_consumed"] = sorted(consumed)
+    merged["allowed_added"] = sorted(added)
+    merged["allowed_removed"] = sorted(removed)
+    return merged
+
+
+def record_patch(user_id, patch):
+    version = patch["to_version"]
+    db.execute(
+        "INSERT INTO player_town_patches (user_id, version, patch_json) VALUES (%s, %s, %s)",
+        [user_id, version, json.dumps(patch)],
+    )
+    # Trim history in batches rather than on every write.
+    if version % PATCH_HISTORY == 0:
+        db.execute(
+            "DELETE FROM player_town_patches WHERE user_id = %s AND version <= %s",
+            [user_id, version - PATCH_HISTORY],
+        )
+
+
+def load_patch(user_id, from_version, to_version):
+    """Return one merged patch from ``from_version`` to ``to_version``.
+
+    Returns None when the client is too far behind or the history has a gap,
+    in which case the caller should fall back to a full snapshot.
+    """
+    if from_version >= to_version or to_version - from_version > PATCH_HISTORY:
+        return None
+    rows = db.fetch_all(
+        "SELECT version, patch_json FROM player_town_patches "
+        "WHERE user_id = %s AND version > %s AND version <= %s ORDER BY version",
+        [user_id, from_version, to_version],
+    )
+    if [int(row[0]) for row in rows] != list(range(from_version + 1, to_version + 1)):
+        return None
+    return merge_patches([json.loads(row[1]) for row in rows])
@@ -0,0 +1,387 @@
+import re
+from bisect import bisect_right
+from collections import namedtuple
+from functools import lru_cache
+from types import MappingProxyType
+
+from django.conf import settings
+
+from . import procgen
+
+TOWN_WIDTH = 32
+TOWN_HEIGHT = 20
+
+PASSABLE_TILES = {"G", "P", "B"}
+
+# Where the client places a new player; reachable towns are measured from here.
+SPAWN = (2, 2)
+
+NPCS = [
+    {"npc_id": "npc_lyra", "name_key": "npc.npc_lyra", "x": 6, "y": 3},
+    {"npc_id": "npc_borin", "name_key": "npc.npc_borin", "x": 10, "y": 4},
+    {"npc_id": "npc_sable", "name_key": "npc.npc_sable", "x": 14, "y": 4},
+    {"npc_id": "npc_quill", "name_key": "npc.npc_quill", "x": 20, "y": 4},
+    {"npc_id": "npc_elowen", "name_key": "npc.npc_elowen", "x": 24, "y": 4},
+    {"npc_id": "npc_tarin", "name_key": "npc.npc_tarin", "x": 7, "y": 8},
+    {"npc_id": "npc_mara", "name_key": "npc.npc_mara", "x": 11, "y": 8},
+    {"npc_id": "npc_nessa", "name_key": "npc.npc_nessa", "x": 15, "y": 8},
+    {"npc_id": "npc_oswin", "name_key": "npc.npc_oswin", "x": 19, "y": 8},
+    {"npc_id": "npc_pru", "name_key": "npc.npc_pru", "x": 23, "y": 8},
+    {"npc_id": "npc_ren", "name_key": "npc.npc_ren", "x": 27, "y": 8},
+    {"npc_id": "npc_selin", "name_key": "npc.npc_selin", "x": 5, "y": 12},
+    {"npc_id": "npc_tovan", "name_key": "npc.npc_tovan", "x": 9, "y": 12},
+    {"npc_id": "npc_ursa", "name_key": "npc.npc_ursa", "x": 13, "y": 12},
+    {"npc_id": "npc_vann", "name_key": "npc.npc_vann", "x": 17, "y": 12},
+    {"npc_id": "npc_wren", "name_key": "npc.npc_wren", "x": 21, "y": 12},
+    {"npc_id": "npc_xara", "name_key": "npc.npc_xara", "x": 25, "y": 12},
+    {"npc_id": "npc_yorik", "name_key": "npc.npc_yorik", "x": 28, "y": 12},
+    {"npc_id": "npc_zev", "name_key": "npc.npc_zev", "x": 4, "y": 16},
+    {"npc_id": "npc_aela", "name_key": "npc.npc_aela", "x": 8, "y": 16},
+    {"npc_id": "npc_brinn", "name_key": "npc.npc_brinn", "x": 12, "y": 16},
+    {"npc_id": "npc_cass", "name_key": "npc.npc_cass", "x": 16, "y": 16},
+    {"npc_id": "npc_dane", "name_key": "npc.npc_dane", "x": 20, "y": 16},
+    {"npc_id": "npc_eris", "name_key": "npc.npc_eris", "x": 24, "y": 16},
+    {"npc_id": "npc_fenn", "name_key": "npc.npc_fenn", "x": 28, "y": 16},
+    {"npc_id": "npc_galen", "name_key": "npc.npc_galen", "x": 6, "y": 18},
+    {"npc_id": "npc_hale", "name_key": "npc.npc_hale", "x": 10, "y": 18},
+    {"npc_id": "npc_iora", "name_key": "npc.npc_iora", "x": 14, "y": 18},
+    {"npc_id": "npc_jory", "name_key": "npc.npc_jory", "x": 18, "y": 18},
+    {"npc_id": "npc_kipp", "name_key": "npc.npc_kipp", "x": 22, "y": 18},
+]
+
+# Named regions of the town, split along the main roads. Content bundles are
+# cut per district. Bounds are (x0, y0, x1, y1), end-exclusive.
+DISTRICTS = [
+    {"district_id": "gate", "bounds": (0, 0, 16, 10)},
+    {"district_id": "market", "bounds": (16, 0, TOWN_WIDTH, 10)},
+    {"district_id": "hall", "bounds": (0, 10, 16, TOWN_HEIGHT)},
+    {"district_id": "guild", "bounds": (16, 10, TOWN_WIDTH, TOWN_HEIGHT)},
+]
+
+
+def district_at(x, y):
+    for district in DISTRICTS:
+        x0, y0, x1, y1 = district["bounds"]
+        if x0 <= x < x1 and y0 <= y < y1:
+            return district["district_id"]
+    return None
+
+
+INTERACTABLE_EVENTS = [
+    {"event_id": "read_sign_gate", "type": "read_sign", "x": 3, "y": 2, "repeatable": True},
+    {"event_id": "read_sign_plaza", "type": "read_sign", "x": 16, "y": 10, "repeatable": True},
+    {"event_id": "open_chest_herb", "type": "open_chest", "x": 27, "y": 3, "repeatable": False},
+    {"event_id": "open_chest_archive", "type": "open_chest", "x": 28, "y": 14, "repeatable": False},
+    {"event_id": "enter_hall", "type": "enter_building", "x": 2, "y": 10, "repeatable": True},
+    {"event_id": "enter_guild", "type": "enter_building", "x": 30, "y": 10, "repeatable": True},
+]
+
+
+def _event_catalog(positions=None):
+    """Every event keyed by id; ``positions`` overrides the classic ``(x, y)`` by id."""
+    positions = positions or {}
+    events = {}
+    for npc in NPCS:
+        event_id = f"talk_{npc['npc_id']}"
+        x, y = positions.get(npc["npc_id"], (npc["x"], npc["y"]))
+        events[event_id] = {
+            "event_id": event_id,
+            "type": "talk_npc",
+            "x": x,
+            "y": y,
+            "repeatable": True,
+            "npc_id": npc["npc_id"],
+        }
+    for evt in INTERACTABLE_EVENTS:
+        x, y = positions.get(evt["event_id"], (evt["x"], evt["y"]))
+        events[evt["event_id"]] = {**evt, "x": x, "y": y}
+    return events
+
+
+EVENT_IDS = frozenset(_event_catalog())
+
+
+GENERATOR_CLASSIC = "classic"
+GENERATOR_PROCEDURAL = "procedural"
+
+
+def _build_tiles(seed):
+    # The classic town is hand-placed and the same for every seed.
+    _ = seed
+    street = bytearray("G" * TOWN_WIDTH, "ascii")
+    for x in (8, 16, 24):
+        street[x] = ord("P")
+    street[0] = street[-1] = ord("W")
+    halls = [(1, 5, 12, 15), (12, 15, 25, 31), (9, 11, 2, 6)]
+
+    rows = []
+    for y in range(TOWN_HEIGHT):
+        if y in (0, TOWN_HEIGHT - 1):
+            rows.append("W" * TOWN_WIDTH)
+            continue
+        if y in (6, 10, 14):
+            rows.append("W" + "P" * (TOWN_WIDTH - 2) + "W")
+            continue
+        row = bytearray(street)
+        for y0, y1, x0, x1 in halls:
+            if y0 <= y <= y1:
+                row[x0:x1] = b"W" * (x1 - x0)
+        rows.append(row.decode("ascii"))
+
+    # Bridge entrances (passable openings) for halls.
+    rows[10] = rows[10][:2] + "B" + rows[10][3:30] + "B" + rows[10][31:]
+    return rows
+
+
+def _procedural_tiles(seed, width, height):
+    return procgen.generate(
+        seed,
+        width,
+        height,
+        building_ids=[evt["event_id"] for evt in INTERACTABLE_EVENTS if evt["type"] == "enter_building"],
+        marker_ids=[npc["npc_id"] for npc in NPCS]
+        + [evt["event_id"] for evt in INTERACTABLE_EVENTS if evt["type"] != "enter_building"],
+    )
+
+
+LAYOUT_CACHE_SIZE = 1024
+
+# Square chunk edge, in tiles, for viewport streaming.
+CHUNK_SIZE = 32
+
+
+class Layout(
+    namedtuple(
+        "Layout",
+        [
+            "seed",
+            "width",
+            "height",
+            "tiles",
+            "passable",
+            "events",
+            "event_ids",
+            "npcs",
+            "chunk_npcs",
+            "chunk_events",
+            "components",
+            "home_component",
+        ],
+    )
+):
+    """Immutable, per-seed town layout shared across requests.
+
+    ``passable`` is a row-major bitmap, one bit per tile. ``events`` maps
+    event_id to a read-only event definition and ``npcs`` holds the snapshot
+    form of every NPC; neither may be mutated by callers. ``chunk_npcs`` and
+    ``chunk_events`` index NPC entries and event ids by ``(cx, cy)`` chunk.
+    ``components`` labels the passable runs of each row by connected
+    component; ``home_component`` is the one holding SPAWN.
+    """
+
+    __slots__ = ()
+
+    @property
+    def chunks_x(self):
+        return -(-self.width // CHUNK_SIZE)
+
+    @property
+    def chunks_y(self):
+        return -(-self.height // CHUNK_SIZE)
+
+    def chunks_in(self, x, y, width, height):
+        """Chunk coordinates overlapping a tile rectangle, clamped to the town."""
+        cx0 = max(0, x // CHUNK_SIZE)
+        cy0 = max(0, y // CHUNK_SIZE)
+        cx1 = min(self.chunks_x, -(-(x + width) // CHUNK_SIZE))
+        cy1 = min(self.chunks_y, -(-(y + height) // CHUNK_SIZE))
+        return [(cx, cy) for cy in range(cy0, cy1) for cx in range(cx0, cx1)]
+
+    def chunk_rows(self, cx, cy):
+        x0, y0 = cx * CHUNK_SIZE, cy * CHUNK_SIZE
+        return [row[x0 : x0 + CHUNK_SIZE] for row in self.tiles[y0 : y0 + CHUNK_SIZE]]
+
+    def is_passable(self, x, y):
+        if x < 0 or y < 0 or x >= self.width or y >= self.height:
+            return False
+        index = y * self.width + x
+        return bool(self.passable[index >> 3] & (1 << (index & 7)))
+
+    def component_at(self, x, y):
+        return _component_at(self.components, x, y)
+
+    def reachable(self, x, y):
+        """True if a player can walk from SPAWN to ``(x, y)``."""
+        return self.home_component is not None and self.component_at(x, y) == self.home_component
+
+
+_PASSABLE_BITS = str.maketrans({tile: "1" if tile in PASSABLE_TILES else "0" for tile in "GPBW"})
+
+
+def _pack_passability(tiles, width, height):
+    # Bit i of the bitmap is tile i in row-major order, least significant
+    # bit first: reversing the 0/1 string makes it one little-endian integer.
+    digits = "".join(tiles).translate(_PASSABLE_BITS)
+    return int(digits[::-1] or "0", 2).to_bytes((width * height + 7) // 8, "little")
+
+
+_PASSABLE_RUN = re.compile(f"[{''.join(sorted(PASSABLE_TILES))}]+")
+
+
+def _label_components(tiles):
+    """Label 4-connected passable regions, one ``(starts, ends, labels)`` per row.
+
+    Works on runs of passable tiles rather than single tiles, and a row equal
+    to the one above reuses its runs outright, so the cost follows the number
+    of distinct rows and runs.
+    """
+    parent = []
+
+    def find(label):
+        while parent[label] != label:
+            parent[label] = parent[parent[label]]
+            label = parent[label]
+        return label
+
+    rows = []
+    previous_row, previous = None, ((), (), ())
+    for row in tiles:
+        if row == previous_row:
+            rows.append(previous)
+            continue
+        starts, ends, labels = [], [], []
+        above_starts, above_ends, above_labels = previous
+        cursor = 0
+        for run in _PASSABLE_RUN.finditer(row):
+            start, end = run.span()
+            label = len(parent)
+            parent.append(label)
+            while cursor < len(above_starts) and above_ends[cursor] <= start:
+                cursor += 1
+            scan = cursor
+            while scan < len(above_starts) and above_starts[scan] < end:
+                root, mine = find(above_labels[scan]), find(label)
+                if root != mine:
+                    parent[max(root, mine)] = min(root, mine)
+                scan += 1
+            starts.append(start)
+            ends.append(end)
+            labels.append(label)
+        previous_row, previous = row, (starts, ends, labels)
+        rows.append(previous)
+
+    resolved = {}
+    components = []
+    for starts, ends, labels in rows:
+        key = id(labels)
+        if key not in resolved:
+            resolved[key] = (tuple(starts), tuple(ends), tuple(find(label) for label in labels))
+        components.append(resolved[key])
+    return tuple(components)
+
+
+def _component_at(components, x, y):
+    if y < 0 or y >= len(components):
+        return None
+    starts, ends, labels = components[y]
+    index = bisect_right(starts, x) - 1
+    if index < 0 or x >= ends[index]:
+        return None
+    return labels[index]
+
+
+_RUN = re.compile(r"(\d+)(\D)")
+
+
+def encode_row(row):
+    """Run-length encode a tile row: ``"GGGPG"`` becomes ``"3G1P1G"``."""
+    runs = []
+    start = 0
+    for index in range(1, len(row) + 1):
+        if index == len(row) or row[index] != row[start]:
+            runs.append(f"{index - start}{row[start]}")
+            start = index
+    return "".join(runs)
+
+
+def decode_row(encoded):
+    return "".join(tile * int(count) for count, tile in _RUN.findall(encoded))
+
+
+def _chunk_index(entries, position):
+    index = {}
+    for entry in entries:
+        x, y = position(entry)
+        index.setdefault((x // CHUNK_SIZE, y // CHUNK_SIZE), []).append(entry)
+    return MappingProxyType({key: tuple(values) for key, values in index.items()})
+
+
+def _npc_entries(events):
+    return tuple(
+        {
+            "npc_id": npc["npc_id"],
+            "name_key": npc["name_key"],
+            "pos": {"x": events[f"talk_{npc['npc_id']}"]["x"], "y": events[f"talk_{npc['npc_id']}"]["y"]},
+            "event_ids": [f"talk_{npc['npc_id']}"],
+        }
+        for npc in NPCS
+    )
+
+
+def generator_config():
+    """``(name, width, height)`` of the configured town generator."""
+    config = settings.GAME_TOWN_GENERATOR
+    if config["NAME"] == GENERATOR_CLASSIC:
+        return (GENERATOR_CLASSIC, TOWN_WIDTH, TOWN_HEIGHT)
+    if config["NAME"] == GENERATOR_PROCEDURAL:
+        return (GENERATOR_PROCEDURAL, config["WIDTH"], config["HEIGHT"])
+    raise ValueError(f"unknown town generator {config['NAME']!r}")
+
+
+# The classic map ignores the seed, so every classic town shares this one:
+# one cached layout and one immutable URL for all players.
+CLASSIC_LAYOUT_SEED = 0
+
+
+def layout_seed(seed, config=None):
+    """The seed a town with ``seed`` builds and serves its map under."""
+    if (config or generator_config())[0] == GENERATOR_CLASSIC:
+        return CLASSIC_LAYOUT_SEED
+    return seed
+
+
+def build_layout(seed, generator=GENERATOR_CLASSIC, width=TOWN_WIDTH, height=TOWN_HEIGHT):
+    if generator == GENERATOR_PROCEDURAL:
+        tiles, positions = _procedural_tiles(seed, width, height)
+    else:
+        tiles, positions = tuple(_build_tiles(seed)), {}
+    events = MappingProxyType(
+        {event_id: MappingProxyType(event) for event_id, event in _event_catalog(positions).items()}
+    )
+    npcs = _npc_entries(events)
+    components = _label_components(tiles)
+    return Layout(
+        seed=seed,
+        width=width,
+        height=height,
+        tiles=tiles,
+        passable=_pack_passability(tiles, width, height),
+        events=events,
+        event_ids=tuple(sorted(events)),
+        npcs=npcs,
+        chunk_npcs=_chunk_index(npcs, lambda npc: (npc["pos"]["x"], npc["pos"]["y"])),
+        chunk_events=_chunk_index(sorted(events), lambda event_id: (events[event_id]["x"], events[event_id]["y"])),
+        components=components,
+        home_component=_component_at(components, *SPAWN),
+    )
+
+
+@lru_cache(maxsize=LAYOUT_CACHE_SIZE)
+def _cached_layout(seed, generator, width, height):
+    return build_layout(seed, generator, width, height)
+
+
+def get_layout(seed, config=None):
+    """The shared layout for ``seed`` under ``config``, by default the configured generator."""
+    config = config or generator_config()
+    return _cached_layout(layout_seed(seed, config), *config)
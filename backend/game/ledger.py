@@ -0,0 +1,171 @@
+import json
+import struct
+import threading
+
+from . import db
+
+# Ledger rows store an event result as an interned message-key id plus packed
+# flag and item ids instead of a JSON blob. Names are interned in ledger_keys;
+# ids are never reused or renamed, so the process-wide maps below never go stale.
+#
+# Old rows move to player_event_ledger_archive. The ids of a player's archived
+# events are packed into player_towns.archived_events, which is read with the
+# town row anyway, so the hot table can shrink without losing consumed state.
+
+KIND_MESSAGE = "message"
+KIND_FLAG = "flag"
+KIND_ITEM = "item"
+KIND_EVENT = "event"
+
+LEDGER_COLUMNS = ["message_id", "flag_ids", "item_ids", "result_json"]
+
+_RESULT_KEYS = {"message_key", "flags_added", "items_added"}
+
+_ids = {}
+_names = {}
+_lock = threading.Lock()
+
+
+class LedgerKeysExhausted(RuntimeError):
+    pass
+
+
+def intern(kind, name):
+    key = (kind, name)
+    key_id = _ids.get(key)
+    if key_id is not None:
+        return key_id
+    # Look before inserting: even an ignored INSERT can use up an
+    # AUTO_INCREMENT value, and key_id is only a SMALLINT.
+    row = db.fetch_one("SELECT key_id FROM ledger_keys WHERE kind = %s AND name = %s", [kind, name])
+    if row is None:
+        db.execute("INSERT IGNORE INTO ledger_keys (kind, name) VALUES (%s, %s)", [kind, name])
+        # A locking read sees a row committed by a concurrent interner even
+        # inside an already-open repeatable-read snapshot.
+        row = db.fetch_one(
+            "SELECT key_id FROM ledger_keys WHERE kind = %s AND name = %s LOCK IN SHARE MODE",
+            [kind, name],
+        )
+    if row is None:
+        # The insert was ignored without a matching row: no ids are left.
+        raise LedgerKeysExhausted(f"ledger_keys has no id left for {kind} {name!r}; widen key_id")
+    key_id = int(row[0])
+    # Only cache once durable: if this transaction rolls back, so does every
+    # row that used the id.
+    db.on_commit(lambda: _remember(kind, name, key_id))
+    return key_id
+
+
+def name_for(kind, key_id):
+    name = _names.get((kind, key_id))
+    if name is None:
+        for row_kind, row_name, row_id in db.fetch_all("SELECT kind, name, key_id FROM ledger_keys"):
+            _remember(row_kind, row_name, int(row_id))
+        name = _names.get((kind, key_id))
+        if name is None:
+            raise KeyError(f"unknown {kind} id {key_id}")
+    return name
+
+
+def _remember(kind, name, key_id):
+    with _lock:
+        _ids[(kind, name)] = key_id
+        _names[(kind, key_id)] = name
+
+
+def pack(ids):
+    return struct.pack(f"<{len(ids)}H", *ids)
+
+
+def unpack(raw):
+    if not raw:
+        return ()
+    raw = bytes(raw)
+    return struct.unpack(f"<{len(raw) // 2}H", raw)
+
+
+def encode_result(result):
+    """Return the ledger column values for an event result, in LEDGER_COLUMNS order.
+
+    Results that are not the usual message/flags/items shape are kept as JSON.
+    """
+    if set(result) != _RESULT_KEYS or not isinstance(result["message_key"], str):
+        return (None, None, None, json.dumps(result))
+    return (
+        intern(KIND_MESSAGE, result["message_key"]),
+        pack([intern(KIND_FLAG, flag) for flag in result["flags_added"]]),
+        pack([intern(KIND_ITEM, item_id) for item_id in result["items_added"]]),
+        None,
+    )
+
+
+def decode_result(message_id, flag_ids, item_ids, result_json):
+    if message_id is None:
+        return json.loads(result_json)
+    return {
+        "message_key": name_for(KIND_MESSAGE, int(message_id)),
+        "flags_added": [name_for(KIND_FLAG, key_id) for key_id in unpack(flag_ids)],
+        "items_added": [name_for(KIND_ITEM, key_id) for key_id in unpack(item_ids)],
+    }
+
+
+def archived_event_ids(raw):
+    return {name_for(KIND_EVENT, key_id) for key_id in unpack(raw)}
+
+
+def load_archived(user_id, event_id):
+    row = db.fetch_one(
+        "SELECT message_id, flag_ids, item_ids, result_json FROM player_event_ledger_archive "
+        "WHERE user_id = %s AND event_id = %s",
+        [user_id, event_id],
+    )
+    return decode_result(*row) if row else None
+
+
+def archive_player(user_id, cutoff):
+    """Move one player's ledger rows applied before ``cutoff`` to the archive."""
+    with db.atomic():
+        # Lock the town row first, the same order event writes take.
+        town = db.fetch_one(
+            "SELECT archived_events FROM player_towns WHERE user_id = %s FOR UPDATE",
+            [user_id],
+        )
+        if town is None:
+            return 0
+        event_ids = [
+            row[0]
+            for row in db.fetch_all(
+                "SELECT event_id FROM player_event_ledger WHERE user_id = %s AND applied_at < %s FOR UPDATE",
+                [user_id, cutoff],
+            )
+        ]
+        if not event_ids:
+            return 0
+        archived = sorted(set(unpack(town[0])) | {intern(KIND_EVENT, event_id) for event_id in event_ids})
+        placeholders = ", ".join(["%s"] * len(event_ids))
+        columns = ", ".join(["user_id", "event_id", *LEDGER_COLUMNS, "applied_at"])
+        db.batch(
+            [
+                (
+                    f"INSERT IGNORE INTO player_event_ledger_archive ({columns}) "
+                    f"SELECT {columns} FROM player_event_ledger "
+                    f"WHERE user_id = %s AND event_id IN ({placeholders})",
+                    [user_id, *event_ids],
+                ),
+                (
+                    f"DELETE FROM player_event_ledger WHERE user_id = %s AND event_id IN ({placeholders})",
+                    [user_id, *event_ids],
+                ),
+                ("UPDATE player_towns SET archived_events = %s WHERE user_id = %s", [pack(archived), user_id]),
+            ]
+        )
+    return len(event_ids)
+
+
+def archive_before(cutoff, batch_size=500):
+    """Archive one batch of players with rows older than ``cutoff``; returns rows moved."""
+    users = db.fetch_all(
+        "SELECT DISTINCT user_id FROM player_event_ledger WHERE applied_at < %s ORDER BY user_id LIMIT %s",
+        [cutoff, batch_size],
+    )
+    return sum(archive_player(user_id, cutoff) for (user_id,) in users)
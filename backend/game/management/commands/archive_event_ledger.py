@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from game import db, ledger, schema
+
+
+class Command(BaseCommand):
+    help = "Move old player_event_ledger rows to player_event_ledger_archive."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--older-than-days", type=int, default=30)
+        parser.add_argument("--batch-size", type=int, default=500, help="Players per batch.")
+
+    def handle(self, *args, **options):
+        schema.require_current()
+        # Compare against the database clock that filled applied_at.
+        cutoff = db.fetch_one("SELECT NOW() - INTERVAL %s DAY", [options["older_than_days"]])[0]
+        total = 0
+        while True:
+            moved = ledger.archive_before(cutoff, options["batch_size"])
+            if not moved:
+                break
+            total += moved
+        self.stdout.write(self.style.SUCCESS(f"Archived {total} ledger row(s) applied before {cutoff}."))
@@ -0,0 +1,26 @@
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from game import content, town
+
+
+class Command(BaseCommand):
+    help = "Validate content/ and write hashed, precompressed release bundles."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--out", default=None, help="Output directory (default: GAME_CONTENT_BUILD_DIR).")
+
+    def handle(self, *args, **options):
+        out_dir = Path(options["out"]) if options["out"] else settings.GAME_CONTENT_BUILD_DIR
+        try:
+            manifest = content.build(out_dir, town.message_keys())
+        except content.ContentError as exc:
+            raise CommandError(str(exc)) from exc
+        if content.brotli is None:
+            self.stdout.write(self.style.WARNING("brotli is not installed; only gzip variants were written."))
+        for locale, files in manifest["locales"].items():
+            for name, filename in files.items():
+                self.stdout.write(f"{locale} {name}: {filename}")
+        self.stdout.write(self.style.SUCCESS(f"Content release {manifest['release']} written to {out_dir}."))
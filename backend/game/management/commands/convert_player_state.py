@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+
+from game import db, schema, statedoc
+from game.state import VersionConflict, convert_player
+
+
+class Command(BaseCommand):
+    help = "Convert stored player progress between the row and document layouts."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--to", choices=statedoc.STORAGE_MODES, required=True)
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument("--limit", type=int, default=None, help="Stop after this many players.")
+
+    def handle(self, *args, **options):
+        schema.require_current()
+        target = options["to"]
+        # Players already in the target layout are skipped by the query.
+        condition = "state_doc IS NULL" if target == statedoc.STORAGE_DOCUMENT else "state_doc IS NOT NULL"
+        limit = options["limit"]
+        converted = conflicts = 0
+        last = ""
+        while limit is None or converted + conflicts < limit:
+            rows = db.fetch_all(
+                f"SELECT user_id FROM player_towns WHERE user_id > %s AND {condition} "
+                "ORDER BY user_id LIMIT %s",
+                [last, options["batch_size"]],
+            )
+            if not rows:
+                break
+            for (user_id,) in rows:
+                last = user_id
+                try:
+                    converted += convert_player(user_id, target)
+                except VersionConflict:
+                    # A live write got there first; the player converts
+                    # lazily on their next event instead.
+                    conflicts += 1
+                if limit is not None and converted + conflicts >= limit:
+                    break
+        self.stdout.write(
+            self.style.SUCCESS(f"Converted {converted} player(s) to {target} layout ({conflicts} skipped).")
+        )
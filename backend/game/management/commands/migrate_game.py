@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from game import schema
+
+
+class Command(BaseCommand):
+    help = "Apply pending game schema migrations (run once per deploy)."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--check",
+            action="store_true",
+            help="Exit non-zero if migrations are pending instead of applying them.",
+        )
+
+    def handle(self, *args, **options):
+        if options["check"]:
+            pending = schema.pending_migrations()
+            for step in pending:
+                self.stdout.write(f"Pending {step['version']:04d}_{step['name']}")
+            if pending:
+                raise CommandError(f"{len(pending)} game schema migration(s) pending")
+            self.stdout.write(f"Game schema is current (version {schema.LATEST_VERSION}).")
+            return
+
+        applied = schema.migrate(log=self.stdout.write)
+        if not applied:
+            self.stdout.write("No game schema migrations to apply.")
+            return
+        self.stdout.write(self.style.SUCCESS(f"Game schema now at version {schema.LATEST_VERSION}."))
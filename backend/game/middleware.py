@@ -0,0 +1,56 @@
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from . import db
+
+
+class ServerTimingMiddleware:
+    """Adds a Server-Timing header covering statements issued through game.db.
+
+    ``db`` carries the number of round trips and statements and their summed
+    duration; ``pool`` is this process's connection pool as the response
+    leaves (connections in use, idle, threads waiting, checkouts timed out so
+    far); ``total`` is wall time spent inside the rest of the stack.
+    Works in both sync and async stacks.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        started = time.perf_counter()
+        token = db.start_query_log()
+        try:
+            response = self.get_response(request)
+        finally:
+            entries = db.stop_query_log(token)
+        return self._add_header(response, entries, started)
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        token = db.start_query_log()
+        try:
+            response = await self.get_response(request)
+        finally:
+            entries = db.stop_query_log(token)
+        return self._add_header(response, entries, started)
+
+    def _add_header(self, response, entries, started):
+        total_ms = (time.perf_counter() - started) * 1000
+        db_ms = sum(entry["duration_ms"] for entry in entries)
+        statements = sum(entry["statements"] for entry in entries)
+        in_use, idle, waiters, timeouts = db.pool_usage()
+        response["Server-Timing"] = (
+            f'db;desc="queries={len(entries)} statements={statements}";dur={db_ms:.2f}, '
+            f'pool;desc="in_use={in_use} idle={idle} waiters={waiters} timeouts={timeouts}", '
+            f"total;dur={total_ms:.2f}"
+        )
+        return response
@@ -0,0 +1,214 @@
+import random
+import threading
+import time
+
+# Process-wide database connection pools, one per alias, used by the
+# game.backends.mysql engine. Django still opens and closes "its" connection
+# around every request; with the pool that is a checkout and a return, and
+# the MySQL handshake only happens when the pool grows or recycles.
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class PoolTimeout(TimeoutError):
+    pass
+
+
+def get_pool(alias, factory):
+    """The pool for ``alias``, created by ``factory()`` on first use."""
+    with _pools_lock:
+        pool = _pools.get(alias)
+        if pool is None:
+            pool = _pools[alias] = factory()
+        return pool
+
+
+def stats():
+    with _pools_lock:
+        pools = dict(_pools)
+    return {alias: pool.stats() for alias, pool in pools.items()}
+
+
+class ConnectionPool:
+    """A bounded, thread-safe pool of DB-API connections.
+
+    ``connect()`` opens a connection and ``ping(conn)`` raises if it is dead.
+    At most ``max_size`` connections are open; a checkout beyond that waits up
+    to ``timeout`` seconds. Connections are closed once they are older than
+    ``max_lifetime`` (jittered by up to 10% so a pool filled at startup does
+    not reconnect all at once) or idle longer than ``max_idle``. One idle for
+    at least ``check_after`` seconds is pinged before it is handed out.
+    """
+
+    def __init__(
+        self,
+        connect,
+        *,
+        max_size,
+        timeout=10.0,
+        max_lifetime=None,
+        max_idle=None,
+        check_after=1.0,
+        ping=None,
+        clock=time.monotonic,
+    ):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.max_idle = max_idle
+        self.check_after = check_after
+        self._connect = connect
+        self._ping = ping
+        self._clock = clock
+        self._lock = threading.Condition()
+        # Idle connections as (conn, expires_at, released_at), most recent last.
+        self._idle = []
+        self._expires = {}
+        self._open = 0
+        self._waiters = 0
+        self._counters = dict.fromkeys(
+            ("checkouts", "created", "recycled", "failed_checks", "waits", "timeouts"), 0
+        )
+        self._wait_seconds = 0.0
+        self._max_wait_seconds = 0.0
+
+    def acquire(self):
+        """Return ``(conn, fresh)``; ``fresh`` is True for a new connection."""
+        deadline = self._clock() + self.timeout
+        while True:
+            conn, released_at = self._checkout(deadline)
+            if released_at is None or self._healthy(conn, released_at):
+                with self._lock:
+                    self._counters["checkouts"] += 1
+                return conn, released_at is None
+            with self._lock:
+                self._counters["failed_checks"] += 1
+            self.release(conn, reusable=False)
+
+    def release(self, conn, reusable=True):
+        with self._lock:
+            expires_at = self._expires.pop(id(conn), None)
+            now = self._clock()
+            if reusable and (expires_at is None or now < expires_at):
+                self._idle.append((conn, expires_at, now))
+                self._lock.notify()
+                return
+            self._open -= 1
+            self._counters["recycled"] += 1
+            self._lock.notify()
+        _close(conn)
+
+    def close_idle(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+        for conn, _, _ in idle:
+            _close(conn)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_size": self.max_size,
+                "open": self._open,
+                "in_use": self._open - len(self._idle),
+                "idle": len(self._idle),
+                "waiters": self._waiters,
+                **self._counters,
+                "wait_ms": round(self._wait_seconds * 1000, 3),
+                "max_wait_ms": round(self._max_wait_seconds * 1000, 3),
+            }
+
+    def _checkout(self, deadline):
+        """Return ``(conn, released_at)``; ``released_at`` is None for a new connection."""
+        stale = []
+        started = None
+        try:
+            with self._lock:
+                while True:
+                    now = self._clock()
+                    stale.extend(self._prune(now))
+                    if self._idle:
+                        conn, expires_at, released_at = self._idle.pop()
+                        self._expires[id(conn)] = expires_at
+                        return conn, released_at
+                    if self._open < self.max_size:
+                        self._open += 1
+                        break
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        self._counters["timeouts"] += 1
+                        raise PoolTimeout(
+                            f"no database connection free after {self.timeout}s ({self.max_size} in use)"
+                        )
+                    if started is None:
+                        started = now
+                        self._counters["waits"] += 1
+                    self._waiters += 1
+                    try:
+                        self._lock.wait(remaining)
+                    finally:
+                        self._waiters -= 1
+        finally:
+            if started is not None:
+                self._record_wait(self._clock() - started)
+            for conn in stale:
+                _close(conn)
+
+        # Connect outside the lock; a failure gives the slot back.
+        try:
+            conn = self._connect()
+        except BaseException:
+            with self._lock:
+                self._open -= 1
+                self._lock.notify()
+            raise
+        with self._lock:
+            self._counters["created"] += 1
+            self._expires[id(conn)] = self._expiry()
+        return conn, None
+
+    def _healthy(self, conn, released_at):
+        if self._ping is None or self._clock() - released_at < self.check_after:
+            return True
+        try:
+            self._ping(conn)
+        except Exception:
+            return False
+        return True
+
+    def _expiry(self):
+        if self.max_lifetime is None:
+            return None
+        return self._clock() + self.max_lifetime * random.uniform(0.9, 1.0)
+
+    def _prune(self, now):
+        # The oldest releases sit at the front of the stack.
+        keep = []
+        stale = []
+        for entry in self._idle:
+            conn, expires_at, released_at = entry
+            if (expires_at is not None and now >= expires_at) or (
+                self.max_idle is not None and now - released_at >= self.max_idle
+            ):
+                stale.append(conn)
+            else:
+                keep.append(entry)
+        if stale:
+            self._idle = keep
+            self._open -= len(stale)
+            self._counters["recycled"] += len(stale)
+        return stale
+
+    def _record_wait(self, seconds):
+        with self._lock:
+            self._wait_seconds += seconds
+            self._max_wait_seconds = max(self._max_wait_seconds, seconds)
+
+
+def _close(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
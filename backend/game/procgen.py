@@ -0,0 +1,140 @@
+import random
+
+# Seeded town generator. Roads form a grid with seeded spacing; the strip
+# between two road rows (a band) holds a row of buildings, one per block.
+# Every band is drawn as four full-width row patterns built by slice
+# assignment and shared by all of its rows, so the cost grows with the number
+# of buildings, not the number of tiles.
+
+WALL = "W"
+PATH = "P"
+GRASS = "G"
+ENTRANCE = "B"
+
+# Distance between neighbouring road rows/columns, inclusive.
+ROAD_SPACING = (9, 13)
+MIN_WIDTH = 48
+MIN_HEIGHT = 32
+
+# Out of 256, per block.
+BUILDING_CHANCE = 192
+DECORATION_CHANCE = 80
+MIN_BUILDING_WIDTH = 4
+
+# Tries per placement before the town is declared too small.
+PLACEMENT_ATTEMPTS = 1000
+
+# Towns generated per seed before giving up. A small town can roll too few
+# buildings; the next try uses a sub-seed derived from the seed, so the
+# result is still the same for the same arguments.
+TOWN_ATTEMPTS = 8
+
+
+class GenerationError(ValueError):
+    pass
+
+
+def _roads(rng, size):
+    roads = []
+    position = rng.randint(3, 5)
+    while position < size - 3:
+        roads.append(position)
+        position += rng.randint(*ROAD_SPACING)
+    return roads
+
+
+def _street(width, road_xs):
+    row = bytearray(GRASS * width, "ascii")
+    for x in road_xs:
+        row[x] = ord(PATH)
+    row[0] = row[-1] = ord(WALL)
+    return row
+
+
+def _band(rng, street, road_xs):
+    """Row patterns for one band: (top margin, building, entrance row), plus entrance xs."""
+    top = bytearray(street)
+    body = bytearray(street)
+    entrances = []
+    for left, right in zip(road_xs, road_xs[1:]):
+        # Buildings keep a grass column on both sides of the block.
+        x0 = left + 2
+        span = right - 1 - x0
+        # One draw per block; each decision reads its own byte.
+        roll = rng.getrandbits(48)
+        if roll & 0xFF < DECORATION_CHANCE:
+            top[x0 + (roll >> 8 & 0xFF) % span] = ord(WALL)
+        if roll >> 16 & 0xFF >= BUILDING_CHANCE:
+            continue
+        building_width = MIN_BUILDING_WIDTH + (roll >> 24 & 0xFF) % (span - MIN_BUILDING_WIDTH + 1)
+        bx = x0 + (roll >> 32 & 0xFF) % (span - building_width + 1)
+        body[bx : bx + building_width] = WALL.encode("ascii") * building_width
+        entrances.append(bx + 1 + (roll >> 40) % (building_width - 2))
+    doors = bytearray(body)
+    for x in entrances:
+        doors[x] = ord(ENTRANCE)
+    return top.decode("ascii"), body.decode("ascii"), doors.decode("ascii"), entrances
+
+
+def generate(seed, width, height, building_ids=(), marker_ids=()):
+    """Return ``(rows, positions)`` for a ``width`` x ``height`` town.
+
+    ``building_ids`` are placed on distinct building entrances and
+    ``marker_ids`` (NPCs, signs, chests) on free grass beside a road, so each
+    can be reached from a passable neighbour. ``positions`` maps every id to
+    ``(x, y)``. The same arguments always produce the same town.
+    """
+    if width < MIN_WIDTH or height < MIN_HEIGHT:
+        raise GenerationError(f"procedural towns need at least {MIN_WIDTH}x{MIN_HEIGHT} tiles")
+    for attempt in range(TOWN_ATTEMPTS):
+        rng = random.Random(seed if attempt == 0 else f"{seed}:{attempt}")
+        try:
+            return _generate(rng, seed, width, height, building_ids, marker_ids)
+        except GenerationError:
+            if attempt == TOWN_ATTEMPTS - 1:
+                raise
+
+
+def _generate(rng, seed, width, height, building_ids, marker_ids):
+    road_xs = _roads(rng, width)
+    road_ys = _roads(rng, height)
+    street = _street(width, road_xs)
+    street_row = street.decode("ascii")
+    road_row = WALL + PATH * (width - 2) + WALL
+    wall_row = WALL * width
+
+    rows = [street_row] * height
+    rows[0] = rows[-1] = wall_row
+    for y in road_ys:
+        rows[y] = road_row
+
+    entrances = []
+    margins = []
+    for top_road, bottom_road in zip(road_ys, road_ys[1:]):
+        top, body, doors, xs = _band(rng, street, road_xs)
+        rows[top_road + 1] = top
+        rows[top_road + 2 : bottom_road - 2] = [body] * (bottom_road - top_road - 4)
+        rows[bottom_road - 2] = doors
+        entrances.extend((x, bottom_road - 2) for x in xs)
+        # Markers stand on a margin row; the road next to it is where the
+        # player stands. The tile in front of a door stays clear.
+        margins.append((top_road + 1, frozenset()))
+        margins.append((bottom_road - 1, frozenset(xs)))
+
+    building_ids = list(building_ids)
+    if len(entrances) < len(building_ids) or not margins:
+        raise GenerationError(f"seed {seed} left too few buildings for a {width}x{height} town")
+    positions = dict(zip(building_ids, rng.sample(entrances, len(building_ids))))
+
+    taken = set()
+    for marker_id in marker_ids:
+        for _ in range(PLACEMENT_ATTEMPTS):
+            y, blocked = margins[rng.randrange(len(margins))]
+            x = rng.randrange(1, width - 1)
+            if rows[y][x] == GRASS and x not in blocked and (x, y) not in taken:
+                break
+        else:
+            raise GenerationError(f"no room to place {marker_id} in a {width}x{height} town")
+        taken.add((x, y))
+        positions[marker_id] = (x, y)
+    return tuple(rows), positions
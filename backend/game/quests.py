@@ -0,0 +1,121 @@
+import json
+from collections import namedtuple
+
+# Quest logic is content: content/quests/town_quests.json maps each event_id
+# to an ordered list of rules. The first rule whose preconditions hold fires
+# its effects; a rule without "when" always matches.
+
+_CONDITION_KEYS = {"flags", "flags_absent", "items"}
+_EFFECT_KEYS = {"consume", "grant", "add_flags", "message_key"}
+
+
+class QuestContentError(ValueError):
+    pass
+
+
+class Rule(
+    namedtuple(
+        "Rule",
+        ["flags", "flags_absent", "items", "consume", "grant", "add_flags", "message_key"],
+    )
+):
+    __slots__ = ()
+
+    @property
+    def unconditional(self):
+        return not (self.flags or self.flags_absent or self.items)
+
+    def matches(self, state):
+        return (
+            self.flags <= state.flags
+            and self.flags_absent.isdisjoint(state.flags)
+            and all(state.has_item(item_id, qty) for item_id, qty in self.items)
+        )
+
+    def apply(self, state):
+        for item_id, qty in self.consume:
+            state.consume_item(item_id, qty)
+        for item_id, qty in self.grant:
+            state.grant_item(item_id, qty)
+        for flag in self.add_flags:
+            state.add_flag(flag)
+        return {
+            "message_key": self.message_key,
+            "flags_added": list(self.add_flags),
+            "items_added": [item_id for item_id, _ in self.grant],
+        }
+
+
+def _quantities(where, value, item_ids):
+    if not isinstance(value, dict):
+        raise QuestContentError(f"{where}: expected an object of item quantities")
+    pairs = []
+    for item_id, qty in value.items():
+        if item_ids is not None and item_id not in item_ids:
+            raise QuestContentError(f"{where}: unknown item {item_id!r}")
+        if not isinstance(qty, int) or isinstance(qty, bool) or qty < 1:
+            raise QuestContentError(f"{where}: quantity for {item_id!r} must be a positive integer")
+        pairs.append((item_id, qty))
+    return tuple(pairs)
+
+
+def _flags(where, value):
+    if not isinstance(value, list) or not all(isinstance(flag, str) for flag in value):
+        raise QuestContentError(f"{where}: expected a list of flag names")
+    return value
+
+
+def _compile_rule(where, spec, item_ids):
+    if not isinstance(spec, dict) or set(spec) - {"when", "then"} or "then" not in spec:
+        raise QuestContentError(f"{where}: a rule is an object with an optional 'when' and a 'then'")
+    when = spec.get("when", {})
+    then = spec["then"]
+    unknown = (set(when) - _CONDITION_KEYS) | (set(then) - _EFFECT_KEYS)
+    if unknown:
+        raise QuestContentError(f"{where}: unknown keys {sorted(unknown)}")
+    message_key = then.get("message_key")
+    if not isinstance(message_key, str) or not message_key:
+        raise QuestContentError(f"{where}: every rule needs a message_key")
+    return Rule(
+        flags=frozenset(_flags(f"{where}.when.flags", when.get("flags", []))),
+        flags_absent=frozenset(_flags(f"{where}.when.flags_absent", when.get("flags_absent", []))),
+        items=_quantities(f"{where}.when.items", when.get("items", {}), item_ids),
+        consume=_quantities(f"{where}.then.consume", then.get("consume", {}), item_ids),
+        grant=_quantities(f"{where}.then.grant", then.get("grant", {}), item_ids),
+        add_flags=tuple(_flags(f"{where}.then.add_flags", then.get("add_flags", []))),
+        message_key=message_key,
+    )
+
+
+def compile_rules(document, event_ids=None, item_ids=None):
+    """Build the dispatch table ``{event_id: (Rule, ...)}`` from parsed content.
+
+    Unknown events, items or keys raise QuestContentError, so a bad content
+    file fails at startup instead of on the first player who trips over it.
+    """
+    rules = document.get("rules") if isinstance(document, dict) else None
+    if not isinstance(rules, dict):
+        raise QuestContentError("quest content needs a top-level 'rules' object")
+    table = {}
+    for event_id, specs in rules.items():
+        if event_ids is not None and event_id not in event_ids:
+            raise QuestContentError(f"rules for unknown event {event_id!r}")
+        if not isinstance(specs, list) or not specs:
+            raise QuestContentError(f"{event_id}: expected a non-empty list of rules")
+        table[event_id] = tuple(
+            _compile_rule(f"{event_id}[{index}]", spec, item_ids) for index, spec in enumerate(specs)
+        )
+    return table
+
+
+def load_rules(path, event_ids=None, item_ids=None):
+    with open(path, encoding="utf-8") as handle:
+        return compile_rules(json.load(handle), event_ids, item_ids)
+
+
+def evaluate(table, state, event_id):
+    """Fire the first matching rule for ``event_id``; None if nothing matched."""
+    for rule in table.get(event_id, ()):
+        if rule.matches(state):
+            return rule.apply(state)
+    return None
@@ -0,0 +1,70 @@
+import json
+
+try:
+    import orjson
+except ImportError:  # optional: falls back to the stdlib encoder
+    orjson = None
+
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+# Prerendered values are found at most this many dict levels into a response
+# body ({"snapshot": ...} is one level).
+_SPLICE_DEPTH = 2
+
+
+class PrerenderedDict(dict):
+    """A dict that can produce its own JSON bytes.
+
+    It behaves as a plain dict everywhere else; FastJSONRenderer splices
+    ``render_json(dumps)`` into the response instead of encoding it.
+    Subclasses override it with cached fragments; by default it is encoded
+    like any other dict.
+    """
+
+    def render_json(self, dumps):
+        return dumps(dict(self))
+
+
+_drf_encoder = JSONEncoder()
+
+
+def _default(value):
+    return _drf_encoder.default(value)
+
+
+def dumps(value):
+    if orjson is not None:
+        return orjson.dumps(value, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(value, cls=JSONEncoder, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _encode_key(key):
+    # Encoded exactly as the encoder writes a key, non-string keys included.
+    return dumps({key: 0})[1:-3]
+
+
+def _render(value, depth):
+    # Dicts that may hold prerendered values are assembled key by key, so a
+    # fragment only ever lands where its value was; nothing is searched for.
+    if isinstance(value, PrerenderedDict):
+        return value.render_json(dumps)
+    if depth and type(value) is dict:
+        items = [_encode_key(key) + b":" + _render(item, depth - 1) for key, item in value.items()]
+        return b"{" + b",".join(items) + b"}"
+    return dumps(value)
+
+
+def render(data):
+    return _render(data, _SPLICE_DEPTH)
+
+
+class FastJSONRenderer(JSONRenderer):
+    """Compact JSON via orjson when installed, with prerendered fragments spliced in."""
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        if self.get_indent(accepted_media_type, renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+        return render(data)
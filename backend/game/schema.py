@@ -0,0 +1,265 @@
+from . import db
+
+SCHEMA_LOCK_NAME = "game_schema_migrate"
+SCHEMA_LOCK_TIMEOUT = 30
+
+
+class SchemaOutOfDate(RuntimeError):
+    pass
+
+
+def _m0001_base_tables():
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS user_login (
+            user_id CHAR(36) NOT NULL PRIMARY KEY,
+            name VARCHAR(100) DEFAULT NULL,
+            created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+        """
+    )
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS players (
+            user_id CHAR(36) NOT NULL PRIMARY KEY,
+            points BIGINT NOT NULL DEFAULT 0,
+            updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+        """
+    )
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS player_towns (
+            user_id CHAR(36) NOT NULL PRIMARY KEY,
+            town_id VARCHAR(64) NOT NULL,
+            seed BIGINT NOT NULL,
+            version INT NOT NULL DEFAULT 1,
+            created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+        """
+    )
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS player_event_ledger (
+            user_id CHAR(36) NOT NULL,
+            event_id VARCHAR(100) NOT NULL,
+            result_json LONGTEXT NOT NULL,
+            applied_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY(user_id, event_id)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+        """
+    )
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS player_flags (
+            user_id CHAR(36) NOT NULL,
+            flag VARCHAR(100) NOT NULL,
+            created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY(user_id, flag)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+        """
+    )
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS item_types (
+            item_id VARCHAR(50) NOT NULL PRIMARY KEY,
+            name_key VARCHAR(120) NOT NULL,
+            description_key VARCHAR(120) NOT NULL,
+            tags VARCHAR(120) NOT NULL
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+        """
+    )
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS player_items (
+            user_id CHAR(36) NOT NULL,
+            item_id VARCHAR(50) NOT NULL,
+            qty INT NOT NULL DEFAULT 0,
+            acquired_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+            PRIMARY KEY(user_id, item_id)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+        """
+    )
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS npc_dialog_state (
+            user_id CHAR(36) NOT NULL,
+            npc_id VARCHAR(60) NOT NULL,
+            node_index INT NOT NULL DEFAULT 0,
+            updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+            PRIMARY KEY(user_id, npc_id)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+        """
+    )
+
+
+def _m0002_seed_item_types():
+    # Imported here, not at module level: only this step needs the game
+    # modules, and migrate_game should not load them just to check versions.
+    from .town import ITEM_TYPES
+
+    for item in ITEM_TYPES:
+        db.execute(
+            """
+            INSERT IGNORE INTO item_types (item_id, name_key, description_key, tags)
+            VALUES (%s, %s, %s, %s)
+            """,
+            [item["item_id"], item["name_key"], item["description_key"], item["tags"]],
+        )
+
+
+def _m0003_town_patches():
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS player_town_patches (
+            user_id CHAR(36) NOT NULL,
+            version INT NOT NULL,
+            patch_json TEXT NOT NULL,
+            created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY(user_id, version)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+        """
+    )
+
+
+def _m0004_player_state_doc():
+    # Single-row progress document used by GAME_STATE_STORAGE = "document".
+    db.execute("ALTER TABLE player_towns ADD COLUMN IF NOT EXISTS state_doc TEXT NULL")
+
+
+def _m0005_compact_ledger():
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS ledger_keys (
+            key_id SMALLINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
+            kind VARCHAR(16) NOT NULL,
+            name VARCHAR(190) NOT NULL,
+            UNIQUE KEY kind_name (kind, name)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+        """
+    )
+    # Existing rows keep result_json; new rows use the packed columns.
+    db.execute(
+        """
+        ALTER TABLE player_event_ledger
+            ADD COLUMN IF NOT EXISTS message_id SMALLINT UNSIGNED NULL,
+            ADD COLUMN IF NOT EXISTS flag_ids VARBINARY(255) NULL,
+            ADD COLUMN IF NOT EXISTS item_ids VARBINARY(255) NULL,
+            MODIFY result_json LONGTEXT NULL,
+            ADD KEY IF NOT EXISTS applied_at (applied_at)
+        """
+    )
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS player_event_ledger_archive (
+            user_id CHAR(36) NOT NULL,
+            event_id VARCHAR(100) NOT NULL,
+            message_id SMALLINT UNSIGNED NULL,
+            flag_ids VARBINARY(255) NULL,
+            item_ids VARBINARY(255) NULL,
+            result_json LONGTEXT NULL,
+            applied_at DATETIME NOT NULL,
+            archived_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY(user_id, event_id)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+        """
+    )
+    db.execute("ALTER TABLE player_towns ADD COLUMN IF NOT EXISTS archived_events VARBINARY(1024) NULL")
+
+
+def _m0006_town_seed_index():
+    # The public layout endpoints only serve seeds that belong to a town.
+    db.execute("ALTER TABLE player_towns ADD KEY IF NOT EXISTS seed (seed)")
+
+
+# Ordered, append-only. Never edit a step that has shipped; add a new one.
+# Steps must be safe to re-run: DDL commits implicitly, so a crash before the
+# schema_version insert replays the whole step (MariaDB's IF NOT EXISTS).
+MIGRATIONS = [
+    {"version": 1, "name": "base_tables", "apply": _m0001_base_tables},
+    {"version": 2, "name": "seed_item_types", "apply": _m0002_seed_item_types},
+    {"version": 3, "name": "town_patches", "apply": _m0003_town_patches},
+    {"version": 4, "name": "player_state_doc", "apply": _m0004_player_state_doc},
+    {"version": 5, "name": "compact_ledger", "apply": _m0005_compact_ledger},
+    {"version": 6, "name": "town_seed_index", "apply": _m0006_town_seed_index},
+]
+
+LATEST_VERSION = MIGRATIONS[-1]["version"]
+
+_verified = False
+
+
+def _ensure_version_table():
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INT NOT NULL PRIMARY KEY,
+            name VARCHAR(100) NOT NULL,
+            applied_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+        """
+    )
+
+
+def current_version():
+    row = db.fetch_one(
+        "SELECT COUNT(*) FROM information_schema.tables "
+        "WHERE table_schema = DATABASE() AND table_name = 'schema_version'"
+    )
+    if not row or not int(row[0]):
+        return 0
+    row = db.fetch_one("SELECT MAX(version) FROM schema_version")
+    return int(row[0]) if row and row[0] is not None else 0
+
+
+def pending_migrations():
+    version = current_version()
+    return [step for step in MIGRATIONS if step["version"] > version]
+
+
+def migrate(log=None):
+    """Apply pending migration steps in order and return the ones applied.
+
+    Safe to run from several deploy hosts at once: a named MySQL lock
+    serializes runners, and each step is recorded as soon as it completes.
+    """
+    global _verified
+    row = db.fetch_one("SELECT GET_LOCK(%s, %s)", [SCHEMA_LOCK_NAME, SCHEMA_LOCK_TIMEOUT])
+    if not row or row[0] != 1:
+        raise SchemaOutOfDate("could not acquire schema migration lock")
+    try:
+        _ensure_version_table()
+        applied = []
+        for step in pending_migrations():
+            if log:
+                log(f"Applying {step['version']:04d}_{step['name']}")
+            step["apply"]()
+            db.execute(
+                "INSERT INTO schema_version (version, name) VALUES (%s, %s)",
+                [step["version"], step["name"]],
+            )
+            applied.append(step)
+    finally:
+        db.fetch_one("SELECT RELEASE_LOCK(%s)", [SCHEMA_LOCK_NAME])
+    _verified = True
+    return applied
+
+
+def require_current():
+    """Per-process guard for the request path.
+
+    The first call costs one metadata query; every later call is a flag check.
+    No DDL ever runs here — an outdated schema is a deploy error.
+    """
+    global _verified
+    if _verified:
+        return
+    version = current_version()
+    if version < LATEST_VERSION:
+        raise SchemaOutOfDate(
+            f"database schema is at version {version}, expected {LATEST_VERSION}; "
+            "run `python manage.py migrate_game`"
+        )
+    _verified = True
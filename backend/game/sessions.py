@@ -0,0 +1,85 @@
+import re
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.contrib.sessions.backends import db as db_sessions
+from django.contrib.sessions.backends import signed_cookies
+
+# The session only holds the anonymous player's user_id and a little
+# bookkeeping, so it lives in a signed cookie instead of a row in
+# django_session. Reading it costs a signature check; nothing is written
+# unless the session actually changes.
+
+REFRESHED_AT_KEY = "refreshed_at"
+# Last town version this player wrote; reads must not go back past it.
+TOWN_VERSION_KEY = "town_version"
+
+_LEGACY_KEY = re.compile(r"^[a-z0-9]{32}$")
+
+
+class SessionStore(signed_cookies.SessionStore):
+    """Signed-cookie sessions that adopt cookies issued by the old db engine.
+
+    A cookie that fails the signature check but looks like a db session key
+    is looked up once in django_session; its data is re-issued as a signed
+    cookie on this response and the old row is never read again.
+    """
+
+    def load(self):
+        session_key = self.session_key
+        data = super().load()
+        if data or not session_key or not _LEGACY_KEY.match(session_key):
+            return data
+        return self._adopt(db_sessions.SessionStore(session_key).load())
+
+    async def aload(self):
+        # The signed part is pure; only a legacy key needs the database.
+        session_key = self.session_key
+        data = super().load()
+        if data or not session_key or not _LEGACY_KEY.match(session_key):
+            return data
+        return self._adopt(await db_sessions.SessionStore(session_key).aload())
+
+    def _adopt(self, legacy):
+        if legacy:
+            self.modified = True
+        return legacy
+
+
+class SessionRefreshMiddleware:
+    """Keeps the two-year expiry sliding without a write on every request.
+
+    Replaces SESSION_SAVE_EVERY_REQUEST: an existing player's cookie is
+    re-signed at most once per GAME_SESSION_REFRESH_SECONDS.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        response = self.get_response(request)
+        session = getattr(request, "session", None)
+        if session is not None and session.get("user_id"):
+            self._refresh(session)
+        return response
+
+    async def __acall__(self, request):
+        response = await self.get_response(request)
+        session = getattr(request, "session", None)
+        if session is not None and await session.aget("user_id"):
+            self._refresh(session)
+        return response
+
+    def _refresh(self, session):
+        # Only called once the session is loaded, so nothing here touches the DB.
+        now = int(time.time())
+        if session.modified or now - session.get(REFRESHED_AT_KEY, 0) >= settings.GAME_SESSION_REFRESH_SECONDS:
+            session[REFRESHED_AT_KEY] = now
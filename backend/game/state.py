@@ -0,0 +1,272 @@
+import hashlib
+
+from . import db, ledger, statedoc
+
+
+class VersionConflict(Exception):
+    pass
+
+
+class PlayerState:
+    """Everything an event needs about one player, loaded once.
+
+    Event logic reads and mutates this object in memory; ``flush`` then
+    writes the accumulated changes back in a few batched statements.
+    """
+
+    def __init__(self, user_id, town, flags, items, dialog, ledger, storage=statedoc.STORAGE_ROWS):
+        self.user_id = user_id
+        self.town_id = town["town_id"]
+        self.seed = town["seed"]
+        self.version = town["version"]
+        self.flags = flags
+        self.items = items
+        self.dialog = dialog
+        self.ledger = ledger
+        self.archived_events = town.get("archived_events", frozenset())
+        self.storage = storage
+
+        self._loaded_version = self.version
+        # Set when progress was read from the other layout; the next flush
+        # rewrites all of it in this state's layout.
+        self._convert = False
+        self._new_flags = []
+        self._dirty_items = set()
+        self._dirty_dialog = set()
+        self._new_ledger = []
+        self._bump = False
+
+    @classmethod
+    def load(cls, user_id, storage=None, _reload=True):
+        storage = storage or statedoc.storage_mode()
+        town_sql = (
+            "SELECT town_id, seed, version, state_doc, archived_events FROM player_towns WHERE user_id = %s",
+            [user_id],
+        )
+        ledger_sql = (
+            "SELECT event_id, message_id, flag_ids, item_ids, result_json FROM player_event_ledger "
+            "WHERE user_id = %s",
+            [user_id],
+        )
+        row_sql = [
+            ("SELECT flag FROM player_flags WHERE user_id = %s", [user_id]),
+            ("SELECT item_id, qty FROM player_items WHERE user_id = %s", [user_id]),
+            ("SELECT npc_id, node_index FROM npc_dialog_state WHERE user_id = %s", [user_id]),
+        ]
+        if storage == statedoc.STORAGE_DOCUMENT:
+            town_rows, ledger_rows = db.batch([town_sql, ledger_sql])
+            row_results = None
+        else:
+            town_rows, ledger_rows, *row_results = db.batch([town_sql, ledger_sql, *row_sql])
+
+        if not town_rows:
+            town = _create_town(user_id)
+            if town is None:
+                # Another request created the town first and may already have
+                # committed progress at its version. Load all of it; under
+                # READ COMMITTED (Django's MySQL default) the re-read sees it.
+                if not _reload:
+                    raise VersionConflict(user_id)
+                return cls.load(user_id, storage, _reload=False)
+            flags, items, dialog = set(), {}, {}
+        else:
+            town = _town_from_row(town_rows[0])
+            if town["state_doc"] is not None:
+                flags, items, dialog = statedoc.decode(town["state_doc"])
+            else:
+                # Not converted yet: read the per-row tables, even in document
+                # mode. The first flush then writes the document.
+                flag_rows, item_rows, dialog_rows = row_results or db.batch(row_sql)
+                flags = {row[0] for row in flag_rows}
+                items = {row[0]: int(row[1]) for row in item_rows}
+                dialog = {row[0]: int(row[1]) for row in dialog_rows}
+        state = cls(
+            user_id,
+            town,
+            flags,
+            items,
+            dialog,
+            {row[0]: tuple(row[1:]) for row in ledger_rows},
+            storage,
+        )
+        if town_rows:
+            state._convert = (town["state_doc"] is None) == (storage == statedoc.STORAGE_DOCUMENT)
+        return state
+
+    def has_flag(self, flag):
+        return flag in self.flags
+
+    def add_flag(self, flag):
+        if flag not in self.flags:
+            self.flags.add(flag)
+            self._new_flags.append(flag)
+
+    def item_qty(self, item_id):
+        return self.items.get(item_id, 0)
+
+    def has_item(self, item_id, qty=1):
+        return self.item_qty(item_id) >= qty
+
+    def grant_item(self, item_id, qty=1):
+        self.items[item_id] = self.item_qty(item_id) + qty
+        self._dirty_items.add(item_id)
+
+    def consume_item(self, item_id, qty=1):
+        self.items[item_id] = max(0, self.item_qty(item_id) - qty)
+        self._dirty_items.add(item_id)
+
+    def dialog_index(self, npc_id):
+        return self.dialog.get(npc_id, 0)
+
+    def set_dialog_index(self, npc_id, index):
+        self.dialog[npc_id] = index
+        self._dirty_dialog.add(npc_id)
+
+    def consumed_event_ids(self):
+        return set(self.ledger) | self.archived_events
+
+    def recorded_event(self, event_id):
+        columns = self.ledger.get(event_id)
+        if columns is not None:
+            return ledger.decode_result(*columns)
+        if event_id in self.archived_events:
+            return ledger.load_archived(self.user_id, event_id)
+        return None
+
+    def record_event(self, event_id, result):
+        columns = ledger.encode_result(result)
+        self.ledger[event_id] = columns
+        self._new_ledger.append((event_id, columns))
+
+    def bump_version(self):
+        if not self._bump:
+            self._bump = True
+            self.version += 1
+
+    def flush(self):
+        """Write pending changes; call inside ``db.atomic()``.
+
+        Any write to player_towns is a compare-and-swap against the version
+        this state was loaded at. It runs first, on its own: if it matches no
+        row, VersionConflict is raised before anything else is written, so a
+        losing writer never reaches the ledger's unique key. The remaining
+        statements then go out as one batch.
+        """
+        if self.storage == statedoc.STORAGE_DOCUMENT:
+            statements = self._document_statements()
+        else:
+            statements = self._row_statements()
+        town_write = bool(statements) and statements[0][0].startswith("UPDATE player_towns")
+        if self._new_ledger:
+            statements.append(
+                db.upsert_statement(
+                    "player_event_ledger",
+                    ["user_id", "event_id", *ledger.LEDGER_COLUMNS],
+                    [(self.user_id, event_id, *columns) for event_id, columns in self._new_ledger],
+                )
+            )
+
+        if town_write:
+            sql, params = statements.pop(0)
+            if db.execute(sql, params) != 1:
+                raise VersionConflict(self.user_id)
+        db.batch(statements)
+
+        self._loaded_version = self.version
+        self._convert = False
+        self._new_flags = []
+        self._dirty_items = set()
+        self._dirty_dialog = set()
+        self._new_ledger = []
+        self._bump = False
+
+    def _document_statements(self):
+        if not (self._bump or self._convert or self._new_flags or self._dirty_items or self._dirty_dialog):
+            return []
+        return [
+            (
+                "UPDATE player_towns SET version = %s, state_doc = %s WHERE user_id = %s AND version = %s",
+                [
+                    self.version,
+                    statedoc.encode(self.flags, self.items, self.dialog),
+                    self.user_id,
+                    self._loaded_version,
+                ],
+            )
+        ]
+
+    def _row_statements(self):
+        user_id = self.user_id
+        statements = []
+        if self._bump or self._convert:
+            statements.append(
+                (
+                    "UPDATE player_towns SET version = %s, state_doc = NULL WHERE user_id = %s AND version = %s",
+                    [self.version, user_id, self._loaded_version],
+                )
+            )
+        new_flags = sorted(self.flags) if self._convert else self._new_flags
+        dirty_items = self.items if self._convert else self._dirty_items
+        dirty_dialog = self.dialog if self._convert else self._dirty_dialog
+        if new_flags:
+            statements.append(
+                db.upsert_statement(
+                    "player_flags",
+                    ["user_id", "flag"],
+                    [(user_id, flag) for flag in new_flags],
+                    ignore=True,
+                )
+            )
+        if dirty_items:
+            statements.append(
+                db.upsert_statement(
+                    "player_items",
+                    ["user_id", "item_id", "qty"],
+                    [(user_id, item_id, self.items[item_id]) for item_id in sorted(dirty_items)],
+                    update=["qty"],
+                )
+            )
+        if dirty_dialog:
+            statements.append(
+                db.upsert_statement(
+                    "npc_dialog_state",
+                    ["user_id", "npc_id", "node_index"],
+                    [(user_id, npc_id, self.dialog[npc_id]) for npc_id in sorted(dirty_dialog)],
+                    update=["node_index"],
+                )
+            )
+        return statements
+
+
+def convert_player(user_id, storage):
+    """Rewrite one player's progress in ``storage`` layout; False if already there.
+
+    The version is left unchanged: the player's visible state is the same.
+    """
+    with db.atomic():
+        state = PlayerState.load(user_id, storage)
+        if not state._convert:
+            return False
+        state.flush()
+    return True
+
+
+def _town_from_row(row):
+    town = {"town_id": row[0], "seed": int(row[1]), "version": int(row[2])}
+    if len(row) > 3:
+        town["state_doc"] = row[3]
+        town["archived_events"] = frozenset(ledger.archived_event_ids(row[4]))
+    return town
+
+
+def _create_town(user_id):
+    """Insert a fresh town row; None if another request created one first."""
+    seed = int(hashlib.sha256(user_id.encode("utf-8")).hexdigest()[:12], 16)
+    town_id = f"town-{seed % 1000000:06d}"
+    created = db.execute(
+        "INSERT IGNORE INTO player_towns (user_id, town_id, seed, version) VALUES (%s, %s, %s, 1)",
+        [user_id, town_id, seed],
+    )
+    if not created:
+        return None
+    return {"town_id": town_id, "seed": seed, "version": 1}
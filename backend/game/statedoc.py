@@ -0,0 +1,76 @@
+import json
+from functools import lru_cache
+
+from django.conf import settings
+
+# Compact single-row layout for a player's flags, inventory and dialog
+# indices, stored in player_towns.state_doc next to the version it belongs to.
+# While state_doc is set it is authoritative; when it is NULL the per-row
+# tables (player_flags, player_items, npc_dialog_state) are.
+
+STORAGE_ROWS = "rows"
+STORAGE_DOCUMENT = "document"
+STORAGE_MODES = (STORAGE_ROWS, STORAGE_DOCUMENT)
+
+DOC_FORMAT = 1
+
+# Append-only: a flag's position in this list is its bit in stored documents.
+FLAG_REGISTRY_PATH = "quests/flag_registry.json"
+
+
+def storage_mode():
+    mode = getattr(settings, "GAME_STATE_STORAGE", STORAGE_ROWS)
+    if mode not in STORAGE_MODES:
+        raise ValueError(f"unknown GAME_STATE_STORAGE: {mode}")
+    return mode
+
+
+@lru_cache(maxsize=None)
+def flag_registry():
+    with open(settings.GAME_CONTENT_DIR / FLAG_REGISTRY_PATH, encoding="utf-8") as handle:
+        flags = tuple(json.load(handle)["flags"])
+    if len(set(flags)) != len(flags):
+        raise ValueError("flag registry lists a flag twice")
+    return flags
+
+
+@lru_cache(maxsize=None)
+def _flag_bits():
+    return {flag: bit for bit, flag in enumerate(flag_registry())}
+
+
+def encode(flags, items, dialog):
+    bits = _flag_bits()
+    mask = 0
+    unregistered = []
+    for flag in flags:
+        bit = bits.get(flag)
+        if bit is None:
+            unregistered.append(flag)
+        else:
+            mask |= 1 << bit
+    doc = {"v": DOC_FORMAT, "f": format(mask, "x")}
+    # Flags written before they were registered are kept by name, not dropped.
+    if unregistered:
+        doc["x"] = sorted(unregistered)
+    if items:
+        doc["i"] = {item_id: items[item_id] for item_id in sorted(items)}
+    if dialog:
+        doc["d"] = {npc_id: dialog[npc_id] for npc_id in sorted(dialog)}
+    return json.dumps(doc, separators=(",", ":"))
+
+
+def decode(raw):
+    """Return ``(flags, items, dialog)`` from an encoded document."""
+    doc = json.loads(raw)
+    if doc.get("v") != DOC_FORMAT:
+        raise ValueError(f"unsupported state document format: {doc.get('v')!r}")
+    registry = flag_registry()
+    mask = int(doc["f"], 16)
+    if mask >> len(registry):
+        raise ValueError("state document sets a flag bit missing from the registry")
+    flags = {flag for bit, flag in enumerate(registry) if mask >> bit & 1}
+    flags.update(doc.get("x", ()))
+    items = {item_id: int(qty) for item_id, qty in doc.get("i", {}).items()}
+    dialog = {npc_id: int(index) for npc_id, index in doc.get("d", {}).items()}
+    return flags, items, dialog
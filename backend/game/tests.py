@@ -1,7 +1,25 @@
-from django.test import TestCase, override_settings
+import gzip
+import json
+import shutil
+import tempfile
+import threading
+import time
+from pathlib import Path
+from unittest import mock, skipUnless
+
+from asgiref.sync import async_to_sync, iscoroutinefunction
+from django.conf import settings
+from django.contrib.sessions.backends import db as db_sessions
+from django.core.exceptions import ImproperlyConfigured
+from django.db.utils import ConnectionHandler
+from django.http import HttpResponse
+from django.test import AsyncRequestFactory, RequestFactory, TestCase, TransactionTestCase, override_settings
 from rest_framework.test import APIClient
 
-from . import db, town
+from . import cache, content, db, delta, layout, ledger, pool, procgen, quests, renderers, schema, statedoc, town, views, websocket
+from .middleware import ServerTimingMiddleware
+from .sessions import SessionStore
+from .state import PlayerState, VersionConflict, convert_player
 
 
 NO_CSRF = {
@@ -20,7 +38,7 @@ class UserEndpointTests(TestCase):
     @classmethod
     def setUpClass(cls):
         super().setUpClass()
-        town.ensure_schema()
+        schema.migrate()
 
     def setUp(self):
         self.client = APIClient()
@@ -37,6 +55,32 @@ class UserEndpointTests(TestCase):
         self.assertEqual(res1.data['user_id'], res2.data['user_id'])
         self.assertEqual(res2.status_code, 200)
 
+    def test_session_not_reissued_within_refresh_interval(self):
+        self.client.get('/api/user/me/')
+        res = self.client.get('/api/user/me/')
+        self.assertNotIn(settings.SESSION_COOKIE_NAME, res.cookies)
+        count = db.fetch_one("SELECT COUNT(*) FROM django_session")[0]
+        self.assertEqual(count, 0)
+
+    @override_settings(GAME_SESSION_REFRESH_SECONDS=0)
+    def test_session_reissued_after_refresh_interval(self):
+        self.client.get('/api/user/me/')
+        res = self.client.get('/api/user/me/')
+        self.assertIn(settings.SESSION_COOKIE_NAME, res.cookies)
+
+    def test_legacy_db_session_is_adopted(self):
+        user_id = self.client.get('/api/user/me/').data['user_id']
+        legacy = db_sessions.SessionStore()
+        legacy['user_id'] = user_id
+        legacy.create()
+
+        client = APIClient()
+        client.cookies[settings.SESSION_COOKIE_NAME] = legacy.session_key
+        res = client.get('/api/user/me/')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.data['user_id'], user_id)
+        self.assertNotEqual(res.cookies[settings.SESSION_COOKIE_NAME].value, legacy.session_key)
+
 
 @override_settings(
     REST_FRAMEWORK=NO_CSRF,
@@ -47,7 +91,7 @@ class TownEndpointTests(TestCase):
     @classmethod
     def setUpClass(cls):
         super().setUpClass()
-        town.ensure_schema()
+        schema.migrate()
 
     def setUp(self):
         self.client = APIClient()
@@ -64,6 +108,58 @@ class TownEndpointTests(TestCase):
         self.assertIn('version', res.data)
         self.assertIn('allowed_event_ids', res.data)
         self.assertEqual(len(res.data['tiles']), 20)
+        self.assertEqual(json.loads(res.content)['tiles'], list(res.data['tiles']))
+
+    def test_state_endpoint_references_layout(self):
+        full = self.client.get('/api/town/').data
+        res = self.client.get('/api/town/state/')
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('tiles', res.data)
+        self.assertEqual(res.data['version'], full['version'])
+        self.assertEqual(res.data['allowed_event_ids'], full['allowed_event_ids'])
+        layout_res = self.client.get(f"/api/{res.data['layout_path']}")
+        self.assertEqual(layout_res.status_code, 200)
+        self.assertIn('immutable', layout_res['Cache-Control'])
+        self.assertEqual(json.loads(layout_res.content)['tiles'], list(full['tiles']))
+
+    @override_settings(GAME_TOWN_GENERATOR={'NAME': 'procedural', 'WIDTH': 64, 'HEIGHT': 48})
+    def test_procedural_layout_only_for_town_seeds(self):
+        res = self.client.get('/api/town/state/')
+        self.assertEqual(self.client.get(f"/api/{res.data['layout_path']}").status_code, 200)
+        self.assertEqual(self.client.get(f"/api/town/layout/{res.data['seed'] + 1}/").status_code, 404)
+
+    def test_get_town_conditional_etag(self):
+        first = self.client.get('/api/town/')
+        etag = first['ETag']
+        self.assertTrue(etag)
+        cached = self.client.get('/api/town/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(cached.status_code, 304)
+
+    def test_etag_changes_with_version(self):
+        first = self.client.get('/api/town/')
+        self.client.post(
+            '/api/town/event/',
+            {
+                'event_id': 'read_sign_gate',
+                'version': first.data['version'],
+                'payload': {
+                    'player_position': {'x': 2, 'y': 2},
+                    'target_position': {'x': 3, 'y': 2},
+                },
+            },
+            format='json',
+        )
+        second = self.client.get('/api/town/', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(second.status_code, 200)
+        self.assertNotEqual(second['ETag'], first['ETag'])
+
+    def test_server_timing_header(self):
+        res = self.client.get('/api/town/')
+        self.assertRegex(
+            res['Server-Timing'],
+            r'^db;desc="queries=\d+ statements=\d+";dur=[\d.]+, '
+            r'pool;desc="in_use=\d+ idle=\d+ waiters=\d+ timeouts=\d+", total;dur=[\d.]+$',
+        )
 
     def test_event_requires_session(self):
         fresh = APIClient()
@@ -148,6 +244,63 @@ class TownEndpointTests(TestCase):
         self.assertEqual(stale.status_code, 409)
         self.assertEqual(stale.data['error_code'], 'stale_client')
 
+    def test_delta_mode_returns_patch(self):
+        snapshot = self.client.get('/api/town/').data
+        res = self.client.post(
+            '/api/town/event/',
+            {
+                'event_id': 'open_chest_herb',
+                'version': snapshot['version'],
+                'delta': True,
+                'payload': {
+                    'player_position': {'x': 26, 'y': 3},
+                    'target_position': {'x': 27, 'y': 3},
+                },
+            },
+            format='json',
+        )
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('snapshot', res.data)
+        patch = res.data['patch']
+        self.assertEqual(patch['from_version'], snapshot['version'])
+        self.assertEqual(patch['to_version'], snapshot['version'] + 1)
+        self.assertEqual(patch['flags_added'], ['herb_collected'])
+        self.assertEqual(patch['events_consumed'], ['open_chest_herb'])
+        self.assertEqual(patch['allowed_removed'], ['open_chest_herb'])
+        self.assertEqual([item['item_id'] for item in patch['items_changed']], ['herb_bundle'])
+
+    def test_stale_delta_client_gets_merged_patch(self):
+        snapshot = self.client.get('/api/town/').data
+        self.client.post(
+            '/api/town/event/',
+            {
+                'event_id': 'talk_npc_borin',
+                'version': snapshot['version'],
+                'payload': {
+                    'player_position': {'x': 10, 'y': 5},
+                    'target_position': {'x': 10, 'y': 4},
+                },
+            },
+            format='json',
+        )
+        stale = self.client.post(
+            '/api/town/event/',
+            {
+                'event_id': 'read_sign_gate',
+                'version': snapshot['version'],
+                'delta': True,
+                'payload': {
+                    'player_position': {'x': 2, 'y': 2},
+                    'target_position': {'x': 3, 'y': 2},
+                },
+            },
+            format='json',
+        )
+        self.assertEqual(stale.status_code, 409)
+        self.assertNotIn('snapshot', stale.data)
+        self.assertEqual(stale.data['patch']['from_version'], snapshot['version'])
+        self.assertEqual(stale.data['patch']['flags_added'], ['iron_key_given'])
+
     def test_fetch_quest_flow_items_and_flags(self):
         start = self.client.get('/api/town/').data
 
@@ -202,13 +355,69 @@ class TownEndpointTests(TestCase):
         item_ids = {item['item_id'] for item in final_snapshot['player_state']['items'] if item['qty'] > 0}
         self.assertIn('moon_badge', item_ids)
 
+    def test_batch_applies_events_in_order_with_one_version(self):
+        start = self.client.get('/api/town/').data
+        lyra = {'player_position': {'x': 6, 'y': 2}, 'target_position': {'x': 6, 'y': 3}}
+        chest = {'player_position': {'x': 26, 'y': 3}, 'target_position': {'x': 27, 'y': 3}}
+        res = self.client.post(
+            '/api/town/events/',
+            {
+                'version': start['version'],
+                'events': [
+                    {'event_id': 'talk_npc_lyra', 'payload': lyra},
+                    {'event_id': 'open_chest_herb', 'payload': chest},
+                    {'event_id': 'talk_npc_lyra', 'payload': lyra},
+                ],
+            },
+            format='json',
+        )
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.data['applied'], 3)
+        self.assertEqual(
+            [result['event_result']['message_key'] for result in res.data['results']],
+            ['event.lyra.quest_start', 'event.chest_herb_opened', 'event.lyra.quest_complete'],
+        )
+        self.assertEqual(res.data['snapshot']['version'], start['version'] + 1)
+        self.assertIn('herb_turned_in', res.data['snapshot']['player_state']['flags'])
+
+    def test_batch_stops_at_first_rejection(self):
+        start = self.client.get('/api/town/').data
+        res = self.client.post(
+            '/api/town/events/',
+            {
+                'version': start['version'],
+                'delta': True,
+                'events': [
+                    {
+                        'event_id': 'talk_npc_borin',
+                        'payload': {'player_position': {'x': 10, 'y': 5}, 'target_position': {'x': 10, 'y': 4}},
+                    },
+                    {
+                        'event_id': 'read_sign_gate',
+                        'payload': {'player_position': {'x': 20, 'y': 10}, 'target_position': {'x': 3, 'y': 2}},
+                    },
+                    {
+                        'event_id': 'open_chest_herb',
+                        'payload': {'player_position': {'x': 26, 'y': 3}, 'target_position': {'x': 27, 'y': 3}},
+                    },
+                ],
+            },
+            format='json',
+        )
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.data['applied'], 1)
+        self.assertEqual(res.data['results'][1]['error_code'], 'invalid_position')
+        self.assertEqual(len(res.data['results']), 2)
+        self.assertEqual(res.data['patch']['flags_added'], ['iron_key_given'])
+        self.assertEqual(self.client.get('/api/town/').data['version'], start['version'] + 1)
+
 
 @override_settings(SESSION_COOKIE_SECURE=False, CSRF_COOKIE_SECURE=False)
 class CsrfTests(TestCase):
     @classmethod
     def setUpClass(cls):
         super().setUpClass()
-        town.ensure_schema()
+        schema.migrate()
 
     def setUp(self):
         self.client = APIClient(enforce_csrf_checks=True)
@@ -243,7 +452,7 @@ class DbRulesTests(TestCase):
     @classmethod
     def setUpClass(cls):
         super().setUpClass()
-        town.ensure_schema()
+        schema.migrate()
 
     def setUp(self):
         self.client = APIClient()
@@ -258,3 +467,992 @@ class DbRulesTests(TestCase):
         user_id = self.client.session['user_id']
         count = db.fetch_one('SELECT COUNT(*) FROM player_towns WHERE user_id = %s', [user_id])[0]
         self.assertEqual(count, 1)
+
+
+class DbBatchTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        schema.migrate()
+
+    def test_batch_returns_result_per_statement(self):
+        results = db.batch(
+            [
+                ("INSERT INTO player_flags (user_id, flag) VALUES (%s, %s)", ['batch-user', 'a']),
+                ("SELECT flag FROM player_flags WHERE user_id = %s", ['batch-user']),
+                ("SELECT flag FROM player_flags WHERE user_id = %s", ['nobody']),
+            ]
+        )
+        self.assertEqual(results, [1, [('a',)], []])
+
+    def test_upsert_many_overwrites_on_duplicate(self):
+        rows = [('batch-user', 'herb_bundle', 1), ('batch-user', 'iron_key', 1)]
+        db.upsert_many('player_items', ['user_id', 'item_id', 'qty'], rows, update=['qty'])
+        db.upsert_many('player_items', ['user_id', 'item_id', 'qty'], [('batch-user', 'herb_bundle', 4)], update=['qty'])
+        qty = db.fetch_all(
+            "SELECT item_id, qty FROM player_items WHERE user_id = %s ORDER BY item_id",
+            ['batch-user'],
+        )
+        self.assertEqual(list(qty), [('herb_bundle', 4), ('iron_key', 1)])
+
+    def test_fingerprint_collapses_literals_and_row_lists(self):
+        self.assertEqual(
+            db.fingerprint("INSERT INTO t (a, b) VALUES (%s, %s), (%s, %s)  ON DUPLICATE KEY UPDATE b = 'x'"),
+            "INSERT INTO t (a, b) VALUES (...) ON DUPLICATE KEY UPDATE b = ?",
+        )
+
+    def test_query_log_records_statements(self):
+        token = db.start_query_log()
+        try:
+            db.fetch_one("SELECT 1")
+        finally:
+            entries = db.stop_query_log(token)
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0]['fingerprint'], 'SELECT ?')
+        self.assertEqual(entries[0]['rows'], 1)
+        self.assertEqual(entries[0]['alias'], 'default')
+        self.assertIn('game.tests.', entries[0]['caller'])
+
+    def test_upsert_rejects_bad_identifiers(self):
+        with self.assertRaises(ValueError):
+            db.upsert_statement('player_items; DROP TABLE x', ['user_id'], [('u',)])
+
+    def test_arun_uses_db_thread_and_query_log(self):
+        def work():
+            db.fetch_one("SELECT 1")
+            return threading.current_thread().name
+
+        token = db.start_query_log()
+        try:
+            name = async_to_sync(db.arun)(work)
+        finally:
+            entries = db.stop_query_log(token)
+        self.assertTrue(name.startswith('game-db'))
+        self.assertEqual([entry['fingerprint'] for entry in entries], ['SELECT ?'])
+
+    def test_server_timing_middleware_is_async_capable(self):
+        async def handler(request):
+            return HttpResponse()
+
+        middleware = ServerTimingMiddleware(handler)
+        self.assertTrue(iscoroutinefunction(middleware))
+        response = async_to_sync(middleware)(RequestFactory().get('/'))
+        self.assertIn('total;dur=', response['Server-Timing'])
+
+
+@override_settings(SESSION_COOKIE_SECURE=False, CSRF_COOKIE_SECURE=False)
+class AsyncViewTests(TransactionTestCase):
+    # DB work happens on game.db threads with their own connections, so the
+    # test cannot wrap it in a transaction, and town reads reach any replicas.
+    databases = {'default', *settings.GAME_DB_REPLICAS}
+
+    def setUp(self):
+        schema.migrate()
+        self.factory = AsyncRequestFactory()
+        self.session = SessionStore()
+
+    def _call(self, view, request):
+        request.session = self.session
+        request._dont_enforce_csrf_checks = True
+        return async_to_sync(view)(request)
+
+    def test_async_town_flow(self):
+        res = self._call(views.aget_or_create_user, self.factory.get('/api/user/me/'))
+        self.assertEqual(res.status_code, 201)
+
+        state = self._call(views.aget_town_state, self.factory.get('/api/town/state/'))
+        self.assertEqual(state.status_code, 200)
+        cached = self._call(
+            views.aget_town_state,
+            self.factory.get('/api/town/state/', headers={'If-None-Match': state['ETag']}),
+        )
+        self.assertEqual(cached.status_code, 304)
+
+        body = {
+            'event_id': 'open_chest_herb',
+            'version': json.loads(state.content)['version'],
+            'payload': {'player_position': {'x': 26, 'y': 3}, 'target_position': {'x': 27, 'y': 3}},
+        }
+        res = self._call(
+            views.atrigger_town_event,
+            self.factory.post('/api/town/event/', body, content_type='application/json'),
+        )
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.content)['event_result']['message_key'], 'event.chest_herb_opened')
+
+
+class TownSocketTests(TransactionTestCase):
+    databases = {'default', *settings.GAME_DB_REPLICAS}
+    ORIGIN = {'host': 'localhost:8000', 'origin': 'http://localhost:8000'}
+
+    def setUp(self):
+        schema.migrate()
+        self.session = SessionStore()
+        town.get_or_create_user(self.session)
+        self.session.save()
+
+    def _connect(self, messages, headers=None, path='/api/town/ws/'):
+        headers = {'cookie': f'{settings.SESSION_COOKIE_NAME}={self.session.session_key}', **self.ORIGIN, **(headers or {})}
+        scope = {
+            'type': 'websocket',
+            'path': path,
+            'headers': [(name.encode(), value.encode()) for name, value in headers.items()],
+        }
+        inbox = [{'type': 'websocket.connect'}]
+        inbox += [{'type': 'websocket.receive', 'text': json.dumps(message)} for message in messages]
+        inbox.append({'type': 'websocket.disconnect', 'code': 1000})
+        sent = []
+
+        async def receive():
+            return inbox.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        async_to_sync(websocket.town_socket)(scope, receive, send)
+        return sent
+
+    def test_events_reply_with_patches_from_the_last_version(self):
+        chest = {
+            'event_id': 'open_chest_herb',
+            'payload': {'player_position': {'x': 26, 'y': 3}, 'target_position': {'x': 27, 'y': 3}},
+        }
+        sent = self._connect([{'id': 1, **chest}, {'id': 2, **chest}])
+        self.assertEqual(sent[0], {'type': 'websocket.accept'})
+        first, second = (json.loads(message['text']) for message in sent[1:])
+        self.assertEqual((first['id'], first['status']), (1, 200))
+        self.assertEqual(first['event_result']['message_key'], 'event.chest_herb_opened')
+        # The first reply carries a snapshot; later ones patch from it.
+        self.assertTrue(second['idempotent'])
+        self.assertEqual(second['patch']['from_version'], first['snapshot']['version'])
+
+    def test_handshake_refused_without_session_or_from_other_origin(self):
+        self.assertEqual(self._connect([], {'cookie': ''}), [{'type': 'websocket.close'}])
+        self.assertEqual(self._connect([], {'origin': 'https://evil.example'}), [{'type': 'websocket.close'}])
+        self.assertEqual(self._connect([], path='/api/town/'), [{'type': 'websocket.close'}])
+
+    def test_invalid_json_is_answered(self):
+        sent = self._connect([['not', 'an', 'object']])
+        self.assertEqual(json.loads(sent[1]['text']), {'status': 400, 'error_code': 'invalid_json'})
+
+
+class FakeConnection:
+    def __init__(self):
+        self.alive = True
+        self.closed = False
+
+    def ping(self):
+        if not self.alive:
+            raise OSError("gone away")
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPoolTests(TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.opened = []
+
+    def _connect(self):
+        self.opened.append(FakeConnection())
+        return self.opened[-1]
+
+    def _pool(self, **options):
+        options = {'max_size': 2, 'ping': FakeConnection.ping, 'clock': lambda: self.now, **options}
+        return pool.ConnectionPool(self._connect, **options)
+
+    def test_released_connection_is_reused_without_reconnecting(self):
+        connections = self._pool()
+        conn, fresh = connections.acquire()
+        self.assertTrue(fresh)
+        connections.release(conn)
+        self.assertEqual(connections.acquire(), (conn, False))
+        self.assertEqual(len(self.opened), 1)
+        self.assertEqual(connections.stats()['in_use'], 1)
+
+    def test_full_pool_times_out_and_counts_the_wait(self):
+        connections = self._pool(max_size=1, timeout=0, clock=time.monotonic)
+        connections.acquire()
+        with self.assertRaises(pool.PoolTimeout):
+            connections.acquire()
+        self.assertEqual(connections.stats()['timeouts'], 1)
+
+    def test_waiter_gets_the_released_connection(self):
+        connections = self._pool(max_size=1, timeout=5, clock=time.monotonic)
+        conn, _ = connections.acquire()
+        got = []
+        waiter = threading.Thread(target=lambda: got.append(connections.acquire()))
+        waiter.start()
+        while connections.stats()['waiters'] == 0:
+            time.sleep(0.001)
+        connections.release(conn)
+        waiter.join()
+        self.assertEqual(got, [(conn, False)])
+        self.assertEqual(connections.stats()['waits'], 1)
+
+    def test_expired_idle_and_dead_connections_are_replaced(self):
+        connections = self._pool(max_lifetime=100, max_idle=10, check_after=1)
+        old, _ = connections.acquire()
+        connections.release(old)
+        self.now = 20
+        self.assertTrue(connections.acquire()[1])
+        self.assertTrue(old.closed)
+
+        dead = self.opened[-1]
+        connections.release(dead)
+        dead.alive = False
+        self.now = 22
+        conn, fresh = connections.acquire()
+        self.assertIsNot(conn, dead)
+        self.assertTrue(fresh and dead.closed)
+        self.assertEqual(connections.stats()['failed_checks'], 1)
+
+    def test_unusable_release_frees_the_slot(self):
+        connections = self._pool(max_size=1)
+        conn, _ = connections.acquire()
+        connections.release(conn, reusable=False)
+        self.assertTrue(conn.closed)
+        self.assertEqual(connections.stats()['open'], 0)
+        self.assertTrue(connections.acquire()[1])
+
+    def test_multi_statements_is_opt_in(self):
+        from MySQLdb.constants import CLIENT
+
+        from .backends.mysql.base import DatabaseWrapper
+
+        def client_flag(options):
+            config = ConnectionHandler({'default': {'ENGINE': 'game.backends.mysql', 'NAME': 'game', 'OPTIONS': options}})
+            return DatabaseWrapper(config.settings['default'], 'default').get_connection_params()['client_flag']
+
+        self.assertFalse(client_flag({}) & CLIENT.MULTI_STATEMENTS)
+        self.assertTrue(client_flag({'multi_statements': True}) & CLIENT.MULTI_STATEMENTS)
+        self.assertTrue(client_flag({'multi_statements': True}) & CLIENT.FOUND_ROWS)
+
+    def test_async_workers_may_not_outnumber_pooled_connections(self):
+        with mock.patch.dict(settings.DATABASES['default'], {'OPTIONS': {'pool': {'max_size': 4}}}):
+            with self.settings(GAME_DB_ASYNC_WORKERS=4):
+                db._check_async_workers()
+            with self.settings(GAME_DB_ASYNC_WORKERS=5), self.assertRaises(ImproperlyConfigured):
+                db._check_async_workers()
+
+
+@override_settings(GAME_DB_REPLICAS=['replica'])
+class ReplicaRoutingTests(TransactionTestCase):
+    def test_reads_go_to_replica_until_a_write(self):
+        self.assertEqual(db._alias_for(['SELECT 1']), 'default')
+        with db.read_replica() as alias:
+            self.assertEqual(alias, 'replica')
+            self.assertEqual(db._alias_for(['SELECT 1', ' select 2']), 'replica')
+            self.assertEqual(db._alias_for(['SELECT 1 FOR UPDATE']), 'default')
+            self.assertEqual(db._alias_for(['SELECT GET_LOCK(%s, %s)']), 'default')
+            self.assertEqual(db._alias_for(['SELECT 1', 'UPDATE players SET points = 0']), 'default')
+            self.assertEqual(db._alias_for(['SELECT 1']), 'default')
+        with db.read_replica():
+            with db.atomic():
+                self.assertEqual(db._alias_for(['SELECT 1']), 'default')
+            self.assertEqual(db._alias_for(['SELECT 1']), 'replica')
+
+    @override_settings(GAME_DB_REPLICAS=[])
+    def test_without_replicas_everything_reads_the_primary(self):
+        with db.read_replica() as alias:
+            self.assertIsNone(alias)
+            self.assertEqual(db._alias_for(['SELECT 1']), 'default')
+
+
+@skipUnless('replica1' in settings.DATABASES, 'run with DB_REPLICA_HOSTS=localhost for a second alias')
+@override_settings(
+    GAME_DB_REPLICAS=['replica1'],
+    REST_FRAMEWORK=NO_CSRF,
+    SESSION_COOKIE_SECURE=False,
+    CSRF_COOKIE_SECURE=False,
+)
+class ReplicaReadTests(TransactionTestCase):
+    # replica1 mirrors the test database on its own connection, so it only
+    # sees committed rows: no test transaction here.
+    databases = {'default', *settings.GAME_DB_REPLICAS}
+
+    def setUp(self):
+        schema.migrate()
+        self.client = APIClient()
+        self.client.get('/api/user/me/')
+        self.client.get('/api/town/state/')
+        self.user_id = self.client.session['user_id']
+
+    def _aliases(self, func, *args):
+        token = db.start_query_log()
+        try:
+            result = func(*args)
+        finally:
+            entries = db.stop_query_log(token)
+        return result, [entry['alias'] for entry in entries]
+
+    def test_town_reads_use_the_replica(self):
+        version, aliases = self._aliases(town.get_town_version, self.user_id)
+        self.assertEqual(aliases, ['replica1'])
+        snapshot, aliases = self._aliases(town.get_town_snapshot, self.user_id)
+        self.assertEqual(snapshot['version'], version)
+        self.assertEqual(set(aliases), {'replica1'})
+
+    def test_writes_and_locking_reads_use_the_primary(self):
+        def work():
+            with db.read_replica():
+                db.fetch_one("SELECT version FROM player_towns WHERE user_id = %s", [self.user_id])
+                db.fetch_one("SELECT version FROM player_towns WHERE user_id = %s FOR UPDATE", [self.user_id])
+                db.execute("UPDATE players SET points = points WHERE user_id = %s", [self.user_id])
+                db.fetch_one("SELECT version FROM player_towns WHERE user_id = %s", [self.user_id])
+
+        _, aliases = self._aliases(work)
+        self.assertEqual(aliases, ['replica1', 'default', 'default', 'default'])
+
+    def test_replica_behind_written_version_is_repeated_on_primary(self):
+        version = town.get_town_snapshot(self.user_id)['version']
+        cache.reset_backend()
+        snapshot, aliases = self._aliases(town.get_town_snapshot, self.user_id, version + 1)
+        self.assertEqual(snapshot['version'], version)
+        self.assertEqual(aliases[0], 'replica1')
+        self.assertIn('default', aliases)
+
+
+class SchemaTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        schema.migrate()
+
+    def test_migrate_is_idempotent(self):
+        self.assertEqual(schema.migrate(), [])
+        self.assertEqual(schema.current_version(), schema.LATEST_VERSION)
+
+    def test_no_pending_after_migrate(self):
+        self.assertEqual(schema.pending_migrations(), [])
+
+    def test_require_current_passes(self):
+        schema._verified = False
+        schema.require_current()
+        self.assertTrue(schema._verified)
+
+    def test_migration_versions_ordered(self):
+        versions = [step["version"] for step in schema.MIGRATIONS]
+        self.assertEqual(versions, sorted(set(versions)))
+
+
+class LayoutTests(TestCase):
+    def test_layout_cached_per_seed(self):
+        self.assertIs(layout.get_layout(42), layout.get_layout(42))
+
+    def test_passability_bitmap_matches_tiles(self):
+        town_layout = layout.get_layout(42)
+        for y, row in enumerate(town_layout.tiles):
+            for x, tile in enumerate(row):
+                self.assertEqual(town_layout.is_passable(x, y), tile in layout.PASSABLE_TILES)
+        self.assertFalse(town_layout.is_passable(-1, 0))
+        self.assertFalse(town_layout.is_passable(town_layout.width, 0))
+
+    def test_chunk_rows_round_trip(self):
+        town_layout = layout.get_layout(42)
+        self.assertEqual(layout.encode_row("GGGPG"), "3G1P1G")
+        rebuilt = [""] * town_layout.height
+        for cx, cy in town_layout.chunks_in(0, 0, town_layout.width, town_layout.height):
+            for offset, row in enumerate(town_layout.chunk_rows(cx, cy)):
+                rebuilt[cy * layout.CHUNK_SIZE + offset] += layout.decode_row(layout.encode_row(row))
+        self.assertEqual(tuple(rebuilt), town_layout.tiles)
+
+    def test_procedural_town_is_seeded(self):
+        first = layout.build_layout(7, layout.GENERATOR_PROCEDURAL, 96, 64)
+        self.assertEqual(first.tiles, layout.build_layout(7, layout.GENERATOR_PROCEDURAL, 96, 64).tiles)
+        self.assertNotEqual(first.tiles, layout.build_layout(8, layout.GENERATOR_PROCEDURAL, 96, 64).tiles)
+        self.assertEqual([len(row) for row in first.tiles], [96] * 64)
+        for y, row in enumerate(first.tiles):
+            for x, tile in enumerate(row):
+                self.assertEqual(first.is_passable(x, y), tile in layout.PASSABLE_TILES)
+
+    def test_procedural_placement_is_reachable(self):
+        town_layout = layout.build_layout(99, layout.GENERATOR_PROCEDURAL, 64, 48)
+        positions = set()
+        for event in town_layout.events.values():
+            x, y = event["x"], event["y"]
+            positions.add((x, y))
+            expected = "B" if event["type"] == "enter_building" else "G"
+            self.assertEqual(town_layout.tiles[y][x], expected, event["event_id"])
+            neighbours = [(x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1)]
+            self.assertTrue(any(town_layout.is_passable(*cell) and cell not in positions for cell in neighbours))
+        self.assertEqual(len(positions), len(town_layout.events))
+        self.assertEqual(town_layout.npcs[0]["pos"], {"x": town_layout.events["talk_npc_lyra"]["x"], "y": town_layout.events["talk_npc_lyra"]["y"]})
+
+    def test_procedural_towns_generate_at_the_minimum_size(self):
+        for seed in range(500):
+            town_layout = layout.build_layout(seed, layout.GENERATOR_PROCEDURAL, procgen.MIN_WIDTH, procgen.MIN_HEIGHT)
+            self.assertEqual(len(town_layout.events), len(layout.INTERACTABLE_EVENTS) + len(layout.NPCS), seed)
+
+    def test_procedural_town_has_a_minimum_size(self):
+        with self.assertRaises(procgen.GenerationError):
+            layout.build_layout(1, layout.GENERATOR_PROCEDURAL, 32, 20)
+
+    def test_event_catalog_is_read_only(self):
+        town_layout = layout.get_layout(42)
+        with self.assertRaises(TypeError):
+            town_layout.events["talk_npc_lyra"]["x"] = 0
+
+
+class MovementValidationTests(TestCase):
+    def _payload(self, player, target, trace=None):
+        payload = {
+            "player_position": dict(zip("xy", player)),
+            "target_position": dict(zip("xy", target)),
+        }
+        if trace is not None:
+            payload["trace"] = trace
+        return payload
+
+    def test_components_split_walled_regions(self):
+        components = layout._label_components(("WWWWWWW", "WGGWGGW", "WGGWGWW", "WWWWWWW"))
+        self.assertEqual(components[1], ((1, 4), (3, 6), (0, 1)))
+        self.assertEqual(components[2], ((1, 4), (3, 5), (0, 1)))
+        repeated = layout._label_components(("GG", "GG"))
+        self.assertIs(repeated[0], repeated[1])
+
+    def test_spawn_component_matches_flood_fill(self):
+        town_layout = layout.build_layout(3, layout.GENERATOR_PROCEDURAL, 64, 40)
+        seen, frontier = {layout.SPAWN}, [layout.SPAWN]
+        while frontier:
+            x, y = frontier.pop()
+            for cell in ((x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1)):
+                if cell not in seen and town_layout.is_passable(*cell):
+                    seen.add(cell)
+                    frontier.append(cell)
+        for y in range(town_layout.height):
+            for x in range(town_layout.width):
+                self.assertEqual(town_layout.reachable(x, y), (x, y) in seen)
+
+    def test_trace_is_validated_step_by_step(self):
+        town_layout = layout.get_layout(42)
+        lyra = town_layout.events["talk_npc_lyra"]
+        sable = town_layout.events["talk_npc_sable"]
+        walk = {"start": {"x": 2, "y": 2}, "moves": "4R"}
+        self.assertTrue(town._validate_adjacency(lyra, self._payload((6, 2), (6, 3), walk), town_layout))
+        self.assertTrue(town._validate_adjacency(lyra, self._payload((6, 2), (6, 3)), town_layout))
+        through_wall = {"start": {"x": 11, "y": 4}, "moves": "4R"}
+        self.assertFalse(town._validate_adjacency(sable, self._payload((15, 4), (14, 4), through_wall), town_layout))
+        elsewhere = {"start": {"x": 2, "y": 2}, "moves": "3R"}
+        self.assertFalse(town._validate_adjacency(lyra, self._payload((6, 2), (6, 3), elsewhere), town_layout))
+        too_long = {"start": {"x": 2, "y": 2}, "moves": "1R1L" * town.MAX_TRACE_STEPS + "4R"}
+        self.assertFalse(town._validate_adjacency(lyra, self._payload((6, 2), (6, 3), too_long), town_layout))
+        self.assertFalse(town._validate_adjacency(lyra, self._payload((6, 2), (6, 3), {"moves": "4R"}), town_layout))
+
+
+class QuestRuleTests(TestCase):
+    def _state(self, flags=(), items=None):
+        town_row = {"town_id": "town-000001", "seed": 1, "version": 1}
+        return PlayerState("u", town_row, set(flags), dict(items or {}), {}, {})
+
+    def test_content_compiles_for_every_quest_event(self):
+        rules = town.quest_rules()
+        for event_id in ("talk_npc_lyra", "open_chest_herb", "open_chest_archive"):
+            self.assertIn(event_id, rules)
+
+    def test_first_matching_rule_fires(self):
+        state = self._state(flags={"herb_quest_started", "herb_collected"}, items={"herb_bundle": 1})
+        result = quests.evaluate(town.quest_rules(), state, "talk_npc_lyra")
+        self.assertEqual(result["message_key"], "event.lyra.quest_complete")
+        self.assertEqual(result["items_added"], ["moon_badge"])
+        self.assertEqual(state.item_qty("herb_bundle"), 0)
+        self.assertIn("herb_turned_in", state.flags)
+
+    def test_unmatched_event_returns_none(self):
+        self.assertIsNone(quests.evaluate(town.quest_rules(), self._state(), "talk_npc_tarin"))
+
+    def test_compile_rejects_unknown_item(self):
+        document = {"rules": {"open_chest_herb": [{"then": {"grant": {"dragon": 1}, "message_key": "x"}}]}}
+        with self.assertRaises(quests.QuestContentError):
+            quests.compile_rules(document, item_ids=town.ITEM_TYPES_BY_ID)
+
+    def test_compile_rejects_unknown_event(self):
+        document = {"rules": {"talk_npc_nobody": [{"then": {"message_key": "x"}}]}}
+        with self.assertRaises(quests.QuestContentError):
+            quests.compile_rules(document, event_ids=layout.EVENT_IDS)
+
+
+class ContentBuildTests(TestCase):
+    def setUp(self):
+        self.out_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.out_dir)
+        self.override = override_settings(GAME_CONTENT_BUILD_DIR=self.out_dir)
+        self.override.enable()
+        self.addCleanup(self.override.disable)
+        self.addCleanup(content.reset)
+        content.reset()
+        self.manifest = content.build(self.out_dir, town.message_keys())
+
+    def test_content_has_every_referenced_key(self):
+        sources = content.load_sources(settings.GAME_CONTENT_DIR, content.DEFAULT_LOCALE)
+        self.assertEqual(content.missing_keys(sources['dialog'], town.message_keys()), [])
+
+    def test_build_is_reproducible(self):
+        again = content.build(self.out_dir, town.message_keys())
+        self.assertEqual(again['release'], self.manifest['release'])
+
+    def test_missing_key_fails_build(self):
+        with self.assertRaises(content.ContentError):
+            content.build(self.out_dir, {'event.not_written_yet'})
+
+    def test_bundle_served_compressed_and_immutable(self):
+        filename = self.manifest['locales']['en']['core']
+        res = self.client.get(f'/api/content/{filename}', HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res['Content-Encoding'], 'gzip')
+        self.assertIn('immutable', res['Cache-Control'])
+        self.assertIn('event.sign_gate', json.loads(gzip.decompress(res.content))['messages'])
+
+    def test_unknown_bundle_is_404(self):
+        self.assertEqual(self.client.get('/api/content/..%2Fsettings.py').status_code, 404)
+        self.assertEqual(self.client.get('/api/content/core.en.0000000000000000.json').status_code, 404)
+
+    def test_missing_file_is_not_remembered(self):
+        name = 'core.en.0000000000000000.json'
+        self.assertIsNone(content.bundle(name, ''))
+        (self.out_dir / name).write_bytes(b'{}')
+        self.assertEqual(content.bundle(name, ''), (b'{}', None))
+
+    def test_file_cache_is_bounded(self):
+        with mock.patch.object(content, 'CACHED_FILES', 2):
+            for index in range(4):
+                path = self.out_dir / f'extra{index}.json'
+                path.write_bytes(b'{}')
+                content._read_cached(path)
+            self.assertEqual(len(content._files), 2)
+
+    def test_manifest_conditional_get(self):
+        res = self.client.get('/api/content/manifest/')
+        self.assertEqual(res.status_code, 200)
+        cached = self.client.get('/api/content/manifest/', HTTP_IF_NONE_MATCH=res['ETag'])
+        self.assertEqual(cached.status_code, 304)
+
+
+class RendererTests(TestCase):
+    def _snapshot(self):
+        town_row = {"town_id": "town-000007", "seed": 7, "version": 3}
+        state = PlayerState("u", town_row, {"herb_collected"}, {"herb_bundle": 1}, {}, {})
+        state.ledger["open_chest_herb"] = (None, None, None, "{}")
+        return town._state_snapshot(state)
+
+    def test_plain_prerendered_dict_encodes_its_items(self):
+        body = renderers.render({'snapshot': renderers.PrerenderedDict(version=3)})
+        self.assertEqual(json.loads(body), {'snapshot': {'version': 3}})
+
+    def test_spliced_snapshot_matches_plain_encoding(self):
+        snapshot = self._snapshot()
+        plain = json.loads(json.dumps(dict(snapshot)))
+        self.assertEqual(json.loads(renderers.render(snapshot)), plain)
+        nested = json.loads(renderers.render({"event_id": "x", "snapshot": snapshot}))
+        self.assertEqual(nested["snapshot"], plain)
+
+    def test_strings_that_look_like_splice_points_are_left_alone(self):
+        snapshot = self._snapshot()
+        for hostile in ('\ue000splice:0', '"\ue000splice:0"', 'splice:0'):
+            data = {'event_id': hostile, 'results': [{'event_id': hostile}], 'snapshot': snapshot}
+            body = json.loads(renderers.render(data))
+            self.assertEqual(body['event_id'], hostile)
+            self.assertEqual(body['results'], [{'event_id': hostile}])
+            self.assertEqual(body['snapshot'], json.loads(json.dumps(dict(snapshot))))
+
+    def test_stdlib_fallback(self):
+        snapshot = self._snapshot()
+        with mock.patch.object(renderers, "orjson", None):
+            body = renderers.render({"snapshot": snapshot})
+        self.assertEqual(json.loads(body)["snapshot"], json.loads(json.dumps(dict(snapshot))))
+
+
+class LayoutEndpointTests(TestCase):
+    def test_layout_by_seed_revalidates(self):
+        res = self.client.get('/api/town/layout/0/')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res['Cache-Control'], 'public, no-cache')
+        cached = self.client.get('/api/town/layout/0/', HTTP_IF_NONE_MATCH=res['ETag'])
+        self.assertEqual(cached.status_code, 304)
+
+    def test_viewport_chunks(self):
+        res = self.client.get('/api/town/layout/0/chunks/', {'x': 0, 'y': 0, 'w': 20, 'h': 12})
+        self.assertEqual(res.status_code, 200)
+        data = json.loads(res.content)
+        self.assertEqual([(chunk['cx'], chunk['cy']) for chunk in data['chunks']], [(0, 0)])
+        self.assertIn('npc_lyra', [npc['npc_id'] for npc in data['chunks'][0]['npcs']])
+        cached = self.client.get(
+            '/api/town/layout/0/chunks/', {'x': 0, 'y': 0, 'w': 20, 'h': 12}, HTTP_IF_NONE_MATCH=res['ETag']
+        )
+        self.assertEqual(cached.status_code, 304)
+        refetched = self.client.get(
+            '/api/town/layout/0/chunks/', {'x': 0, 'y': 0, 'w': 20, 'h': 12}, HTTP_IF_NONE_MATCH=f'W/"x{res["ETag"]}"'
+        )
+        self.assertEqual(refetched.status_code, 200)
+
+    def test_viewport_validation(self):
+        self.assertEqual(self.client.get('/api/town/layout/0/chunks/', {'x': 0}).status_code, 400)
+        too_big = {'x': 0, 'y': 0, 'w': 100000, 'h': 100000}
+        with mock.patch.object(town, 'MAX_VIEWPORT_CHUNKS', 0):
+            self.assertEqual(self.client.get('/api/town/layout/0/chunks/', too_big).status_code, 400)
+
+    def test_stale_layout_hash_is_404(self):
+        self.assertEqual(self.client.get('/api/town/layout/0/0000000000000000/').status_code, 404)
+
+    def test_classic_towns_share_one_layout(self):
+        self.assertEqual(layout.layout_seed(42), layout.CLASSIC_LAYOUT_SEED)
+        self.assertIs(layout.get_layout(42), layout.get_layout(7))
+        layout_hash, _ = town.layout_document(layout.CLASSIC_LAYOUT_SEED)
+        self.assertEqual(self.client.get(f'/api/town/layout/0/{layout_hash}/').status_code, 200)
+
+    def test_layout_follows_generator_setting(self):
+        classic_hash, _ = town.layout_document(7)
+        with override_settings(GAME_TOWN_GENERATOR={'NAME': 'procedural', 'WIDTH': 64, 'HEIGHT': 48}):
+            procedural_hash, body = town.layout_document(7)
+            self.assertEqual(json.loads(body)['width'], 64)
+            state = PlayerState('u', {'town_id': 'town-000007', 'seed': 7, 'version': 1}, set(), {}, {}, {})
+            self.assertEqual(json.loads(renderers.render(town._state_snapshot(state)))['width'], 64)
+        self.assertNotEqual(procedural_hash, classic_hash)
+        self.assertEqual(town.layout_document(7)[0], classic_hash)
+
+    def test_chunks_follow_generator_setting(self):
+        classic = json.loads(town.viewport_document(7, 0, 0, 20, 12))
+        with override_settings(GAME_TOWN_GENERATOR={'NAME': 'procedural', 'WIDTH': 64, 'HEIGHT': 48}):
+            procedural = json.loads(town.viewport_document(7, 0, 0, 20, 12))
+        self.assertEqual(procedural['width'], 64)
+        self.assertNotEqual(procedural['chunks'], classic['chunks'])
+        self.assertEqual(json.loads(town.viewport_document(7, 0, 0, 20, 12)), classic)
+
+    def test_seeds_without_a_town_are_404(self):
+        self.assertEqual(self.client.get('/api/town/layout/42/').status_code, 404)
+        self.assertEqual(self.client.get('/api/town/layout/42/chunks/', {'x': 0, 'y': 0, 'w': 20, 'h': 12}).status_code, 404)
+
+
+class DeltaTests(TestCase):
+    def test_merge_collapses_item_changes_and_allowed_churn(self):
+        first = delta.empty_patch(1)
+        first.update(to_version=2, items_changed=[{'item_id': 'herb_bundle', 'qty': 1}], allowed_removed=['x'])
+        second = delta.empty_patch(2)
+        second.update(to_version=3, items_changed=[{'item_id': 'herb_bundle', 'qty': 0}], allowed_added=['x'])
+        merged = delta.merge_patches([first, second])
+        self.assertEqual(merged['from_version'], 1)
+        self.assertEqual(merged['to_version'], 3)
+        self.assertEqual(merged['items_changed'], [{'item_id': 'herb_bundle', 'qty': 0}])
+        self.assertEqual(merged['allowed_added'], [])
+        self.assertEqual(merged['allowed_removed'], [])
+
+
+@override_settings(
+    REST_FRAMEWORK=NO_CSRF,
+    SESSION_COOKIE_SECURE=False,
+    CSRF_COOKIE_SECURE=False,
+)
+class PlayerStateTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        schema.migrate()
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.get('/api/user/me/')
+        self.user_id = self.client.session['user_id']
+
+    def test_losing_town_creation_loads_the_winners_progress(self):
+        winner = PlayerState.load(self.user_id)
+        winner.add_flag('herb_collected')
+        winner.grant_item('herb_bundle', 2)
+        winner.bump_version()
+        winner.flush()
+        real_batch = db.batch
+        calls = []
+
+        def town_missing(statements, **kwargs):
+            # The first read misses the row, as if it was created just after.
+            results = real_batch(statements, **kwargs)
+            calls.append(statements)
+            return [[], *results[1:]] if len(calls) == 1 else results
+
+        with mock.patch.object(db, 'batch', town_missing):
+            loser = PlayerState.load(self.user_id)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(loser.version, winner.version)
+        self.assertEqual(loser.flags, {'herb_collected'})
+        self.assertEqual(loser.item_qty('herb_bundle'), 2)
+
+    def test_flush_round_trip(self):
+        state = PlayerState.load(self.user_id)
+        start_version = state.version
+        state.add_flag('herb_collected')
+        state.add_flag('iron_key_given')
+        state.grant_item('herb_bundle', 2)
+        state.consume_item('herb_bundle', 1)
+        state.set_dialog_index('npc_tarin', 2)
+        state.record_event('open_chest_herb', {'message_key': 'event.chest_herb_opened'})
+        state.bump_version()
+        state.flush()
+
+        reloaded = PlayerState.load(self.user_id)
+        self.assertEqual(reloaded.version, start_version + 1)
+        self.assertEqual(reloaded.flags, {'herb_collected', 'iron_key_given'})
+        self.assertEqual(reloaded.item_qty('herb_bundle'), 1)
+        self.assertEqual(reloaded.dialog_index('npc_tarin'), 2)
+        self.assertEqual(
+            reloaded.recorded_event('open_chest_herb'),
+            {'message_key': 'event.chest_herb_opened'},
+        )
+
+    def test_flush_detects_concurrent_version_change(self):
+        winner = PlayerState.load(self.user_id)
+        loser = PlayerState.load(self.user_id)
+        winner.bump_version()
+        winner.flush()
+
+        loser.add_flag('iron_key_given')
+        loser.bump_version()
+        with self.assertRaises(VersionConflict):
+            loser.flush()
+        self.assertNotIn('iron_key_given', PlayerState.load(self.user_id).flags)
+
+    def test_racing_ledger_write_is_a_version_conflict(self):
+        # Both writers record the same one-time event; the loser must see a
+        # VersionConflict (which apply_event retries), not a duplicate key.
+        result = {'message_key': 'event.chest_herb_opened', 'flags_added': [], 'items_added': ['herb_bundle']}
+        winner = PlayerState.load(self.user_id)
+        loser = PlayerState.load(self.user_id)
+        for state in (winner, loser):
+            state.record_event('open_chest_herb', result)
+            state.bump_version()
+        winner.flush()
+        with self.assertRaises(VersionConflict):
+            loser.flush()
+        count = db.fetch_one(
+            "SELECT COUNT(*) FROM player_event_ledger WHERE user_id = %s AND event_id = %s",
+            [self.user_id, 'open_chest_herb'],
+        )[0]
+        self.assertEqual(count, 1)
+
+    def test_flush_without_changes_is_noop(self):
+        state = PlayerState.load(self.user_id)
+        with self.assertNumQueries(0):
+            state.flush()
+
+    @override_settings(GAME_STATE_STORAGE='document')
+    def test_document_storage_writes_one_statement(self):
+        state = PlayerState.load(self.user_id)
+        state.flush()  # first load in document mode converts the rows
+        state.set_dialog_index('npc_tarin', 1)
+        state.bump_version()
+        with self.assertNumQueries(1):
+            state.flush()
+        reloaded = PlayerState.load(self.user_id)
+        self.assertEqual(reloaded.dialog_index('npc_tarin'), 1)
+        self.assertEqual(reloaded.version, state.version)
+
+    def test_convert_player_round_trip(self):
+        state = PlayerState.load(self.user_id)
+        state.add_flag('herb_collected')
+        state.grant_item('herb_bundle', 1)
+        state.set_dialog_index('npc_tarin', 2)
+        state.bump_version()
+        state.flush()
+
+        self.assertTrue(convert_player(self.user_id, statedoc.STORAGE_DOCUMENT))
+        self.assertFalse(convert_player(self.user_id, statedoc.STORAGE_DOCUMENT))
+        document = PlayerState.load(self.user_id, statedoc.STORAGE_DOCUMENT)
+        document.grant_item('iron_key', 1)
+        document.bump_version()
+        document.flush()
+
+        self.assertTrue(convert_player(self.user_id, statedoc.STORAGE_ROWS))
+        rows = PlayerState.load(self.user_id, statedoc.STORAGE_ROWS)
+        self.assertEqual(rows.flags, {'herb_collected'})
+        self.assertEqual(rows.items, {'herb_bundle': 1, 'iron_key': 1})
+        self.assertEqual(rows.dialog_index('npc_tarin'), 2)
+        self.assertEqual(rows.version, document.version)
+
+
+    def test_archived_event_still_replays(self):
+        result = {'message_key': 'event.chest_herb_opened', 'flags_added': ['herb_collected'], 'items_added': ['herb_bundle']}
+        state = PlayerState.load(self.user_id)
+        state.record_event('open_chest_herb', result)
+        state.bump_version()
+        state.flush()
+        db.execute(
+            "UPDATE player_event_ledger SET applied_at = NOW() - INTERVAL 60 DAY WHERE user_id = %s",
+            [self.user_id],
+        )
+        cutoff = db.fetch_one("SELECT NOW() - INTERVAL 30 DAY")[0]
+
+        self.assertEqual(ledger.archive_player(self.user_id, cutoff), 1)
+        hot = db.fetch_one("SELECT COUNT(*) FROM player_event_ledger WHERE user_id = %s", [self.user_id])
+        self.assertEqual(hot[0], 0)
+        reloaded = PlayerState.load(self.user_id)
+        self.assertIn('open_chest_herb', reloaded.consumed_event_ids())
+        self.assertEqual(reloaded.recorded_event('open_chest_herb'), result)
+
+
+class LedgerEncodingTests(TestCase):
+    def test_pack_round_trip(self):
+        self.assertEqual(ledger.unpack(ledger.pack([1, 300, 65535])), (1, 300, 65535))
+        self.assertEqual(ledger.unpack(None), ())
+
+    def test_unusual_result_kept_as_json(self):
+        result = {'message_key': 'event.unknown', 'extra': 1}
+        columns = ledger.encode_result(result)
+        self.assertEqual(columns[:3], (None, None, None))
+        self.assertEqual(ledger.decode_result(*columns), result)
+
+
+class LedgerKeyTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        schema.migrate()
+
+    def test_known_name_does_not_use_up_ids(self):
+        first = ledger.intern(ledger.KIND_MESSAGE, 'test.intern.first')
+        ledger._ids.clear()
+        self.assertEqual(ledger.intern(ledger.KIND_MESSAGE, 'test.intern.first'), first)
+        self.assertEqual(ledger.intern(ledger.KIND_MESSAGE, 'test.intern.second'), first + 1)
+
+    def test_exhausted_ids_raise_a_clear_error(self):
+        with mock.patch.object(db, 'fetch_one', return_value=None), mock.patch.object(db, 'execute', return_value=0):
+            with self.assertRaises(ledger.LedgerKeysExhausted):
+                ledger.intern(ledger.KIND_MESSAGE, 'test.intern.full')
+
+
+class StateDocumentTests(TestCase):
+    def test_encode_decode_round_trip(self):
+        flags = {'herb_collected', 'guild_seal_given', 'unregistered_flag'}
+        raw = statedoc.encode(flags, {'herb_bundle': 2}, {'npc_tarin': 1})
+        self.assertEqual(statedoc.decode(raw), (flags, {'herb_bundle': 2}, {'npc_tarin': 1}))
+
+    def test_registry_covers_quest_flags(self):
+        registered = set(statedoc.flag_registry())
+        for rules in town.quest_rules().values():
+            for rule in rules:
+                self.assertLessEqual(set(rule.add_flags), registered)
+
+
+class LocalLRUCacheTests(TestCase):
+    def test_evicts_least_recently_used_when_over_budget(self):
+        lru = cache.LocalLRUCache(max_bytes=200)
+        lru.set('a', 'x' * 60)
+        lru.set('b', 'x' * 60)
+        lru.get('a')
+        lru.set('c', 'x' * 60)
+        self.assertIsNotNone(lru.get('a'))
+        self.assertIsNone(lru.get('b'))
+        self.assertIsNotNone(lru.get('c'))
+
+    def test_add_does_not_replace(self):
+        lru = cache.LocalLRUCache(max_bytes=1024)
+        self.assertTrue(lru.add('k', 1))
+        self.assertFalse(lru.add('k', 2))
+        self.assertEqual(lru.get('k'), 1)
+
+    def test_per_process_backends_need_single_process(self):
+        self.addCleanup(cache.reset_backend)
+        for backend in ('local', 'shared'):
+            with self.subTest(backend=backend), override_settings(GAME_STATE_CACHE={'BACKEND': backend}):
+                cache.reset_backend()
+                with self.assertRaises(ImproperlyConfigured):
+                    cache.backend()
+        with override_settings(GAME_STATE_CACHE={'BACKEND': 'local', 'SINGLE_PROCESS': True}):
+            cache.reset_backend()
+            self.assertIsInstance(cache.backend(), cache.LocalLRUCache)
+
+
+@override_settings(
+    REST_FRAMEWORK=NO_CSRF,
+    SESSION_COOKIE_SECURE=False,
+    CSRF_COOKIE_SECURE=False,
+    GAME_STATE_CACHE={'BACKEND': 'local', 'MAX_BYTES': 1024 * 1024, 'SINGLE_PROCESS': True},
+)
+class StateCacheTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        schema.migrate()
+
+    def setUp(self):
+        cache.reset_backend()
+        self.client = APIClient()
+        self.client.get('/api/user/me/')
+        self.user_id = self.client.session['user_id']
+
+    def tearDown(self):
+        cache.reset_backend()
+
+    def test_repeat_snapshot_read_skips_database(self):
+        first = town.get_town_snapshot(self.user_id)
+        with self.assertNumQueries(0):
+            second = town.get_town_snapshot(self.user_id)
+        self.assertEqual(first['version'], second['version'])
+
+    def test_event_invalidates_cached_snapshot(self):
+        before = town.get_town_snapshot(self.user_id)
+        self.client.post(
+            '/api/town/event/',
+            {
+                'event_id': 'read_sign_gate',
+                'version': before['version'],
+                'payload': {
+                    'player_position': {'x': 2, 'y': 2},
+                    'target_position': {'x': 3, 'y': 2},
+                },
+            },
+            format='json',
+        )
+        after = town.get_town_snapshot(self.user_id)
+        self.assertEqual(after['version'], before['version'] + 1)
+
+    def test_event_records_written_version_in_session(self):
+        before = town.get_town_snapshot(self.user_id)
+        self.client.post(
+            '/api/town/event/',
+            {
+                'event_id': 'read_sign_gate',
+                'version': before['version'],
+                'payload': {'player_position': {'x': 2, 'y': 2}, 'target_position': {'x': 3, 'y': 2}},
+            },
+            format='json',
+        )
+        self.assertEqual(self.client.session['town_version'], before['version'] + 1)
+
+    def test_lagging_replica_is_passed_over_for_written_version(self):
+        current = town.get_town_snapshot(self.user_id)['version']
+        cache.reset_backend()
+        real = town._town_snapshot
+
+        def lagging(user_id):
+            snapshot = real(user_id)
+            if db._replica.get() is not None:
+                return {**snapshot, 'version': snapshot['version'] - 1}
+            return snapshot
+
+        with override_settings(GAME_DB_REPLICAS=['default']), mock.patch.object(town, '_town_snapshot', lagging):
+            self.assertEqual(town.get_town_snapshot(self.user_id)['version'], current - 1)
+            self.assertIsNone(cache.get_snapshot(self.user_id))
+            self.assertEqual(town.get_town_snapshot(self.user_id, current)['version'], current)
+        self.assertEqual(cache.get_snapshot(self.user_id)['version'], current)
+
+    def test_client_presented_version_passes_over_lagging_replica(self):
+        # Socket writes never reach the session, so the client presents the
+        # version its last socket reply carried.
+        current = town.get_town_snapshot(self.user_id)['version']
+        cache.reset_backend()
+        real = town._town_snapshot
+
+        def lagging(user_id):
+            snapshot = real(user_id)
+            if db._replica.get() is not None:
+                return {**snapshot, 'version': snapshot['version'] - 1}
+            return snapshot
+
+        with override_settings(GAME_DB_REPLICAS=['default']), mock.patch.object(town, '_town_snapshot', lagging):
+            self.assertEqual(self.client.get('/api/town/state/').data['version'], current - 1)
+            res = self.client.get('/api/town/state/', {'min_version': current})
+            self.assertEqual(res.data['version'], current)
+
+    def test_add_points_invalidates_user_data(self):
+        self.client.get('/api/user/me/')
+        res = self.client.post('/api/user/me/points/', {'amount': 3}, format='json')
+        self.assertEqual(res.data['points'], 3)
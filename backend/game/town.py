@@ -1,55 +1,34 @@
 import hashlib
-import json
+import re
 import uuid
-
-from . import db
-
-TOWN_WIDTH = 32
-TOWN_HEIGHT = 20
-
-PASSABLE_TILES = {"G", "P", "B"}
-
-NPCS = [
-    {"npc_id": "npc_lyra", "name_key": "npc.npc_lyra", "x": 6, "y": 3},
-    {"npc_id": "npc_borin", "name_key": "npc.npc_borin", "x": 10, "y": 4},
-    {"npc_id": "npc_sable", "name_key": "npc.npc_sable", "x": 14, "y": 4},
-    {"npc_id": "npc_quill", "name_key": "npc.npc_quill", "x": 20, "y": 4},
-    {"npc_id": "npc_elowen", "name_key": "npc.npc_elowen", "x": 24, "y": 4},
-    {"npc_id": "npc_tarin", "name_key": "npc.npc_tarin", "x": 7, "y": 8},
-    {"npc_id": "npc_mara", "name_key": "npc.npc_mara", "x": 11, "y": 8},
-    {"npc_id": "npc_nessa", "name_key": "npc.npc_nessa", "x": 15, "y": 8},
-    {"npc_id": "npc_oswin", "name_key": "npc.npc_oswin", "x": 19, "y": 8},
-    {"npc_id": "npc_pru", "name_key": "npc.npc_pru", "x": 23, "y": 8},
-    {"npc_id": "npc_ren", "name_key": "npc.npc_ren", "x": 27, "y": 8},
-    {"npc_id": "npc_selin", "name_key": "npc.npc_selin", "x": 5, "y": 12},
-    {"npc_id": "npc_tovan", "name_key": "npc.npc_tovan", "x": 9, "y": 12},
-    {"npc_id": "npc_ursa", "name_key": "npc.npc_ursa", "x": 13, "y": 12},
-    {"npc_id": "npc_vann", "name_key": "npc.npc_vann", "x": 17, "y": 12},
-    {"npc_id": "npc_wren", "name_key": "npc.npc_wren", "x": 21, "y": 12},
-    {"npc_id": "npc_xara", "name_key": "npc.npc_xara", "x": 25, "y": 12},
-    {"npc_id": "npc_yorik", "name_key": "npc.npc_yorik", "x": 28, "y": 12},
-    {"npc_id": "npc_zev", "name_key": "npc.npc_zev", "x": 4, "y": 16},
-    {"npc_id": "npc_aela", "name_key": "npc.npc_aela", "x": 8, "y": 16},
-    {"npc_id": "npc_brinn", "name_key": "npc.npc_brinn", "x": 12, "y": 16},
-    {"npc_id": "npc_cass", "name_key": "npc.npc_cass", "x": 16, "y": 16},
-    {"npc_id": "npc_dane", "name_key": "npc.npc_dane", "x": 20, "y": 16},
-    {"npc_id": "npc_eris", "name_key": "npc.npc_eris", "x": 24, "y": 16},
-    {"npc_id": "npc_fenn", "name_key": "npc.npc_fenn", "x": 28, "y": 16},
-    {"npc_id": "npc_galen", "name_key": "npc.npc_galen", "x": 6, "y": 18},
-    {"npc_id": "npc_hale", "name_key": "npc.npc_hale", "x": 10, "y": 18},
-    {"npc_id": "npc_iora", "name_key": "npc.npc_iora", "x": 14, "y": 18},
-    {"npc_id": "npc_jory", "name_key": "npc.npc_jory", "x": 18, "y": 18},
-    {"npc_id": "npc_kipp", "name_key": "npc.npc_kipp", "x": 22, "y": 18},
-]
-
-INTERACTABLE_EVENTS = [
-    {"event_id": "read_sign_gate", "type": "read_sign", "x": 3, "y": 2, "repeatable": True},
-    {"event_id": "read_sign_plaza", "type": "read_sign", "x": 16, "y": 10, "repeatable": True},
-    {"event_id": "open_chest_herb", "type": "open_chest", "x": 27, "y": 3, "repeatable": False},
-    {"event_id": "open_chest_archive", "type": "open_chest", "x": 28, "y": 14, "repeatable": False},
-    {"event_id": "enter_hall", "type": "enter_building", "x": 2, "y": 10, "repeatable": True},
-    {"event_id": "enter_guild", "type": "enter_building", "x": 30, "y": 10, "repeatable": True},
-]
+from functools import lru_cache
+from itertools import accumulate
+
+from django.conf import settings
+
+from . import cache, db, delta, quests, renderers
+from .layout import (
+    CHUNK_SIZE,
+    CLASSIC_LAYOUT_SEED,
+    GENERATOR_CLASSIC,
+    EVENT_IDS,
+    LAYOUT_CACHE_SIZE,
+    NPCS,
+    encode_row,
+    generator_config,
+    get_layout,
+    layout_seed,
+)
+from .renderers import PrerenderedDict
+from .state import PlayerState, VersionConflict
+
+SNAPSHOT_REVISION = 1
+
+# Attempts at applying one event before giving up on a contended town row.
+EVENT_RETRY_LIMIT = 3
+
+# Most events one batch request may carry.
+MAX_BATCH_EVENTS = 32
 
 ITEM_TYPES = [
     {
@@ -90,6 +69,8 @@ ITEM_TYPES = [
     },
 ]
 
+ITEM_TYPES_BY_ID = {item["item_id"]: item for item in ITEM_TYPES}
+
 NPC_DIALOG_PATHS = {
     "npc_lyra": ["intro", "quest_start", "quest_wait", "quest_done"],
     "npc_borin": ["intro", "forge_key", "forge_after"],
@@ -100,101 +81,35 @@ NPC_DIALOG_PATHS = {
 
 GENERIC_DIALOG = ["hello", "rumor", "direction"]
 
+QUEST_RULES_PATH = "quests/town_quests.json"
 
-def ensure_schema():
-    db.execute(
-        """
-        CREATE TABLE IF NOT EXISTS user_login (
-            user_id CHAR(36) NOT NULL PRIMARY KEY,
-            name VARCHAR(100) DEFAULT NULL,
-            created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
-        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
-        """
-    )
-    db.execute(
-        """
-        CREATE TABLE IF NOT EXISTS players (
-            user_id CHAR(36) NOT NULL PRIMARY KEY,
-            points BIGINT NOT NULL DEFAULT 0,
-            updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
-        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
-        """
-    )
-    db.execute(
-        """
-        CREATE TABLE IF NOT EXISTS player_towns (
-            user_id CHAR(36) NOT NULL PRIMARY KEY,
-            town_id VARCHAR(64) NOT NULL,
-            seed BIGINT NOT NULL,
-            version INT NOT NULL DEFAULT 1,
-            created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
-            updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
-        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
-        """
-    )
-    db.execute(
-        """
-        CREATE TABLE IF NOT EXISTS player_event_ledger (
-            user_id CHAR(36) NOT NULL,
-            event_id VARCHAR(100) NOT NULL,
-            result_json LONGTEXT NOT NULL,
-            applied_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
-            PRIMARY KEY(user_id, event_id)
-        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
-        """
-    )
-    db.execute(
-        """
-        CREATE TABLE IF NOT EXISTS player_flags (
-            user_id CHAR(36) NOT NULL,
-            flag VARCHAR(100) NOT NULL,
-            created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
-            PRIMARY KEY(user_id, flag)
-        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
-        """
-    )
-    db.execute(
-        """
-        CREATE TABLE IF NOT EXISTS item_types (
-            item_id VARCHAR(50) NOT NULL PRIMARY KEY,
-            name_key VARCHAR(120) NOT NULL,
-            description_key VARCHAR(120) NOT NULL,
-            tags VARCHAR(120) NOT NULL
-        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
-        """
-    )
-    db.execute(
-        """
-        CREATE TABLE IF NOT EXISTS player_items (
-            user_id CHAR(36) NOT NULL,
-            item_id VARCHAR(50) NOT NULL,
-            qty INT NOT NULL DEFAULT 0,
-            acquired_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
-            updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
-            PRIMARY KEY(user_id, item_id)
-        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
-        """
-    )
-    db.execute(
-        """
-        CREATE TABLE IF NOT EXISTS npc_dialog_state (
-            user_id CHAR(36) NOT NULL,
-            npc_id VARCHAR(60) NOT NULL,
-            node_index INT NOT NULL DEFAULT 0,
-            updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
-            PRIMARY KEY(user_id, npc_id)
-        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
-        """
+
+@lru_cache(maxsize=None)
+def quest_rules():
+    return quests.load_rules(
+        settings.GAME_CONTENT_DIR / QUEST_RULES_PATH,
+        event_ids=EVENT_IDS,
+        item_ids=ITEM_TYPES_BY_ID,
     )
 
+
+def message_keys():
+    """Every message key the server can send, for content validation."""
+    rules = quest_rules()
+    keys = {"event.unknown"}
+    for event_rules in rules.values():
+        keys.update(rule.message_key for rule in event_rules)
+    for npc in NPCS:
+        keys.add(npc["name_key"])
+        # Dialog paths only play when no quest rule matches.
+        event_rules = rules.get(f"talk_{npc['npc_id']}", ())
+        if event_rules and event_rules[-1].unconditional:
+            continue
+        for node in NPC_DIALOG_PATHS.get(npc["npc_id"], GENERIC_DIALOG):
+            keys.add(f"dialog.{npc['npc_id']}.{node}")
     for item in ITEM_TYPES:
-        db.execute(
-            """
-            INSERT IGNORE INTO item_types (item_id, name_key, description_key, tags)
-            VALUES (%s, %s, %s, %s)
-            """,
-            [item["item_id"], item["name_key"], item["description_key"], item["tags"]],
-        )
+        keys.update((item["name_key"], item["description_key"]))
+    return keys
 
 
 def get_or_create_user(session):
@@ -212,6 +127,9 @@ def get_or_create_user(session):
 
 
 def user_data(user_id):
+    data = cache.get_user_data(user_id)
+    if data is not None:
+        return data
     row = db.fetch_one(
         "SELECT ul.user_id, ul.name, ul.created_at, p.points "
         "FROM user_login ul JOIN players p ON ul.user_id = p.user_id WHERE ul.user_id = %s",
@@ -219,245 +137,312 @@ def user_data(user_id):
     )
     if not row:
         return None
-    return {
+    data = {
         "user_id": row[0],
         "name": row[1],
         "created_at": row[2].isoformat() if row[2] else None,
         "points": row[3],
     }
+    cache.set_user_data(user_id, data)
+    return data
 
 
-def _event_catalog():
-    events = {}
-    for npc in NPCS:
-        event_id = f"talk_{npc['npc_id']}"
-        events[event_id] = {
-            "event_id": event_id,
-            "type": "talk_npc",
-            "x": npc["x"],
-            "y": npc["y"],
-            "repeatable": True,
-            "npc_id": npc["npc_id"],
-        }
-    for evt in INTERACTABLE_EVENTS:
-        events[evt["event_id"]] = evt
-    return events
-
-
-def _build_tiles(seed):
-    # Seed is reserved for future procedural decoration and serialized in snapshot.
-    _ = seed
-    rows = []
-    for y in range(TOWN_HEIGHT):
-        chars = []
-        for x in range(TOWN_WIDTH):
-            if x == 0 or y == 0 or x == TOWN_WIDTH - 1 or y == TOWN_HEIGHT - 1:
-                chars.append("W")
-            elif y in (6, 10, 14) or x in (8, 16, 24):
-                chars.append("P")
-            elif 12 <= x <= 14 and 1 <= y <= 5:
-                chars.append("W")
-            elif 25 <= x <= 30 and 12 <= y <= 15:
-                chars.append("W")
-            elif 2 <= x <= 5 and 9 <= y <= 11:
-                chars.append("W")
-            else:
-                chars.append("G")
-        rows.append("".join(chars))
-
-    # Bridge entrances (passable openings) for halls.
-    rows[10] = rows[10][:2] + "B" + rows[10][3:30] + "B" + rows[10][31:]
-    return rows
-
-
-def _ensure_player_town(user_id):
-    row = db.fetch_one(
-        "SELECT town_id, seed, version FROM player_towns WHERE user_id = %s",
-        [user_id],
-    )
-    if row:
-        return {"town_id": row[0], "seed": int(row[1]), "version": int(row[2])}
-
-    seed = int(hashlib.sha256(user_id.encode("utf-8")).hexdigest()[:12], 16)
-    town_id = f"town-{seed % 1000000:06d}"
-    db.execute(
-        "INSERT INTO player_towns (user_id, town_id, seed, version) VALUES (%s, %s, %s, 1)",
-        [user_id, town_id, seed],
-    )
-    return {"town_id": town_id, "seed": seed, "version": 1}
+def _snapshot_items(state):
+    items = []
+    for item_id in sorted(state.items):
+        qty = state.items[item_id]
+        item_type = ITEM_TYPES_BY_ID.get(item_id)
+        if qty <= 0 or item_type is None:
+            continue
+        items.append(
+            {
+                "item_id": item_id,
+                "qty": qty,
+                "name_key": item_type["name_key"],
+                "description_key": item_type["description_key"],
+                "tags": item_type["tags"],
+            }
+        )
+    return items
 
 
-def _get_flags(user_id):
-    rows = db.fetch_all("SELECT flag FROM player_flags WHERE user_id = %s", [user_id])
-    return {row[0] for row in rows}
+# Snapshot keys that depend only on the layout, pre-encoded once per seed.
+_STATIC_SNAPSHOT_KEYS = ("width", "height", "tiles", "npcs")
 
 
-def _add_flag(user_id, flag):
-    return db.execute(
-        "INSERT IGNORE INTO player_flags (user_id, flag) VALUES (%s, %s)",
-        [user_id, flag],
-    )
+class TownSnapshot(PrerenderedDict):
+    """Snapshot dict whose layout-static parts are spliced in as cached bytes."""
+
+    def render_json(self, dumps):
+        config = generator_config()
+        static, events = _layout_fragments(layout_seed(self["seed"], config), config, dumps)
+        dynamic = {key: value for key, value in self.items() if key not in _STATIC_SNAPSHOT_KEYS and key != "events"}
+        return b"".join(
+            [
+                dumps(dynamic)[:-1],
+                b",",
+                static,
+                b',"events":[',
+                b",".join(events[event["event_id"]][event["state"] == "consumed"] for event in self["events"]),
+                b"]}",
+            ]
+        )
 
 
-def _get_items(user_id):
-    rows = db.fetch_dicts(
-        "SELECT pi.item_id, pi.qty, it.name_key, it.description_key, it.tags "
-        "FROM player_items pi JOIN item_types it ON pi.item_id = it.item_id "
-        "WHERE pi.user_id = %s AND pi.qty > 0 ORDER BY pi.item_id",
-        [user_id],
-    )
-    items = []
-    for row in rows:
-        items.append(
-            {
-                "item_id": row["item_id"],
-                "qty": int(row["qty"]),
-                "name_key": row["name_key"],
-                "description_key": row["description_key"],
-                "tags": row["tags"],
-            }
+# Layout caches are keyed by generator_config() as well as the seed, so a
+# changed generator setting never serves the old map under a new ETag.
+@lru_cache(maxsize=LAYOUT_CACHE_SIZE)
+def _layout_fragments(seed, config, dumps):
+    layout = get_layout(seed, config)
+    static = dumps({"width": layout.width, "height": layout.height, "tiles": layout.tiles, "npcs": layout.npcs})
+    events = {}
+    for event_id in layout.event_ids:
+        event = layout.events[event_id]
+        events[event_id] = tuple(
+            dumps({"event_id": event_id, "type": event["type"], "state": state, "pos": {"x": event["x"], "y": event["y"]}})
+            for state in ("available", "consumed")
         )
-    return items
+    return static[1:-1], events
 
 
-def _has_item(user_id, item_id, qty=1):
-    row = db.fetch_one(
-        "SELECT qty FROM player_items WHERE user_id = %s AND item_id = %s",
-        [user_id, item_id],
-    )
-    return bool(row and int(row[0]) >= qty)
+def layout_document(seed):
+    """Return ``(layout_hash, body)``: the static map for ``seed`` as JSON bytes.
+
+    The hash covers the body, so a URL carrying it can be cached forever.
+    """
+    config = generator_config()
+    return _layout_document(layout_seed(seed, config), config)
 
 
-def _grant_item(user_id, item_id, qty=1):
-    db.execute(
-        """
-        INSERT INTO player_items (user_id, item_id, qty)
-        VALUES (%s, %s, %s)
-        ON DUPLICATE KEY UPDATE qty = qty + VALUES(qty)
-        """,
-        [user_id, item_id, qty],
+@lru_cache(maxsize=LAYOUT_CACHE_SIZE)
+def _layout_document(seed, config):
+    layout = get_layout(seed, config)
+    body = renderers.dumps(
+        {
+            "width": layout.width,
+            "height": layout.height,
+            "tiles": layout.tiles,
+            "npcs": layout.npcs,
+            "events": [_layout_event(layout, event_id) for event_id in layout.event_ids],
+        }
     )
+    return hashlib.sha256(body).hexdigest()[:16], body
 
 
-def _consume_item(user_id, item_id, qty=1):
-    db.execute(
-        "UPDATE player_items SET qty = GREATEST(0, qty - %s) WHERE user_id = %s AND item_id = %s",
-        [qty, user_id, item_id],
-    )
+def _layout_event(layout, event_id):
+    event = layout.events[event_id]
+    return {
+        "event_id": event_id,
+        "type": event["type"],
+        "pos": {"x": event["x"], "y": event["y"]},
+        "repeatable": event.get("repeatable", False),
+    }
 
 
-def _get_dialog_index(user_id, npc_id):
-    row = db.fetch_one(
-        "SELECT node_index FROM npc_dialog_state WHERE user_id = %s AND npc_id = %s",
-        [user_id, npc_id],
-    )
-    return int(row[0]) if row else 0
+def is_town_layout_seed(seed):
+    """True if ``seed`` is the layout seed of an existing town.
 
+    The layout endpoints are public, so they only build maps for these seeds.
+    """
+    if generator_config()[0] == GENERATOR_CLASSIC:
+        return seed == CLASSIC_LAYOUT_SEED
+    return db.fetch_one("SELECT 1 FROM player_towns WHERE seed = %s LIMIT 1", [seed]) is not None
 
-def _set_dialog_index(user_id, npc_id, index):
-    db.execute(
-        """
-        INSERT INTO npc_dialog_state (user_id, npc_id, node_index)
-        VALUES (%s, %s, %s)
-        ON DUPLICATE KEY UPDATE node_index = VALUES(node_index)
-        """,
-        [user_id, npc_id, index],
-    )
 
+# Most chunks a single viewport request may ask for.
+MAX_VIEWPORT_CHUNKS = 64
 
-def _is_passable(x, y, tiles):
-    if x < 0 or y < 0 or y >= len(tiles) or x >= len(tiles[0]):
-        return False
-    return tiles[y][x] in PASSABLE_TILES
+CHUNK_CACHE_SIZE = 16384
 
 
-def _town_snapshot(user_id):
-    town = _ensure_player_town(user_id)
-    tiles = _build_tiles(town["seed"])
-    events = _event_catalog()
+@lru_cache(maxsize=CHUNK_CACHE_SIZE)
+def _chunk_document(seed, config, cx, cy):
+    layout = get_layout(seed, config)
+    return renderers.dumps(
+        {
+            "cx": cx,
+            "cy": cy,
+            "rows": [encode_row(row) for row in layout.chunk_rows(cx, cy)],
+            "npcs": layout.chunk_npcs.get((cx, cy), ()),
+            "events": [_layout_event(layout, event_id) for event_id in layout.chunk_events.get((cx, cy), ())],
+        }
+    )
 
-    consumed_rows = db.fetch_all(
-        "SELECT event_id FROM player_event_ledger WHERE user_id = %s",
-        [user_id],
+
+def viewport_document(seed, x, y, width, height):
+    """JSON bytes for every chunk overlapping a tile viewport; None if too large.
+
+    Each chunk carries run-length-encoded tile rows plus the NPCs and events
+    inside it, so the work and payload scale with the viewport, not the town.
+    """
+    config = generator_config()
+    layout = get_layout(seed, config)
+    chunks = layout.chunks_in(x, y, width, height)
+    if len(chunks) > MAX_VIEWPORT_CHUNKS:
+        return None
+    header = renderers.dumps(
+        {"seed": seed, "width": layout.width, "height": layout.height, "chunk_size": CHUNK_SIZE}
     )
-    consumed = {row[0] for row in consumed_rows}
+    parts = [header[:-1], b',"chunks":[', b",".join(_chunk_document(seed, config, cx, cy) for cx, cy in chunks), b"]}"]
+    return b"".join(parts)
+
+
+def state_view(snapshot):
+    """The per-player part of a snapshot; the map is fetched once by layout hash."""
+    seed = layout_seed(snapshot["seed"])
+    layout_hash, _ = layout_document(seed)
+    return {
+        "town_id": snapshot["town_id"],
+        "seed": snapshot["seed"],
+        "version": snapshot["version"],
+        "layout_hash": layout_hash,
+        "layout_path": f"town/layout/{seed}/{layout_hash}/",
+        "allowed_event_ids": snapshot["allowed_event_ids"],
+        "consumed_event_ids": [event["event_id"] for event in snapshot["events"] if event["state"] == "consumed"],
+        "player_state": snapshot["player_state"],
+    }
+
+
+def _state_snapshot(state):
+    layout = get_layout(state.seed)
+    consumed = state.consumed_event_ids()
 
     event_list = []
     allowed = []
-    for event in events.values():
-        is_consumed = (event["event_id"] in consumed) and (not event.get("repeatable", False))
-        state = "consumed" if is_consumed else "available"
+    for event_id in layout.event_ids:
+        event = layout.events[event_id]
+        is_consumed = (event_id in consumed) and (not event.get("repeatable", False))
+        state_name = "consumed" if is_consumed else "available"
         event_list.append(
             {
-                "event_id": event["event_id"],
+                "event_id": event_id,
                 "type": event["type"],
-                "state": state,
+                "state": state_name,
                 "pos": {"x": event["x"], "y": event["y"]},
             }
         )
-        if state == "available":
-            allowed.append(event["event_id"])
-
-    flags = sorted(_get_flags(user_id))
-    items = _get_items(user_id)
+        if state_name == "available":
+            allowed.append(event_id)
+
+    return TownSnapshot(
+        {
+            "town_id": state.town_id,
+            "seed": state.seed,
+            "width": layout.width,
+            "height": layout.height,
+            "tiles": layout.tiles,
+            "npcs": layout.npcs,
+            "events": event_list,
+            "allowed_event_ids": allowed,
+            "version": state.version,
+            "player_state": {
+                "flags": sorted(state.flags),
+                "items": _snapshot_items(state),
+            },
+        }
+    )
 
-    npcs = []
-    for npc in NPCS:
-        npcs.append(
-            {
-                "npc_id": npc["npc_id"],
-                "name_key": npc["name_key"],
-                "pos": {"x": npc["x"], "y": npc["y"]},
-                "event_ids": [f"talk_{npc['npc_id']}"] ,
-            }
-        )
 
-    return {
-        "town_id": town["town_id"],
-        "seed": town["seed"],
-        "width": TOWN_WIDTH,
-        "height": TOWN_HEIGHT,
-        "tiles": tiles,
-        "npcs": npcs,
-        "events": sorted(event_list, key=lambda e: e["event_id"]),
-        "allowed_event_ids": sorted(allowed),
-        "version": town["version"],
-        "player_state": {
-            "flags": flags,
-            "items": items,
-        },
-    }
+def _town_snapshot(user_id):
+    return _state_snapshot(PlayerState.load(user_id))
+
+
+def get_town_snapshot(user_id, min_version=0):
+    """The player's snapshot, at least at ``min_version``.
+
+    ``min_version`` is the last version this player wrote (read your own
+    writes); a replica that has not caught up to it is passed over for the
+    primary.
+    """
+    snapshot = cache.get_snapshot(user_id)
+    if snapshot is not None and snapshot["version"] >= min_version:
+        return snapshot
+    with db.read_replica() as replica:
+        snapshot = _town_snapshot(user_id)
+    if replica is not None:
+        if snapshot["version"] >= min_version:
+            # Only primary reads fill the cache, so a lagging replica can
+            # never become the cached version.
+            return snapshot
+        snapshot = _town_snapshot(user_id)
+    cache.add_snapshot(user_id, snapshot)
+    return snapshot
+
+
+def get_town_version(user_id, min_version=0):
+    version = cache.get_town_version(user_id)
+    if version is not None and version >= min_version:
+        return version
+    sql = "SELECT version FROM player_towns WHERE user_id = %s"
+    with db.read_replica() as replica:
+        row = db.fetch_one(sql, [user_id])
+    if replica is not None and (row is None or int(row[0]) < min_version):
+        row = db.fetch_one(sql, [user_id])
+    return int(row[0]) if row else None
+
+
+def response_version(body):
+    """The town version an event response leaves the client at, if it says."""
+    if "snapshot" in body:
+        return body["snapshot"]["version"]
+    if "patch" in body:
+        return body["patch"]["to_version"]
+    return None
 
 
-def get_town_snapshot(user_id):
-    return _town_snapshot(user_id)
+def town_etag(user_id, version):
+    # Bump SNAPSHOT_REVISION whenever a deploy changes snapshot contents for an
+    # unchanged version (layout, catalog or response shape), so cached copies
+    # are not revalidated as current. Switching town generator does so too.
+    generator = "/".join(str(part) for part in generator_config())
+    key = f"{SNAPSHOT_REVISION}:{generator}:{user_id}:{version}".encode("utf-8")
+    return f'"{hashlib.sha256(key).hexdigest()[:32]}"'
 
 
-def _bump_version(user_id):
-    db.execute(
-        "UPDATE player_towns SET version = version + 1 WHERE user_id = %s",
-        [user_id],
-    )
+# Longest movement trace accepted with one event, in steps.
+MAX_TRACE_STEPS = 512
 
+_TRACE = re.compile(r"(?:\d{1,4}[UDLR])*")
+_TRACE_RUN = re.compile(r"(\d+)([UDLR])")
+_STEPS = {"U": (0, -1), "D": (0, 1), "L": (-1, 0), "R": (1, 0)}
 
-def _record_event(user_id, event_id, result):
-    db.execute(
-        "INSERT INTO player_event_ledger (user_id, event_id, result_json) VALUES (%s, %s, %s)",
-        [user_id, event_id, json.dumps(result)],
-    )
 
+def _trace_cells(start, moves):
+    """Every tile a run-length move string (``"3R2D"``) visits from ``start``, or None.
 
-def _load_recorded_event(user_id, event_id):
-    row = db.fetch_one(
-        "SELECT result_json FROM player_event_ledger WHERE user_id = %s AND event_id = %s",
-        [user_id, event_id],
-    )
-    if not row:
+    Positions are running sums of the unit steps, so the whole trace is
+    expanded in one pass.
+    """
+    if not isinstance(moves, str) or not _TRACE.fullmatch(moves):
+        return None
+    runs = [(int(count), step) for count, step in _TRACE_RUN.findall(moves)]
+    # Checked before expanding, so a long string of big runs costs nothing.
+    if sum(count for count, _ in runs) > MAX_TRACE_STEPS:
         return None
-    return json.loads(row[0])
+    steps = "".join(step * count for count, step in runs)
+    xs = list(accumulate((_STEPS[step][0] for step in steps), initial=start[0]))
+    ys = list(accumulate((_STEPS[step][1] for step in steps), initial=start[1]))
+    return xs, ys
+
+
+def _validate_trace(trace, player, layout):
+    """A trace must start somewhere reachable, stay passable and end at ``player``."""
+    if not isinstance(trace, dict) or not isinstance(trace.get("start"), dict):
+        return False
+    try:
+        start = (int(trace["start"].get("x")), int(trace["start"].get("y")))
+    except (TypeError, ValueError):
+        return False
+    cells = _trace_cells(start, trace.get("moves", ""))
+    if cells is None:
+        return False
+    xs, ys = cells
+    if (xs[-1], ys[-1]) != player or not layout.reachable(*start):
+        return False
+    return all(map(layout.is_passable, xs, ys))
 
 
-def _validate_adjacency(event, payload, snapshot):
+def _validate_adjacency(event, payload, layout):
     player = payload.get("player_position") or {}
     target = payload.get("target_position") or {}
 
@@ -475,17 +460,23 @@ def _validate_adjacency(event, payload, snapshot):
     if abs(px - tx) + abs(py - ty) != 1:
         return False
 
-    if not _is_passable(px, py, snapshot["tiles"]):
+    # Connected components are precomputed per layout, so this is a lookup
+    # rather than a pathfind: a player walled off from the spawn is rejected.
+    if not layout.reachable(px, py):
+        return False
+
+    trace = payload.get("trace")
+    if trace is not None and not _validate_trace(trace, (px, py), layout):
         return False
 
     return True
 
 
-def _generic_npc_event(user_id, npc_id):
+def _generic_npc_event(state, npc_id):
     path = NPC_DIALOG_PATHS.get(npc_id, GENERIC_DIALOG)
-    idx = _get_dialog_index(user_id, npc_id)
+    idx = state.dialog_index(npc_id)
     node = path[idx % len(path)]
-    _set_dialog_index(user_id, npc_id, (idx + 1) % len(path))
+    state.set_dialog_index(npc_id, (idx + 1) % len(path))
     return {
         "message_key": f"dialog.{npc_id}.{node}",
         "flags_added": [],
@@ -493,186 +484,170 @@ def _generic_npc_event(user_id, npc_id):
     }
 
 
-def _special_npc_event(user_id, npc_id):
-    flags = _get_flags(user_id)
+def _execute_event(state, event):
+    result = quests.evaluate(quest_rules(), state, event["event_id"])
+    if result is not None:
+        return result
+    if event["type"] == "talk_npc":
+        return _generic_npc_event(state, event["npc_id"])
+    return {"message_key": "event.unknown", "flags_added": [], "items_added": []}
 
-    if npc_id == "npc_lyra":
-        if "herb_quest_started" not in flags:
-            _add_flag(user_id, "herb_quest_started")
-            return {
-                "message_key": "event.lyra.quest_start",
-                "flags_added": ["herb_quest_started"],
-                "items_added": [],
-            }
-        if "herb_collected" in flags and "herb_turned_in" not in flags and _has_item(user_id, "herb_bundle"):
-            _consume_item(user_id, "herb_bundle", 1)
-            _grant_item(user_id, "moon_badge", 1)
-            _add_flag(user_id, "herb_turned_in")
-            return {
-                "message_key": "event.lyra.quest_complete",
-                "flags_added": ["herb_turned_in"],
-                "items_added": ["moon_badge"],
-            }
-        if "herb_turned_in" in flags:
-            return {
-                "message_key": "event.lyra.after_quest",
-                "flags_added": [],
-                "items_added": [],
-            }
-        return {
-            "message_key": "event.lyra.quest_wait",
-            "flags_added": [],
-            "items_added": [],
-        }
 
-    if npc_id == "npc_borin":
-        if "iron_key_given" not in flags:
-            _grant_item(user_id, "iron_key", 1)
-            _add_flag(user_id, "iron_key_given")
-            return {
-                "message_key": "event.borin.key_given",
-                "flags_added": ["iron_key_given"],
-                "items_added": ["iron_key"],
-            }
-        return {"message_key": "event.borin.after", "flags_added": [], "items_added": []}
-
-    if npc_id == "npc_sable":
-        if "market_pass_given" in flags:
-            return {"message_key": "event.sable.after", "flags_added": [], "items_added": []}
-        if not _has_item(user_id, "iron_key"):
-            return {"message_key": "event.sable.needs_key", "flags_added": [], "items_added": []}
-        _grant_item(user_id, "market_pass", 1)
-        _add_flag(user_id, "market_pass_given")
-        return {
-            "message_key": "event.sable.pass_given",
-            "flags_added": ["market_pass_given"],
-            "items_added": ["market_pass"],
-        }
+def _client_state(snapshot, use_delta):
+    if use_delta:
+        return {"patch": delta.empty_patch(snapshot["version"])}
+    return {"snapshot": snapshot}
 
-    if npc_id == "npc_quill":
-        if "guild_task_done" in flags and "guild_seal_given" not in flags:
-            _grant_item(user_id, "guild_seal", 1)
-            _add_flag(user_id, "guild_seal_given")
-            return {
-                "message_key": "event.quill.task_complete",
-                "flags_added": ["guild_seal_given"],
-                "items_added": ["guild_seal"],
-            }
-        if "guild_task_started" not in flags:
-            _add_flag(user_id, "guild_task_started")
-            return {
-                "message_key": "event.quill.task_start",
-                "flags_added": ["guild_task_started"],
-                "items_added": [],
-            }
-        return {"message_key": "event.quill.task_wait", "flags_added": [], "items_added": []}
-
-    if npc_id == "npc_elowen":
-        if "cross_town_hint" not in flags:
-            _add_flag(user_id, "cross_town_hint")
-            return {
-                "message_key": "event.elowen.cross_town",
-                "flags_added": ["cross_town_hint"],
-                "items_added": [],
-            }
-        return {"message_key": "event.elowen.after", "flags_added": [], "items_added": []}
 
-    return None
+def apply_event(user_id, event_id, payload, client_version, use_delta=False):
+    # Optimistic concurrency: each attempt runs in one transaction and commits
+    # only if player_towns.version is still the one it loaded. A loser reloads
+    # and re-validates, which turns a duplicate submit into a 409 or an
+    # idempotent replay instead of a second grant.
+    for _ in range(EVENT_RETRY_LIMIT):
+        try:
+            with db.atomic():
+                return _apply_event_once(user_id, event_id, payload, client_version, use_delta)
+        except VersionConflict:
+            continue
+    return 409, {"error_code": "concurrent_update", "snapshot": _town_snapshot(user_id)}
 
 
-def _execute_event(user_id, event):
-    event_id = event["event_id"]
-    flags = []
-    items = []
+def apply_events(user_id, entries, client_version, use_delta=False):
+    """Apply ``[{"event_id", "payload"}, ...]`` in order against one base version.
 
-    if event["type"] == "talk_npc":
-        npc_id = event["npc_id"]
-        special = _special_npc_event(user_id, npc_id)
-        if special:
-            return special
-        return _generic_npc_event(user_id, npc_id)
-
-    if event_id == "read_sign_gate":
-        return {"message_key": "event.sign_gate", "flags_added": flags, "items_added": items}
-
-    if event_id == "read_sign_plaza":
-        return {"message_key": "event.sign_plaza", "flags_added": flags, "items_added": items}
-
-    if event_id == "enter_hall":
-        return {"message_key": "event.enter_hall", "flags_added": flags, "items_added": items}
-
-    if event_id == "enter_guild":
-        return {"message_key": "event.enter_guild", "flags_added": flags, "items_added": items}
-
-    current_flags = _get_flags(user_id)
-
-    if event_id == "open_chest_herb":
-        if "herb_collected" in current_flags:
-            return {"message_key": "event.chest_empty", "flags_added": [], "items_added": []}
-        _grant_item(user_id, "herb_bundle", 1)
-        _add_flag(user_id, "herb_collected")
-        return {
-            "message_key": "event.chest_herb_opened",
-            "flags_added": ["herb_collected"],
-            "items_added": ["herb_bundle"],
-        }
+    Same rules as apply_event, in one transaction with one version bump.
+    Processing stops at the first rejected entry; the entries before it stay
+    applied, and the response reports each entry plus the final state.
+    """
+    for _ in range(EVENT_RETRY_LIMIT):
+        try:
+            with db.atomic():
+                return _apply_events_once(user_id, entries, client_version, use_delta)
+        except VersionConflict:
+            continue
+    return 409, {"error_code": "concurrent_update", "snapshot": _town_snapshot(user_id)}
 
-    if event_id == "open_chest_archive":
-        if "guild_task_started" not in current_flags:
-            return {"message_key": "event.archive_locked", "flags_added": [], "items_added": []}
-        if "guild_task_done" in current_flags:
-            return {"message_key": "event.chest_empty", "flags_added": [], "items_added": []}
-        _grant_item(user_id, "sun_ribbon", 1)
-        _add_flag(user_id, "guild_task_done")
-        return {
-            "message_key": "event.archive_found",
-            "flags_added": ["guild_task_done"],
-            "items_added": ["sun_ribbon"],
-        }
 
-    return {"message_key": "event.unknown", "flags_added": [], "items_added": []}
+def _check_version(user_id, snapshot, client_version, use_delta):
+    """Return an error response if ``client_version`` is not current, else None."""
+    try:
+        client_version = int(client_version)
+    except (TypeError, ValueError):
+        return 400, {"error_code": "bad_version"}
+    if client_version != snapshot["version"]:
+        patch = None
+        if use_delta:
+            patch = delta.load_patch(user_id, client_version, snapshot["version"])
+        if patch is not None:
+            return 409, {"error_code": "stale_client", "patch": patch}
+        return 409, {"error_code": "stale_client", "snapshot": snapshot}
+    return None
 
 
-def apply_event(user_id, event_id, payload, client_version):
-    snapshot = _town_snapshot(user_id)
+def _run_event(state, snapshot, event_id, payload):
+    """Validate and execute one event against loaded state.
 
-    if client_version is not None:
-        try:
-            client_version = int(client_version)
-        except (TypeError, ValueError):
-            return 400, {"error_code": "bad_version"}
-        if client_version != snapshot["version"]:
-            return 409, {"error_code": "stale_client", "snapshot": snapshot}
-
-    events = _event_catalog()
-    event = events.get(event_id)
+    Returns ``(status, body)``: body carries ``error_code`` on rejection,
+    otherwise ``event_result`` and whether it was an idempotent replay.
+    """
+    layout = get_layout(snapshot["seed"])
+    event = layout.events.get(event_id)
     if not event:
         return 404, {"error_code": "unknown_event"}
 
     if event_id not in snapshot["allowed_event_ids"]:
-        recorded = _load_recorded_event(user_id, event_id)
+        recorded = state.recorded_event(event_id)
         if recorded is not None:
-            return 200, {"event_id": event_id, "idempotent": True, "event_result": recorded, "snapshot": snapshot}
-        return 400, {"error_code": "event_not_allowed", "snapshot": snapshot}
+            return 200, {"event_id": event_id, "idempotent": True, "event_result": recorded}
+        return 400, {"error_code": "event_not_allowed"}
 
-    if not _validate_adjacency(event, payload, snapshot):
-        return 400, {"error_code": "invalid_position", "snapshot": snapshot}
+    if not _validate_adjacency(event, payload, layout):
+        return 400, {"error_code": "invalid_position"}
 
-    recorded = _load_recorded_event(user_id, event_id)
+    recorded = state.recorded_event(event_id)
     if recorded is not None and not event.get("repeatable", False):
-        return 200, {"event_id": event_id, "idempotent": True, "event_result": recorded, "snapshot": snapshot}
+        return 200, {"event_id": event_id, "idempotent": True, "event_result": recorded}
 
-    result = _execute_event(user_id, event)
+    result = _execute_event(state, event)
 
     if not event.get("repeatable", False):
-        _record_event(user_id, event_id, result)
+        state.record_event(event_id, result)
+    return 200, {"event_id": event_id, "idempotent": False, "event_result": result}
 
-    _bump_version(user_id)
-    fresh = _town_snapshot(user_id)
 
-    return 200, {
-        "event_id": event_id,
-        "idempotent": False,
-        "event_result": result,
-        "snapshot": fresh,
-    }
+def _commit_state(user_id, state, snapshot):
+    """Flush a changed state; return its fresh snapshot and the patch from ``snapshot``."""
+    state.bump_version()
+    state.flush()
+    fresh = _state_snapshot(state)
+    patch = delta.snapshot_patch(snapshot, fresh)
+    delta.record_patch(user_id, patch)
+
+    # Drop the pointer now so no reader is served the old version, and
+    # publish the new snapshot only once it is durable.
+    cache.invalidate_town(user_id)
+    db.on_commit(lambda: cache.store_snapshot(user_id, fresh))
+    return fresh, patch
+
+
+def _apply_event_once(user_id, event_id, payload, client_version, use_delta):
+    state = PlayerState.load(user_id)
+    snapshot = _state_snapshot(state)
+
+    if client_version is not None:
+        rejected = _check_version(user_id, snapshot, client_version, use_delta)
+        if rejected is not None:
+            return rejected
+    else:
+        # Without a base version there is nothing to patch against.
+        use_delta = False
+
+    http_status, body = _run_event(state, snapshot, event_id, payload)
+    if http_status == 404:
+        return http_status, body
+    if "error_code" in body or body["idempotent"]:
+        return http_status, {**body, **_client_state(snapshot, use_delta)}
+
+    fresh, patch = _commit_state(user_id, state, snapshot)
+    if use_delta:
+        body["patch"] = patch
+    else:
+        body["snapshot"] = fresh
+    return 200, body
+
+
+def _apply_events_once(user_id, entries, client_version, use_delta):
+    state = PlayerState.load(user_id)
+    snapshot = _state_snapshot(state)
+
+    if client_version is not None:
+        rejected = _check_version(user_id, snapshot, client_version, use_delta)
+        if rejected is not None:
+            return rejected
+    else:
+        use_delta = False
+
+    results = []
+    current = snapshot
+    changed = False
+    for entry in entries:
+        http_status, body = _run_event(state, current, entry["event_id"], entry["payload"])
+        if "error_code" in body:
+            results.append({"event_id": entry["event_id"], "status": http_status, **body})
+            break
+        results.append({"status": http_status, **body})
+        if not body["idempotent"]:
+            changed = True
+            # The next entry is checked against what this one unlocked.
+            current = _state_snapshot(state)
+
+    response = {"results": results, "applied": sum(1 for result in results if "error_code" not in result)}
+    if not changed:
+        return 200, {**response, **_client_state(snapshot, use_delta)}
+    fresh, patch = _commit_state(user_id, state, snapshot)
+    if use_delta:
+        response["patch"] = patch
+    else:
+        response["snapshot"] = fresh
+    return 200, response
@@ -1,9 +1,26 @@
+from django.conf import settings
 from django.urls import path
 from . import views
 
+# Under ASGI, GAME_ASYNC_VIEWS serves the user and town endpoints from their
+# async versions; the URLs and responses are the same.
+if settings.GAME_ASYNC_VIEWS:
+    user_views = (views.aget_or_create_user, views.aadd_points)
+    town_views = (views.aget_town, views.aget_town_state, views.atrigger_town_event, views.atrigger_town_events)
+else:
+    user_views = (views.get_or_create_user, views.add_points)
+    town_views = (views.get_town, views.get_town_state, views.trigger_town_event, views.trigger_town_events)
+
 urlpatterns = [
-    path('user/me/', views.get_or_create_user, name='get_or_create_user'),
-    path('user/me/points/', views.add_points, name='add_points'),
-    path('town/', views.get_town, name='get_town'),
-    path('town/event/', views.trigger_town_event, name='trigger_town_event'),
+    path('user/me/', user_views[0], name='get_or_create_user'),
+    path('user/me/points/', user_views[1], name='add_points'),
+    path('town/', town_views[0], name='get_town'),
+    path('town/state/', town_views[1], name='get_town_state'),
+    path('town/layout/<int:seed>/', views.get_town_layout, name='get_town_layout'),
+    path('town/layout/<int:seed>/chunks/', views.get_town_chunks, name='get_town_chunks'),
+    path('town/layout/<int:seed>/<str:layout_hash>/', views.get_town_layout, name='get_town_layout_hashed'),
+    path('town/event/', town_views[2], name='trigger_town_event'),
+    path('town/events/', town_views[3], name='trigger_town_events'),
+    path('content/manifest/', views.get_content_manifest, name='get_content_manifest'),
+    path('content/<str:filename>', views.get_content_bundle, name='get_content_bundle'),
 ]
@@ -1,74 +1,352 @@
+import hashlib
+import json
+
+from django.http import Http404, HttpResponse, HttpResponseNotModified, JsonResponse
+from django.utils.http import parse_etags
+from django.views.decorators.cache import cache_control
 from django.views.decorators.csrf import ensure_csrf_cookie
+from django.views.decorators.http import condition, require_GET, require_POST
 from rest_framework import status
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 
 from . import town
+from . import cache
+from . import content
 from . import db
+from . import renderers
+from . import schema
+from .sessions import TOWN_VERSION_KEY
+
+# For URLs that carry a hash of their body, which therefore never changes.
+IMMUTABLE_MAX_AGE = 60 * 60 * 24 * 365
 
 
-def _require_user(request):
-    town.ensure_schema()
-    user_id, created = town.get_or_create_user(request.session)
+def _require_user(session):
+    schema.require_current()
+    user_id, created = town.get_or_create_user(session)
     return user_id, created
 
 
-@api_view(["GET"])
-@ensure_csrf_cookie
-def get_or_create_user(request):
-    user_id, created = _require_user(request)
+# Endpoint bodies shared by the sync views and their async versions below.
+# Each takes the session plus parsed request data and returns (status, body).
+
+
+def _user_me(session):
+    user_id, created = _require_user(session)
     data = town.user_data(user_id)
     if not data:
-        return Response({"error_code": "user_lookup_failed"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-    code = status.HTTP_201_CREATED if created else status.HTTP_200_OK
-    return Response(data, status=code)
+        return status.HTTP_500_INTERNAL_SERVER_ERROR, {"error_code": "user_lookup_failed"}
+    return (status.HTTP_201_CREATED if created else status.HTTP_200_OK), data
 
 
-@api_view(["POST"])
-def add_points(request):
-    user_id = request.session.get("user_id")
+def _add_points(session, data):
+    user_id = session.get("user_id")
     if not user_id:
-        return Response({"error_code": "no_session"}, status=status.HTTP_401_UNAUTHORIZED)
+        return status.HTTP_401_UNAUTHORIZED, {"error_code": "no_session"}
 
-    amount = request.data.get("amount", 1)
+    amount = data.get("amount", 1)
     try:
         amount = int(amount)
     except (TypeError, ValueError):
-        return Response({"error_code": "amount_not_integer"}, status=status.HTTP_400_BAD_REQUEST)
+        return status.HTTP_400_BAD_REQUEST, {"error_code": "amount_not_integer"}
 
     if amount < 1:
-        return Response({"error_code": "amount_must_be_positive"}, status=status.HTTP_400_BAD_REQUEST)
+        return status.HTTP_400_BAD_REQUEST, {"error_code": "amount_must_be_positive"}
 
-    town.ensure_schema()
+    schema.require_current()
     rows = db.execute("UPDATE players SET points = points + %s WHERE user_id = %s", [amount, user_id])
     if rows == 0:
-        return Response({"error_code": "user_not_found"}, status=status.HTTP_404_NOT_FOUND)
+        return status.HTTP_404_NOT_FOUND, {"error_code": "user_not_found"}
+    cache.invalidate_user(user_id)
+
+    return status.HTTP_200_OK, town.user_data(user_id)
+
+
+def _event(session, data):
+    user_id = session.get("user_id")
+    if not user_id:
+        return status.HTTP_401_UNAUTHORIZED, {"error_code": "no_session"}
+
+    event_id = data.get("event_id")
+    payload = data.get("payload") or {}
+    version = data.get("version")
+    use_delta = bool(data.get("delta"))
+
+    if not event_id:
+        return status.HTTP_400_BAD_REQUEST, {"error_code": "event_id_required"}
+
+    schema.require_current()
+    return _remember_version(session, *town.apply_event(user_id, event_id, payload, version, use_delta=use_delta))
+
+
+def _events(session, data):
+    user_id = session.get("user_id")
+    if not user_id:
+        return status.HTTP_401_UNAUTHORIZED, {"error_code": "no_session"}
+
+    events = data.get("events")
+    version = data.get("version")
+    use_delta = bool(data.get("delta"))
+
+    if not isinstance(events, list) or not events:
+        return status.HTTP_400_BAD_REQUEST, {"error_code": "events_required"}
+    if len(events) > town.MAX_BATCH_EVENTS:
+        return status.HTTP_400_BAD_REQUEST, {"error_code": "batch_too_large"}
+    entries = []
+    for entry in events:
+        if not isinstance(entry, dict) or not entry.get("event_id"):
+            return status.HTTP_400_BAD_REQUEST, {"error_code": "event_id_required"}
+        entries.append({"event_id": entry["event_id"], "payload": entry.get("payload") or {}})
+
+    schema.require_current()
+    return _remember_version(session, *town.apply_events(user_id, entries, version, use_delta=use_delta))
 
-    data = town.user_data(user_id)
-    return Response(data)
+
+def _remember_version(session, code, body):
+    # Replica reads for this player must catch up to what they have seen
+    # written (town.get_town_snapshot). Re-signs the cookie once per change.
+    version = town.response_version(body)
+    if version is not None and version > session.get(TOWN_VERSION_KEY, 0):
+        session[TOWN_VERSION_KEY] = version
+    return code, body
+
+
+def _min_version(session, query=None):
+    # The newest version this player wrote over HTTP, or a newer one the
+    # client presents as ?min_version= (socket writes never reach the cookie).
+    try:
+        presented = int((query or {}).get("min_version", 0))
+    except ValueError:
+        presented = 0
+    return max(session.get(TOWN_VERSION_KEY, 0), presented)
 
 
 @api_view(["GET"])
 @ensure_csrf_cookie
-def get_town(request):
-    user_id, _ = _require_user(request)
-    snapshot = town.get_town_snapshot(user_id)
-    return Response(snapshot)
+def get_or_create_user(request):
+    code, data = _user_me(request.session)
+    return Response(data, status=code)
 
 
 @api_view(["POST"])
-def trigger_town_event(request):
-    user_id = request.session.get("user_id")
+def add_points(request):
+    code, data = _add_points(request.session, request.data)
+    return Response(data, status=code)
+
+
+def _current_town_etag(session, query=None):
+    user_id = session.get("user_id")
     if not user_id:
-        return Response({"error_code": "no_session"}, status=status.HTTP_401_UNAUTHORIZED)
+        return None
+    schema.require_current()
+    version = town.get_town_version(user_id, _min_version(session, query))
+    if version is None:
+        return None
+    return town.town_etag(user_id, version)
 
-    event_id = request.data.get("event_id")
-    payload = request.data.get("payload") or {}
-    version = request.data.get("version")
 
-    if not event_id:
-        return Response({"error_code": "event_id_required"}, status=status.HTTP_400_BAD_REQUEST)
+def _town_etag(request):
+    return _current_town_etag(request.session, request.GET)
+
+
+@api_view(["GET"])
+@ensure_csrf_cookie
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=_town_etag)
+def get_town(request):
+    user_id, _ = _require_user(request.session)
+    snapshot = town.get_town_snapshot(user_id, _min_version(request.session, request.GET))
+    return Response(snapshot, headers={"ETag": town.town_etag(user_id, snapshot["version"])})
+
+
+@api_view(["GET"])
+@ensure_csrf_cookie
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=_town_etag)
+def get_town_state(request):
+    user_id, _ = _require_user(request.session)
+    snapshot = town.get_town_snapshot(user_id, _min_version(request.session, request.GET))
+    return Response(town.state_view(snapshot), headers={"ETag": town.town_etag(user_id, snapshot["version"])})
+
+
+# Seeds are 48-bit (see state._create_town); anything larger is not a town.
+MAX_SEED = 1 << 48
 
-    town.ensure_schema()
-    http_status, body = town.apply_event(user_id, event_id, payload, version)
+
+def _known_layout(seed):
+    return seed < MAX_SEED and town.is_town_layout_seed(seed)
+
+
+def _layout_etag(request, seed, layout_hash=None):
+    if not _known_layout(seed):
+        return None
+    return f'"{town.layout_document(seed)[0]}"'
+
+
+@require_GET
+@condition(etag_func=_layout_etag)
+def get_town_layout(request, seed, layout_hash=None):
+    if not _known_layout(seed):
+        raise Http404("unknown town layout")
+    current_hash, body = town.layout_document(seed)
+    if layout_hash is not None and layout_hash != current_hash:
+        # A hash from before a layout change; the client must re-read its state.
+        raise Http404("stale town layout")
+    response = HttpResponse(body, content_type="application/json")
+    if layout_hash is None:
+        response["Cache-Control"] = "public, no-cache"
+    else:
+        response["Cache-Control"] = f"public, max-age={IMMUTABLE_MAX_AGE}, immutable"
+    return response
+
+
+@require_GET
+def get_town_chunks(request, seed):
+    try:
+        viewport = [int(request.GET[name]) for name in ("x", "y", "w", "h")]
+    except (KeyError, ValueError):
+        return JsonResponse({"error_code": "bad_viewport"}, status=status.HTTP_400_BAD_REQUEST)
+    if viewport[2] <= 0 or viewport[3] <= 0:
+        return JsonResponse({"error_code": "bad_viewport"}, status=status.HTTP_400_BAD_REQUEST)
+    if not _known_layout(seed):
+        raise Http404("unknown town layout")
+    body = town.viewport_document(seed, *viewport)
+    if body is None:
+        return JsonResponse({"error_code": "viewport_too_large"}, status=status.HTTP_400_BAD_REQUEST)
+    etag = f'"{hashlib.sha256(body).hexdigest()[:16]}"'
+    if_none_match = request.headers.get("If-None-Match", "")
+    if etag in parse_etags(if_none_match) or if_none_match.strip() == "*":
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(body, content_type="application/json")
+    response["ETag"] = etag
+    response["Cache-Control"] = "public, no-cache"
+    return response
+
+
+@api_view(["POST"])
+def trigger_town_event(request):
+    http_status, body = _event(request.session, request.data)
     return Response(body, status=http_status)
+
+
+@api_view(["POST"])
+def trigger_town_events(request):
+    http_status, body = _events(request.session, request.data)
+    return Response(body, status=http_status)
+
+
+def _manifest_etag(request):
+    manifest = content.manifest()
+    return f'"{manifest["release"]}"' if manifest else None
+
+
+@api_view(["GET"])
+@cache_control(public=True, no_cache=True)
+@condition(etag_func=_manifest_etag)
+def get_content_manifest(request):
+    manifest = content.manifest()
+    if manifest is None:
+        return Response({"error_code": "content_not_built"}, status=status.HTTP_404_NOT_FOUND)
+    return Response(manifest)
+
+
+@require_GET
+def get_content_bundle(request, filename):
+    found = content.bundle(filename, request.headers.get("Accept-Encoding"))
+    if found is None:
+        raise Http404("unknown content bundle")
+    body, encoding = found
+    response = HttpResponse(body, content_type="application/json; charset=utf-8")
+    if encoding:
+        response["Content-Encoding"] = encoding
+    response["Vary"] = "Accept-Encoding"
+    response["Cache-Control"] = f"public, max-age={IMMUTABLE_MAX_AGE}, immutable"
+    return response
+
+
+# Async versions of the user and town endpoints, routed instead of the views
+# above when GAME_ASYNC_VIEWS is on (ASGI deployments). Each request's DB work
+# runs as one unit on a game.db worker thread, so a worker process keeps many
+# requests waiting on MySQL without holding a thread per request. They
+# accept JSON bodies only.
+
+
+def _json_response(body, code=status.HTTP_200_OK):
+    return HttpResponse(renderers.render(body), status=code, content_type="application/json")
+
+
+def _json_body(request):
+    try:
+        data = json.loads(request.body or b"{}")
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def _town_unless_current(session, query, if_none_match, view):
+    """``(body, etag)``; body is None when the client's ETag is still current."""
+    etag = _current_town_etag(session, query)
+    if etag is not None and (etag in parse_etags(if_none_match) or if_none_match.strip() == "*"):
+        return None, etag
+    user_id, _ = _require_user(session)
+    snapshot = town.get_town_snapshot(user_id, _min_version(session, query))
+    return view(snapshot), town.town_etag(user_id, snapshot["version"])
+
+
+async def _conditional_town(request, view):
+    body, etag = await db.arun(
+        _town_unless_current, request.session, request.GET, request.headers.get("If-None-Match", ""), view
+    )
+    response = HttpResponseNotModified() if body is None else _json_response(body)
+    response["ETag"] = etag
+    return response
+
+
+@require_GET
+@ensure_csrf_cookie
+async def aget_or_create_user(request):
+    code, data = await db.arun(_user_me, request.session)
+    return _json_response(data, code)
+
+
+@require_POST
+async def aadd_points(request):
+    data = _json_body(request)
+    if data is None:
+        return _json_response({"error_code": "invalid_json"}, status.HTTP_400_BAD_REQUEST)
+    code, body = await db.arun(_add_points, request.session, data)
+    return _json_response(body, code)
+
+
+@require_GET
+@ensure_csrf_cookie
+@cache_control(private=True, no_cache=True)
+async def aget_town(request):
+    return await _conditional_town(request, lambda snapshot: snapshot)
+
+
+@require_GET
+@ensure_csrf_cookie
+@cache_control(private=True, no_cache=True)
+async def aget_town_state(request):
+    return await _conditional_town(request, town.state_view)
+
+
+@require_POST
+async def atrigger_town_event(request):
+    data = _json_body(request)
+    if data is None:
+        return _json_response({"error_code": "invalid_json"}, status.HTTP_400_BAD_REQUEST)
+    code, body = await db.arun(_event, request.session, data)
+    return _json_response(body, code)
+
+
+@require_POST
+async def atrigger_town_events(request):
+    data = _json_body(request)
+    if data is None:
+        return _json_response({"error_code": "invalid_json"}, status.HTTP_400_BAD_REQUEST)
+    code, body = await db.arun(_events, request.session, data)
+    return _json_response(body, code)
@@ -0,0 +1,135 @@
+import json
+import logging
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.http import parse_cookie
+from django.http.request import split_domain_port, validate_host
+
+from . import db
+from . import renderers
+from . import schema
+from . import town
+from . import views
+from .sessions import SessionStore
+
+# Town events over one WebSocket per player, served next to Django's ASGI app
+# (config.asgi). The handshake authenticates the session cookie once; after
+# that each text message is one event (or batch) with the same fields as
+# POST /api/town/event/ (/events/), answered on the same socket:
+#
+#   -> {"id": 1, "event_id": "open_chest_herb", "payload": {...}}
+#   <- {"id": 1, "status": 200, "event_id": ..., "event_result": ..., "patch": ...}
+#
+# Replies default to patches ("delta": true) and "version" defaults to the
+# last version this socket sent the client, so a client that applies every
+# patch never has to echo it. Messages are handled one at a time, in order.
+# Socket writes cannot update the session cookie, so a client that later
+# reads GET /api/town/ (or state/) passes the last version it received as
+# ?min_version= to keep replica reads from going back past it.
+
+SOCKET_PATH = "/api/town/ws/"
+MAX_MESSAGE_BYTES = 64 * 1024
+
+# Close codes. Refused handshakes reach the browser as HTTP 403 instead.
+CLOSE_TOO_BIG = 1009
+CLOSE_SERVER_ERROR = 1011
+
+logger = logging.getLogger(__name__)
+
+
+def application(http_application):
+    """Wrap Django's ASGI app so WebSocket connections go to the town socket."""
+
+    async def app(scope, receive, send):
+        if scope["type"] == "websocket":
+            return await town_socket(scope, receive, send)
+        return await http_application(scope, receive, send)
+
+    return app
+
+
+def _headers(scope):
+    return {name.decode("latin-1"): value.decode("latin-1") for name, value in scope.get("headers", ())}
+
+
+def _path(scope):
+    path = scope.get("path", "")
+    root_path = scope.get("root_path", "")
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path) :]
+    return path
+
+
+def _origin_allowed(headers):
+    # Browsers send cookies with cross-site WebSocket handshakes and there is
+    # no CSRF token, so the Origin check is the CSRF protection here.
+    host = headers.get("host", "")
+    domain, _ = split_domain_port(host)
+    if not domain or not validate_host(domain, settings.ALLOWED_HOSTS):
+        return False
+    origin = headers.get("origin")
+    if not origin:
+        return False
+    if origin in settings.CSRF_TRUSTED_ORIGINS:
+        return True
+    return urlsplit(origin).netloc == host
+
+
+async def _session_user(headers):
+    cookie = parse_cookie(headers.get("cookie", "")).get(settings.SESSION_COOKIE_NAME)
+    if not cookie:
+        return None
+    session = SessionStore(cookie)
+    return await session.aget("user_id")
+
+
+def _handle(session, message, version):
+    data = {"version": version, "delta": True, **message}
+    if "events" in data:
+        return views._events(session, data)
+    return views._event(session, data)
+
+
+async def town_socket(scope, receive, send):
+    message = await receive()
+    if message["type"] != "websocket.connect":
+        return
+    headers = _headers(scope)
+    user_id = None
+    if _path(scope) == SOCKET_PATH and _origin_allowed(headers):
+        user_id = await _session_user(headers)
+    if not user_id:
+        await send({"type": "websocket.close"})
+        return
+    await db.arun(schema.require_current)
+    await send({"type": "websocket.accept"})
+
+    session = {"user_id": user_id}
+    version = None
+    while True:
+        message = await receive()
+        if message["type"] == "websocket.disconnect":
+            return
+        if message["type"] != "websocket.receive":
+            continue
+        raw = message.get("text") if message.get("text") is not None else message.get("bytes") or b""
+        if len(raw) > MAX_MESSAGE_BYTES:
+            await send({"type": "websocket.close", "code": CLOSE_TOO_BIG})
+            return
+        try:
+            data = json.loads(raw)
+        except ValueError:
+            data = None
+        if not isinstance(data, dict):
+            reply = {"status": 400, "error_code": "invalid_json"}
+        else:
+            try:
+                code, body = await db.arun(_handle, session, data, version)
+            except Exception:
+                logger.exception("town socket event failed for user %s", user_id)
+                await send({"type": "websocket.close", "code": CLOSE_SERVER_ERROR})
+                return
+            version = town.response_version(body) or version
+            reply = {"id": data.get("id"), "status": code, **body}
+        await send({"type": "websocket.send", "text": renderers.render(reply).decode("utf-8")})
@@ -0,0 +1,276 @@
+"""Headless load generator for the town API.
+
+Each simulated player gets its own anonymous session via /api/user/me/,
+fetches /api/town/, walks the Lyra -> herb chest -> Borin -> Sable -> Quill
+-> archive chain with adjacency payloads derived from the snapshot, and
+mixes in generic NPC chatter. Point it at a local server:
+
+    DJANGO_DEBUG=True python manage.py runserver          # in backend/
+    python3 scripts/load_test.py --players 50 --concurrency 10
+
+Against a non-DEBUG server add --assume-https so requests look like they came
+through the TLS proxy (no SSL redirect, CSRF referer check satisfied).
+"""
+
+import argparse
+import json
+import math
+import random
+import re
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.cookies import SimpleCookie
+
+PASSABLE_TILES = {"G", "P", "B"}
+
+QUEST_CHAIN = [
+    "talk_npc_lyra",
+    "open_chest_herb",
+    "talk_npc_lyra",
+    "talk_npc_borin",
+    "talk_npc_sable",
+    "talk_npc_quill",
+    "open_chest_archive",
+    "talk_npc_quill",
+]
+
+QUEST_NPCS = {"npc_lyra", "npc_borin", "npc_sable", "npc_quill", "npc_elowen"}
+
+QUERIES_RE = re.compile(r"queries=(\d+)")
+
+
+class Stats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self.queries = []
+        self.errors = 0
+
+    def record(self, endpoint, status, elapsed_ms, server_timing):
+        match = QUERIES_RE.search(server_timing or "")
+        with self._lock:
+            self.latencies[endpoint].append(elapsed_ms)
+            self.statuses[endpoint][status] += 1
+            if match:
+                self.queries.append(int(match.group(1)))
+
+    def record_error(self):
+        with self._lock:
+            self.errors += 1
+
+
+class Player:
+    def __init__(self, base_url, stats, assume_https, use_delta):
+        self.base_url = base_url.rstrip("/")
+        self.stats = stats
+        self.assume_https = assume_https
+        self.use_delta = use_delta
+        self.cookies = {}
+        self.snapshot = None
+        self.version = None
+
+    def _request(self, method, path, endpoint, body=None):
+        url = f"{self.base_url}{path}"
+        data = json.dumps(body).encode("utf-8") if body is not None else None
+        request = urllib.request.Request(url, data=data, method=method)
+        request.add_header("Accept", "application/json")
+        if data is not None:
+            request.add_header("Content-Type", "application/json")
+        if self.cookies:
+            # Cookies are tracked by hand: the session and CSRF cookies are
+            # marked Secure, which http.cookiejar refuses to send over http.
+            request.add_header("Cookie", "; ".join(f"{k}={v}" for k, v in self.cookies.items()))
+        csrf = next((v for k, v in self.cookies.items() if k.endswith("csrf")), None)
+        if method == "POST" and csrf:
+            request.add_header("X-CSRFToken", csrf)
+        if self.assume_https:
+            request.add_header("X-Forwarded-Proto", "https")
+            request.add_header("Referer", f"https://{request.host}/")
+
+        started = time.perf_counter()
+        try:
+            response = urllib.request.urlopen(request, timeout=30)
+        except urllib.error.HTTPError as exc:
+            response = exc
+        except OSError:
+            self.stats.record_error()
+            return None, None
+        with response:
+            raw = response.read()
+            status = response.status if hasattr(response, "status") else response.code
+            headers = response.headers
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.stats.record(endpoint, status, elapsed_ms, headers.get("Server-Timing"))
+
+        for header in headers.get_all("Set-Cookie") or []:
+            parsed = SimpleCookie()
+            parsed.load(header)
+            for name, morsel in parsed.items():
+                self.cookies[name] = morsel.value
+        try:
+            return status, json.loads(raw) if raw else {}
+        except ValueError:
+            return status, {}
+
+    def login(self):
+        status, _ = self._request("GET", "/user/me/", "GET /api/user/me/")
+        return status in (200, 201)
+
+    def load_town(self):
+        status, body = self._request("GET", "/town/", "GET /api/town/")
+        if status == 200:
+            self.snapshot = body
+            self.version = body["version"]
+        return status == 200
+
+    def _positions(self, event_id):
+        events = {event["event_id"]: event for event in self.snapshot["events"]}
+        target = events[event_id]["pos"]
+        occupied = {(npc["pos"]["x"], npc["pos"]["y"]) for npc in self.snapshot["npcs"]}
+        tiles = self.snapshot["tiles"]
+        for dx, dy in ((0, -1), (0, 1), (-1, 0), (1, 0)):
+            x, y = target["x"] + dx, target["y"] + dy
+            if 0 <= y < len(tiles) and 0 <= x < len(tiles[y]):
+                if tiles[y][x] in PASSABLE_TILES and (x, y) not in occupied:
+                    return {"x": x, "y": y}, target
+        return None, target
+
+    def trigger(self, event_id):
+        player, target = self._positions(event_id)
+        if player is None:
+            return None
+        body = {
+            "event_id": event_id,
+            "version": self.version,
+            "payload": {"player_position": player, "target_position": target},
+        }
+        if self.use_delta:
+            body["delta"] = True
+        status, data = self._request("POST", "/town/event/", "POST /api/town/event/", body)
+        if data is None:
+            return status
+        if "snapshot" in data:
+            self.snapshot = data["snapshot"]
+            self.version = data["snapshot"]["version"]
+        elif "patch" in data:
+            self.version = data["patch"]["to_version"]
+        return status
+
+    def chatter_targets(self):
+        return [
+            f"talk_{npc['npc_id']}" for npc in self.snapshot["npcs"] if npc["npc_id"] not in QUEST_NPCS
+        ]
+
+
+def run_player(args, stats, rng_seed):
+    rng = random.Random(rng_seed)
+    player = Player(args.base_url, stats, args.assume_https, args.delta)
+    if not player.login() or not player.load_town():
+        return
+    chatter = player.chatter_targets()
+    for _ in range(args.rounds):
+        for event_id in QUEST_CHAIN:
+            while chatter and rng.random() < args.chatter:
+                player.trigger(rng.choice(chatter))
+            player.trigger(event_id)
+        player.load_town()
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summarize(stats, wall_seconds):
+    total = sum(len(values) for values in stats.latencies.values())
+    report = {
+        "requests": total,
+        "errors": stats.errors,
+        "wall_seconds": round(wall_seconds, 3),
+        "requests_per_second": round(total / wall_seconds, 1) if wall_seconds else 0.0,
+        "queries_per_request": round(sum(stats.queries) / len(stats.queries), 2) if stats.queries else None,
+        "endpoints": {},
+    }
+    for endpoint, values in sorted(stats.latencies.items()):
+        statuses = stats.statuses[endpoint]
+        count = len(values)
+        report["endpoints"][endpoint] = {
+            "count": count,
+            "p50_ms": round(percentile(values, 50), 2),
+            "p95_ms": round(percentile(values, 95), 2),
+            "p99_ms": round(percentile(values, 99), 2),
+            "rate_400": round(statuses.get(400, 0) / count, 4),
+            "rate_409": round(statuses.get(409, 0) / count, 4),
+            "statuses": dict(sorted(statuses.items())),
+        }
+    return report
+
+
+def print_report(report):
+    print(
+        f"{report['requests']} requests in {report['wall_seconds']}s "
+        f"= {report['requests_per_second']} req/s, errors={report['errors']}, "
+        f"queries/request={report['queries_per_request']}"
+    )
+    print(f"{'endpoint':<24} {'count':>7} {'p50':>9} {'p95':>9} {'p99':>9} {'400%':>7} {'409%':>7}")
+    for endpoint, row in report["endpoints"].items():
+        print(
+            f"{endpoint:<24} {row['count']:>7} {row['p50_ms']:>9.2f} {row['p95_ms']:>9.2f} "
+            f"{row['p99_ms']:>9.2f} {row['rate_400'] * 100:>6.2f}% {row['rate_409'] * 100:>6.2f}%"
+        )
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000/api")
+    parser.add_argument("--players", type=int, default=20, help="simulated anonymous players")
+    parser.add_argument("--concurrency", type=int, default=8, help="players running at once")
+    parser.add_argument("--rounds", type=int, default=1, help="quest chain passes per player")
+    parser.add_argument(
+        "--chatter",
+        type=float,
+        default=0.5,
+        help="probability of a generic NPC talk before each quest step (repeats geometrically)",
+    )
+    parser.add_argument("--delta", action="store_true", help="request delta patches instead of snapshots")
+    parser.add_argument("--assume-https", action="store_true", help="send X-Forwarded-Proto: https")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args(argv)
+    if not 0 <= args.chatter < 1:
+        # Chatter repeats while a roll stays under it, so 1.0 would never stop.
+        parser.error("--chatter must be at least 0 and below 1")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    stats = Stats()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        futures = [
+            pool.submit(run_player, args, stats, args.seed * 100003 + index) for index in range(args.players)
+        ]
+    for future in futures:
+        if future.exception() is not None:
+            print(f"player failed: {future.exception()!r}", file=sys.stderr)
+            stats.record_error()
+    report = summarize(stats, time.perf_counter() - started)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    return 1 if report["requests"] == 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())